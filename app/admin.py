@@ -1,6 +1,8 @@
 from flask import Blueprint, render_template, request, redirect, url_for
 from .auth import login_required, role_required
 from .db import get_db
+from .extractor import invalidate as invalidate_rules
+from .metacache import invalidate as invalidate_metadata
 from werkzeug.security import generate_password_hash
 
 bp = Blueprint('admin', __name__)
@@ -62,6 +64,7 @@ def roles():
         if name:
             db.execute('INSERT INTO roles(name, description) VALUES(?,?)', (name, desc))
             db.commit()
+            invalidate_metadata()
         return redirect(url_for('admin.roles'))
     roles = db.execute('SELECT id, name, description FROM roles').fetchall()
     return render_template('admin/roles.html', roles=roles)
@@ -76,6 +79,7 @@ def update_role(role_id):
     if name:
         db.execute('UPDATE roles SET name=?, description=? WHERE id=?', (name, desc, role_id))
         db.commit()
+        invalidate_metadata()
     return redirect(url_for('admin.roles'))
 
 @bp.route('/roles/delete/<int:role_id>')
@@ -85,6 +89,7 @@ def delete_role(role_id):
     db = get_db()
     db.execute('DELETE FROM roles WHERE id=?', (role_id,))
     db.commit()
+    invalidate_metadata()
     return redirect(url_for('admin.roles'))
 
 @bp.route('/settings', methods=['GET','POST'])
@@ -102,8 +107,10 @@ def settings():
             else:
                 db.execute('INSERT INTO settings(app_name, logo_path) VALUES(?,?)', (app_name, logo_path))
             db.commit()
+            invalidate_metadata()
         return redirect(url_for('admin.settings'))
-    row = get_db().execute('SELECT app_name, logo_path FROM settings LIMIT 1').fetchone()
+    from .metacache import get_settings
+    row = get_settings(db)
     return render_template('admin/settings.html', settings=row)
 
 @bp.route('/crawls')
@@ -115,6 +122,7 @@ def crawls():
 @login_required
 def api_crawl_page():
     from .crawler import crawl_baidu_news, crawl_sina_news, crawl_sohu_news, crawl_xinhua_multi
+    from .cache import crawl_page_cache
     from flask import jsonify, request
     kw = request.args.get('keyword','').strip()
     pn = request.args.get('pn','0').strip()
@@ -125,6 +133,10 @@ def api_crawl_page():
         pn_val = 0
     if not kw:
         return jsonify({'error':'Keyword required'}), 400
+    key = crawl_page_cache.make_key(source, kw, pn_val)
+    data = crawl_page_cache.get(key)
+    if data is not None:
+        return jsonify({'data': data, 'pn': pn_val, 'source': source, 'cached': True})
     if source == 'baidu':
         data = crawl_baidu_news(kw, pn=pn_val)
     elif source == 'sina':
@@ -135,25 +147,56 @@ def api_crawl_page():
         data = crawl_xinhua_multi(kw, offset=pn_val, limit=10)
     else:
         return jsonify({'error':'Unknown source'}), 400
-    return jsonify({'data': data, 'pn': pn_val, 'source': source})
+    # crawlers swallow upstream errors and return [], so empty pages are not cached
+    if data:
+        crawl_page_cache.set(key, data)
+    return jsonify({'data': data, 'pn': pn_val, 'source': source, 'cached': False})
+
+@bp.route('/api/crawl_cache_stats')
+@login_required
+@role_required('admin')
+def api_crawl_cache_stats():
+    from flask import jsonify
+    from .cache import crawl_page_cache
+    return jsonify(crawl_page_cache.stats())
+
+@bp.route('/api/llm_cache_stats')
+@login_required
+@role_required('admin')
+def api_llm_cache_stats():
+    from flask import jsonify
+    from .cache import llm_response_cache
+    return jsonify(llm_response_cache.stats())
+
+@bp.route('/api/engine_stats')
+@login_required
+@role_required('admin')
+def api_engine_stats():
+    from flask import jsonify
+    from .router import stats
+    return jsonify(stats())
+
+@bp.route('/api/db_stats')
+@login_required
+@role_required('admin')
+def api_db_stats():
+    from flask import jsonify
+    from .db import pool_stats
+    from .metacache import metadata
+    return jsonify(dict(pool_stats(), metadata=metadata.stats()))
 
 @bp.route('/api/deep_crawl', methods=['POST'])
 @login_required
 def api_deep_crawl():
-    import requests
-    from bs4 import BeautifulSoup
     from flask import jsonify, request
+    from .crawler import fetch_article
+    from .extractor import load_rules
     url = request.json.get('url','') if request.is_json else request.form.get('url','')
     if not url:
         return jsonify({'error':'url required'}), 400
     try:
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.content, 'html.parser')
-        # naive extraction
-        main = soup.find('article') or soup.find('div', class_='content') or soup.find('div', id='content') or soup.body
-        text = main.get_text('\n', strip=True) if main else ''
-        return jsonify({'content': text[:10000]})
+        article = fetch_article(url, timeout=10, rules=load_rules(get_db()))
+        return jsonify({'content': article['content'], 'title': article['title'], 'rule_id': article['rule_id']})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -161,8 +204,7 @@ def api_deep_crawl():
 @login_required
 def api_save_items():
     from flask import request, jsonify
-    from .db import get_db
-    import datetime
+    from .ingest import ingest_items
     items = []
     if request.is_json:
         items = request.json.get('items', [])
@@ -173,160 +215,123 @@ def api_save_items():
         items = json.loads(items)
     if not isinstance(items, list):
         return jsonify({'error':'items must be list'}), 400
-    db = get_db()
-    now = datetime.datetime.now().isoformat()
-    saved = 0
-    for it in items:
-        url = (it.get('original_url') or '').strip()
-        if not url:
-            continue
-        exists = db.execute('SELECT 1 FROM crawl_items WHERE original_url=?', (url,)).fetchone()
-        if exists:
-            continue
-        db.execute(
-            'INSERT INTO crawl_items(keyword,title,summary,cover,original_url,source,deep_crawled,deep_content,detail_json,created_at) VALUES(?,?,?,?,?,?,?,?,?,?)',
-            (
-                it.get('keyword',''),
-                it.get('title',''),
-                it.get('summary',''),
-                it.get('cover',''),
-                url,
-                it.get('source',''),
-                1 if it.get('deep_crawled') else 0,
-                it.get('deep_content',''),
-                it.get('detail_json','') or '{}',
-                now
-            )
-        )
-        saved += 1
-    db.commit()
-    return jsonify({'saved': saved})
+    counts = ingest_items(get_db(), items)
+    return jsonify({'saved': counts['inserted'], **counts})
+
+def _crawl_auto_params():
+    from flask import request
+    data = request.json if request.is_json else request.form
+    kw = (data.get('keyword','') or '').strip()
+    try:
+        num = int(data.get('num','10'))
+    except Exception:
+        num = 10
+    source = (data.get('source','baidu') or 'baidu').strip()
+    if num < 1:
+        num = 1
+    if num > 100:
+        num = 100
+    return kw, num, source
 
 @bp.route('/api/crawl_auto', methods=['POST'])
 @login_required
 def api_crawl_auto():
-    from flask import request, jsonify
-    from .crawler import crawl_baidu_news, crawl_sina_news, crawl_sohu_news, crawl_xinhua_multi
-    from .db import get_db
-    import datetime, json, requests
-    from bs4 import BeautifulSoup
-    kw = ''
-    num = 10
-    source = 'baidu'
-    if request.is_json:
-        kw = (request.json.get('keyword','') or '').strip()
-        try:
-            num = int(request.json.get('num','10'))
-        except Exception:
-            num = 10
-        src = (request.json.get('source','baidu') or 'baidu').strip()
-        source = src
-    else:
-        kw = (request.form.get('keyword','') or '').strip()
-        try:
-            num = int(request.form.get('num','10'))
-        except Exception:
-            num = 10
-        src = (request.form.get('source','baidu') or 'baidu').strip()
-        source = src
+    from flask import jsonify
+    from .jobs import crawl_auto, SOURCES
+    kw, num, source = _crawl_auto_params()
     if not kw:
         return jsonify({'error':'Keyword required'}), 400
-    if num < 1:
-        num = 1
-    if num > 100:
-        num = 100
-    db = get_db()
-    aggregated = []
-    seen = set()
-    if source == 'baidu':
-        cursor = 0
-        step = 10
-        def fetch():
-            return crawl_baidu_news(kw, pn=cursor)
-        def advance():
-            nonlocal cursor
-            cursor += step
-        limit = 200
-    elif source == 'sina':
-        cursor = 0
-        step = 10
-        def fetch():
-            return crawl_sina_news(kw, page=(cursor//10)+1, size=step)
-        def advance():
-            nonlocal cursor
-            cursor += step
-        limit = 200
-    elif source == 'sohu':
-        cursor = 0
-        step = 10
-        def fetch():
-            return crawl_sohu_news(kw, offset=cursor, limit=step)
-        def advance():
-            nonlocal cursor
-            cursor += step
-        limit = 200
-    elif source == 'xinhua':
-        cursor = 0
-        step = 10
-        def fetch():
-            return crawl_xinhua_multi(kw, offset=cursor, limit=step)
-        def advance():
-            nonlocal cursor
-            cursor += step
-        limit = 200
-    else:
+    if source not in SOURCES:
         return jsonify({'error':'Unknown source'}), 400
-    while len(aggregated) < num and cursor <= limit:
-        page = fetch()
-        if not page:
-            break
-        for it in page:
-            url = (it.get('original_url') or '').strip()
-            if not url or url in seen or not it.get('cover') or not it.get('title'):
-                continue
-            seen.add(url)
-            it['keyword'] = kw
-            aggregated.append(it)
-            if len(aggregated) >= num:
-                break
-        advance()
-    now = datetime.datetime.now().isoformat()
-    saved = 0
-    for it in aggregated:
-        url = (it.get('original_url') or '').strip()
-        if not url or not it.get('cover') or not it.get('title'):
-            continue
-        exists = db.execute('SELECT 1 FROM crawl_items WHERE original_url=?', (url,)).fetchone()
-        if exists:
-            continue
-        content = ''
-        try:
-            resp = requests.get(url, timeout=10)
-            resp.raise_for_status()
-            soup = BeautifulSoup(resp.content, 'html.parser')
-            main = soup.find('article') or soup.find('div', class_='content') or soup.find('div', id='content') or soup.body
-            content = main.get_text('\n', strip=True)[:10000] if main else ''
-        except Exception:
-            content = ''
-        details = {'content_length': len(content)}
-        db.execute(
-            'INSERT INTO crawl_items(keyword,title,summary,cover,original_url,source,deep_crawled,deep_content,detail_json,created_at) VALUES(?,?,?,?,?,?,?,?,?,?)',
-            (
-                it.get('keyword',''),
-                it.get('title',''),
-                it.get('summary',''),
-                it.get('cover',''),
-                url,
-                it.get('source',''),
-                1 if content else 0,
-                content,
-                json.dumps(details, ensure_ascii=False),
-                now
-            )
-        )
-        saved += 1
-    db.commit()
-    return jsonify({'saved': saved, 'requested': num, 'keyword': kw, 'items': len(aggregated), 'source': source})
+    stats, _ = crawl_auto(get_db(), kw, num, source)
+    return jsonify({'saved': stats['items_saved'], 'requested': num, 'keyword': kw, 'items': stats['items_found'], 'source': source})
+
+@bp.route('/api/crawl_job_submit', methods=['POST'])
+@login_required
+def api_crawl_job_submit():
+    from flask import jsonify, session
+    from .jobs import submit_crawl_job, SOURCES
+    kw, num, source = _crawl_auto_params()
+    if not kw:
+        return jsonify({'error':'Keyword required'}), 400
+    if source not in SOURCES:
+        return jsonify({'error':'Unknown source'}), 400
+    job_id = submit_crawl_job(kw, num, source, session.get('user_id'))
+    return jsonify({'job_id': job_id, 'status': 'queued'})
+
+@bp.route('/api/crawl_jobs')
+@login_required
+def api_crawl_jobs():
+    from flask import jsonify, request
+    from .jobs import list_jobs, job_to_dict
+    try:
+        limit = int(request.args.get('limit', '20'))
+    except Exception:
+        limit = 20
+    if limit < 1 or limit > 100:
+        limit = 20
+    return jsonify({'items': [job_to_dict(r) for r in list_jobs(limit)]})
+
+@bp.route('/api/crawl_job_status/<int:job_id>')
+@login_required
+def api_crawl_job_status(job_id):
+    from flask import jsonify
+    from .jobs import get_job, job_to_dict
+    r = get_job(job_id)
+    if not r:
+        return jsonify({'error':'not found'}), 404
+    return jsonify(job_to_dict(r))
+
+@bp.route('/api/crawl_job_cancel/<int:job_id>', methods=['POST'])
+@login_required
+def api_crawl_job_cancel(job_id):
+    from flask import jsonify
+    from .jobs import get_job, cancel_job
+    if not get_job(job_id):
+        return jsonify({'error':'not found'}), 404
+    cancel_job(job_id)
+    return jsonify({'cancel_requested': 1})
+
+@bp.route('/api/crawl_job_result/<int:job_id>')
+@login_required
+def api_crawl_job_result(job_id):
+    from flask import jsonify
+    from .jobs import get_job, job_to_dict
+    import json
+    r = get_job(job_id)
+    if not r:
+        return jsonify({'error':'not found'}), 404
+    result = json.loads(r['result_json'] or '{}')
+    urls = result.get('urls') or []
+    db = get_db()
+    items = []
+    ids = result.get('ids') or []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i+500]
+        marks = ','.join('?' * len(chunk))
+        for row in db.execute(f'SELECT id,title,original_url,detail_json FROM crawl_items WHERE id IN ({marks}) ORDER BY id', chunk).fetchall():
+            try:
+                analysis = json.loads(row['detail_json'] or '{}').get('analysis')
+            except (ValueError, AttributeError):
+                analysis = None
+            items.append({'id': row['id'], 'title': row['title'], 'original_url': row['original_url'], 'analysis': analysis})
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i+500]
+        marks = ','.join('?' * len(chunk))
+        rows = db.execute(f'SELECT id,keyword,title,summary,cover,original_url,source,deep_crawled,created_at FROM crawl_items WHERE original_url IN ({marks}) ORDER BY id', chunk).fetchall()
+        for row in rows:
+            items.append({
+                'id': row['id'],
+                'keyword': row['keyword'],
+                'title': row['title'],
+                'summary': row['summary'],
+                'cover': row['cover'],
+                'original_url': row['original_url'],
+                'source': row['source'],
+                'deep_crawled': bool(row['deep_crawled']),
+                'created_at': row['created_at']
+            })
+    return jsonify({'job': job_to_dict(r), 'items': items, 'report_id': result.get('report_id')})
 
 @bp.route('/warehouse')
 @login_required
@@ -337,27 +342,70 @@ def warehouse():
 @login_required
 def api_warehouse_items():
     from flask import jsonify, request
+    from .search import match_query, query_terms, snippet, BM25_WEIGHTS
+    from .paging import page_args, keyset, next_cursor, table_count, cached_count
+    from .archive import partitions_between, attached
     db = get_db()
-    try:
-        page = int(request.args.get('page', '1'))
-        limit = int(request.args.get('limit', '10'))
-    except Exception:
-        page, limit = 1, 10
-    q = (request.args.get('q','') or '').strip()
-    if limit < 1:
-        limit = 10
-    if limit > 100:
-        limit = 100
+    page, limit, q, cursor = page_args(request.args, 10)
+    date_from = (request.args.get('date_from') or '').strip()
+    date_to = (request.args.get('date_to') or '').strip()
     offset = (page - 1) * limit
-    if q:
-        total = db.execute('SELECT COUNT(1) AS cnt FROM crawl_items WHERE title LIKE ? OR keyword LIKE ?', (f'%{q}%', f'%{q}%')).fetchone()['cnt']
-        rows = db.execute('SELECT id,keyword,title,summary,cover,original_url,source,deep_crawled,created_at FROM crawl_items WHERE title LIKE ? OR keyword LIKE ? ORDER BY created_at DESC LIMIT ? OFFSET ?', (f'%{q}%', f'%{q}%', limit, offset)).fetchall()
+    # archived months are attached only when the requested date range reaches back into them
+    months = partitions_between(date_from, date_to) if (date_from or date_to) else []
+    dates, date_params = [], []
+    if date_from:
+        dates.append('created_at >= ?'); date_params.append(date_from)
+    if date_to:
+        dates.append("created_at < date(?, '+1 day')"); date_params.append(date_to)
+    count_key = [q, date_from, date_to]
+    # partitions carry no FTS index, so ranked search only covers the hot database
+    match = match_query(q) if q and not months else None
+    cursor_out = None
+    if match:
+        # relevance order has no stable key to seek on, so ranked search keeps OFFSET paging
+        where = ' AND '.join(['crawl_items_fts MATCH ?'] + ['c.' + d for d in dates])
+        if dates:
+            total = cached_count(db, 'crawl_items_fts', count_key, f'SELECT COUNT(1) FROM crawl_items_fts f JOIN crawl_items c ON c.id=f.rowid WHERE {where}', [match] + date_params)
+        else:
+            total = cached_count(db, 'crawl_items_fts', count_key, 'SELECT COUNT(1) FROM crawl_items_fts WHERE crawl_items_fts MATCH ?', (match,))
+        rows = db.execute(
+            "SELECT c.id,c.keyword,c.title,c.summary,c.cover,c.original_url,c.source,c.deep_crawled,c.created_at,inflate(b.data) AS deep_content,'main' AS part "
+            f'FROM crawl_items_fts f JOIN crawl_items c ON c.id=f.rowid LEFT JOIN content_blobs b ON b.hash=c.content_hash WHERE {where} '
+            'ORDER BY bm25(crawl_items_fts, ?, ?, ?, ?), c.created_at DESC LIMIT ? OFFSET ?',
+            (match, *date_params, *BM25_WEIGHTS, limit, offset)
+        ).fetchall()
     else:
-        total = db.execute('SELECT COUNT(1) AS cnt FROM crawl_items').fetchone()['cnt']
-        rows = db.execute('SELECT id,keyword,title,summary,cover,original_url,source,deep_crawled,created_at FROM crawl_items ORDER BY created_at DESC LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+        where, params = [], []
+        if q:
+            # single CJK characters are below the bigram index granularity
+            where.append('(title LIKE ? OR keyword LIKE ?)')
+            params += [f'%{q}%', f'%{q}%']
+        where += dates
+        params += date_params
+        seek, seek_params, tail, tail_params = keyset('created_at', 'id', cursor, page, limit)
+        try:
+            with attached(db, months) as aliases:
+                schemas = ['main'] + aliases
+                if where:
+                    filtered = ' WHERE ' + ' AND '.join(where)
+                    counts = ' UNION ALL '.join(f'SELECT COUNT(1) AS cnt FROM {s}.crawl_items{filtered}' for s in schemas)
+                    total = cached_count(db, 'crawl_items', count_key, f'SELECT SUM(cnt) FROM ({counts})', params * len(schemas))
+                else:
+                    total = table_count(db, 'crawl_items')
+                page_where = where + [seek] if seek else where
+                filtered = (' WHERE ' + ' AND '.join(page_where)) if page_where else ''
+                branches = [
+                    f"SELECT id,keyword,title,summary,cover,original_url,source,deep_crawled,created_at,NULL AS deep_content,'{s}' AS part FROM {s}.crawl_items{filtered}"
+                    for s in schemas
+                ]
+                rows = db.execute(' UNION ALL '.join(branches) + ' ORDER BY created_at DESC, id DESC' + tail, (params + seek_params) * len(schemas) + tail_params).fetchall()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        cursor_out = next_cursor(rows, limit, 'created_at')
+    terms = query_terms(q)
     items = []
     for r in rows:
-        items.append({
+        item = {
             'id': r['id'],
             'keyword': r['keyword'],
             'title': r['title'],
@@ -366,18 +414,39 @@ def api_warehouse_items():
             'original_url': r['original_url'],
             'source': r['source'],
             'deep_crawled': bool(r['deep_crawled']),
-            'created_at': r['created_at']
-        })
-    return jsonify({'items': items, 'total': total, 'page': page, 'limit': limit})
+            'created_at': r['created_at'],
+            'partition': '' if r['part'] == 'main' else r['part'][4:]
+        }
+        if q:
+            item['snippet'] = snippet(r, terms or [q])
+        items.append(item)
+    return jsonify({'items': items, 'total': total, 'page': page, 'limit': limit, 'next_cursor': cursor_out})
 
 @bp.route('/api/warehouse_item/<int:item_id>')
 @login_required
 def api_warehouse_item(item_id):
-    from flask import jsonify
+    from flask import jsonify, request
+    from .blobs import load_text
+    from .archive import list_partitions, attached, alias
+    from .sentiment import item_sentiment
     db = get_db()
-    r = db.execute('SELECT id,keyword,title,summary,cover,original_url,source,deep_crawled,deep_content,detail_json,created_at FROM crawl_items WHERE id=?', (item_id,)).fetchone()
+    sql = 'SELECT id,keyword,title,summary,cover,original_url,source,deep_crawled,content_hash,detail_json,created_at FROM {s}.crawl_items WHERE id=?'
+    r = db.execute(sql.format(s='main'), (item_id,)).fetchone()
+    content = load_text(db, r['content_hash']) if r else ''
+    if not r:
+        # archived rows keep their id; look in the named partition or walk them newest first
+        wanted = request.args.get('partition')
+        months = [wanted] if wanted in list_partitions() else list(reversed(list_partitions()))
+        for m in months:
+            with attached(db, [m]):
+                r = db.execute(sql.format(s=alias(m)), (item_id,)).fetchone()
+                if r:
+                    content = load_text(db, r['content_hash'], schema=alias(m))
+                    break
     if not r:
         return jsonify({'error':'not found'}), 404
+    # archive partitions do not keep the lexicon columns
+    scored = db.execute('SELECT sentiment_score, risk_score, sentiment_terms, sentiment_flag, scored_at FROM crawl_items WHERE id=?', (item_id,)).fetchone()
     return jsonify({
         'id': r['id'],
         'keyword': r['keyword'],
@@ -387,8 +456,9 @@ def api_warehouse_item(item_id):
         'original_url': r['original_url'],
         'source': r['source'],
         'deep_crawled': bool(r['deep_crawled']),
-        'deep_content': r['deep_content'] or '',
+        'deep_content': content,
         'detail_json': r['detail_json'] or '{}',
+        'sentiment': item_sentiment(scored) if scored else None,
         'created_at': r['created_at']
     })
 
@@ -396,6 +466,8 @@ def api_warehouse_item(item_id):
 @login_required
 def api_warehouse_update(item_id):
     from flask import request, jsonify
+    from .ingest import normalize_url
+    import sqlite3
     db = get_db()
     title = (request.form.get('title') or request.json.get('title') if request.is_json else request.form.get('title')) if request else ''
     summary = (request.form.get('summary') or (request.json.get('summary') if request.is_json else None))
@@ -412,29 +484,129 @@ def api_warehouse_update(item_id):
     if cover is not None:
         fields.append('cover=?'); values.append(cover)
     if original_url is not None:
-        fields.append('original_url=?'); values.append(original_url)
+        fields.append('original_url=?'); values.append(normalize_url(original_url))
     if source is not None:
         fields.append('source=?'); values.append(source)
     if keyword is not None:
         fields.append('keyword=?'); values.append(keyword)
     if not fields:
         return jsonify({'updated': 0})
+    if title is not None or summary is not None:
+        # the lexicon score covers title and summary; the next score job picks the item up again
+        fields.append('scored_at=NULL')
     values.append(item_id)
-    db.execute(f"UPDATE crawl_items SET {', '.join(fields)} WHERE id=?", values)
+    try:
+        db.execute(f"UPDATE crawl_items SET {', '.join(fields)} WHERE id=?", values)
+    except sqlite3.IntegrityError:
+        db.rollback()
+        return jsonify({'error':'original_url already exists'}), 409
     db.commit()
+    if title is not None or summary is not None:
+        from .vectors import mark_stale
+        mark_stale(item_id)
     return jsonify({'updated': 1})
 
 @bp.route('/api/warehouse_analyze/<int:item_id>', methods=['POST'])
 @login_required
 def api_warehouse_analyze(item_id):
-    from flask import jsonify
+    from flask import jsonify, request, session
+    import json
+    from .jobs import submit_analyze_job
     db = get_db()
-    r = db.execute('SELECT id, title, summary, deep_content FROM crawl_items WHERE id=?', (item_id,)).fetchone()
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+    r = db.execute('SELECT id, detail_json, analyzed_at FROM crawl_items WHERE id=?', (item_id,)).fetchone()
     if not r:
         return jsonify({'error': 'not found'}), 404
-    text = (r['deep_content'] or '') or (r['summary'] or '')
-    preview = (text or '')[:400]
-    return jsonify({'analysis': 'AI解析入口预留，待实现', 'preview': preview})
+    force = data.get('force') in (True, 1, '1', 'true')
+    if r['analyzed_at'] and not force:
+        try:
+            analysis = json.loads(r['detail_json'] or '{}').get('analysis')
+        except (ValueError, AttributeError):
+            analysis = None
+        if analysis:
+            return jsonify({'status': 'done', 'analysis': analysis})
+    job_id = submit_analyze_job(data.get('engine_id') or None, [item_id], 1, force, session.get('user_id'))
+    return jsonify({'status': 'queued', 'job_id': job_id})
+
+@bp.route('/api/warehouse_analyze_batch', methods=['POST'])
+@login_required
+def api_warehouse_analyze_batch():
+    from flask import jsonify, request, session
+    from .jobs import submit_analyze_job
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+    try:
+        limit = int(data.get('limit') or 100)
+    except Exception:
+        limit = 100
+    if limit < 1:
+        limit = 100
+    if limit > 5000:
+        limit = 5000
+    ids = data.get('ids') if request.is_json else None
+    try:
+        ids = [int(i) for i in ids] if ids else []
+    except (TypeError, ValueError):
+        return jsonify({'error': 'invalid ids'}), 400
+    flagged = data.get('flagged') in (True, 1, '1', 'true')
+    job_id = submit_analyze_job(data.get('engine_id') or None, ids, limit, data.get('force') in (True, 1, '1', 'true'), session.get('user_id'), flagged)
+    return jsonify({'status': 'queued', 'job_id': job_id})
+
+@bp.route('/api/warehouse_score', methods=['POST'])
+@login_required
+def api_warehouse_score():
+    from flask import jsonify, request, session
+    from .jobs import submit_score_job
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+    job_id = submit_score_job(data.get('rescore') in (True, 1, '1', 'true'), session.get('user_id'))
+    return jsonify({'status': 'queued', 'job_id': job_id})
+
+@bp.route('/api/warehouse_similar/<int:item_id>')
+@login_required
+def api_warehouse_similar(item_id):
+    from flask import jsonify, request
+    from .vectors import similar_items
+    k = min(max(request.args.get('k', 10, type=int), 1), 100)
+    try:
+        items = similar_items(get_db(), item_id, k)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 502
+    if items is None:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify({'items': items})
+
+@bp.route('/api/warehouse_semantic')
+@login_required
+def api_warehouse_semantic():
+    from flask import jsonify, request
+    from .vectors import semantic_search
+    q = (request.args.get('q') or '').strip()
+    if not q:
+        return jsonify({'error': 'q required'}), 400
+    k = min(max(request.args.get('k', 20, type=int), 1), 100)
+    try:
+        items = semantic_search(get_db(), q, k)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 502
+    return jsonify({'items': items})
+
+@bp.route('/api/report_build', methods=['POST'])
+@login_required
+def api_report_build():
+    from flask import jsonify, request, session
+    from .jobs import submit_report_job
+    from .reports import REPORT_MAX_ITEMS
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+    keyword = (data.get('keyword') or '').strip()
+    date_from = (data.get('date_from') or '').strip()
+    date_to = (data.get('date_to') or '').strip()
+    try:
+        limit = int(data.get('limit') or REPORT_MAX_ITEMS)
+    except Exception:
+        limit = REPORT_MAX_ITEMS
+    if limit < 1 or limit > 5000:
+        limit = REPORT_MAX_ITEMS
+    job_id = submit_report_job(keyword, date_from, date_to, data.get('engine_id') or None, limit, session.get('user_id'))
+    return jsonify({'status': 'queued', 'job_id': job_id})
 
 @bp.route('/api/warehouse_delete/<int:item_id>', methods=['POST'])
 @login_required
@@ -456,25 +628,24 @@ def rulelib():
 @role_required('admin')
 def api_rulelib_items():
     from flask import jsonify, request
-    import json
+    from .paging import page_args, keyset, next_cursor, table_count, cached_count
     db = get_db()
-    try:
-        page = int(request.args.get('page', '1'))
-        limit = int(request.args.get('limit', '10'))
-    except Exception:
-        page, limit = 1, 10
-    q = (request.args.get('q','') or '').strip()
-    if limit < 1:
-        limit = 10
-    if limit > 100:
-        limit = 100
-    offset = (page - 1) * limit
+    page, limit, q, cursor = page_args(request.args, 10)
+    where, params = [], []
     if q:
-        total = db.execute('SELECT COUNT(1) AS cnt FROM crawl_rules WHERE site LIKE ? OR domain LIKE ?', (f'%{q}%', f'%{q}%')).fetchone()['cnt']
-        rows = db.execute('SELECT id,site,domain,title_xpath,content_xpath,headers,created_at,updated_at FROM crawl_rules WHERE site LIKE ? OR domain LIKE ? ORDER BY (updated_at IS NULL), updated_at DESC, id DESC LIMIT ? OFFSET ?', (f'%{q}%', f'%{q}%', limit, offset)).fetchall()
+        where.append('(site LIKE ? OR domain LIKE ?)')
+        params += [f'%{q}%', f'%{q}%']
+        total = cached_count(db, 'crawl_rules', q, 'SELECT COUNT(1) FROM crawl_rules WHERE site LIKE ? OR domain LIKE ?', params)
     else:
-        total = db.execute('SELECT COUNT(1) AS cnt FROM crawl_rules').fetchone()['cnt']
-        rows = db.execute('SELECT id,site,domain,title_xpath,content_xpath,headers,created_at,updated_at FROM crawl_rules ORDER BY (updated_at IS NULL), updated_at DESC, id DESC LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+        total = table_count(db, 'crawl_rules')
+    # never-updated rows sort last, as with the old (updated_at IS NULL) ordering
+    seek, seek_params, tail, tail_params = keyset("COALESCE(updated_at,'')", 'id', cursor, page, limit)
+    if seek:
+        where.append(seek)
+    sql = "SELECT id,site,domain,title_xpath,content_xpath,headers,created_at,updated_at,COALESCE(updated_at,'') AS sort_key FROM crawl_rules"
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    rows = db.execute(sql + " ORDER BY COALESCE(updated_at,'') DESC, id DESC" + tail, params + seek_params + tail_params).fetchall()
     items = []
     for r in rows:
         h = r['headers'] or ''
@@ -495,7 +666,7 @@ def api_rulelib_items():
             'created_at': r['created_at'] or '',
             'updated_at': upd
         })
-    return jsonify({'items': items, 'total': total, 'page': page, 'limit': limit})
+    return jsonify({'items': items, 'total': total, 'page': page, 'limit': limit, 'next_cursor': next_cursor(rows, limit, 'sort_key')})
 
 @bp.route('/api/rulelib_create', methods=['POST'])
 @login_required
@@ -515,6 +686,7 @@ def api_rulelib_create():
     now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
     db.execute('INSERT INTO crawl_rules(site,domain,title_xpath,content_xpath,headers,created_at,updated_at) VALUES(?,?,?,?,?,?,?)', (site, domain, title_xpath, content_xpath, headers, now, now))
     db.commit()
+    invalidate_rules()
     return jsonify({'created': 1})
 
 @bp.route('/api/rulelib_update/<int:rule_id>', methods=['POST'])
@@ -539,6 +711,7 @@ def api_rulelib_update(rule_id):
     values.append(rule_id)
     db.execute(f"UPDATE crawl_rules SET {', '.join(fields)} WHERE id=?", values)
     db.commit()
+    invalidate_rules()
     return jsonify({'updated': 1})
 
 @bp.route('/api/rulelib_delete/<int:rule_id>', methods=['POST'])
@@ -549,6 +722,7 @@ def api_rulelib_delete(rule_id):
     db = get_db()
     db.execute('DELETE FROM crawl_rules WHERE id=?', (rule_id,))
     db.commit()
+    invalidate_rules()
     return jsonify({'deleted': 1})
 
 @bp.route('/ai_engines')
@@ -562,24 +736,23 @@ def ai_engines():
 @role_required('admin')
 def api_ai_engines_items():
     from flask import jsonify, request
+    from .paging import page_args, keyset, next_cursor, table_count, cached_count
     db = get_db()
-    try:
-        page = int(request.args.get('page', '1'))
-        limit = int(request.args.get('limit', '12'))
-    except Exception:
-        page, limit = 1, 12
-    q = (request.args.get('q','') or '').strip()
-    if limit < 1:
-        limit = 12
-    if limit > 100:
-        limit = 100
-    offset = (page - 1) * limit
+    page, limit, q, cursor = page_args(request.args, 12)
+    where, params = [], []
     if q:
-        total = db.execute('SELECT COUNT(1) AS cnt FROM ai_engines WHERE provider LIKE ? OR model_name LIKE ?', (f'%{q}%', f'%{q}%')).fetchone()['cnt']
-        rows = db.execute('SELECT id,provider,api_url,model_name,description,created_at,updated_at FROM ai_engines WHERE provider LIKE ? OR model_name LIKE ? ORDER BY (updated_at IS NULL), updated_at DESC, id DESC LIMIT ? OFFSET ?', (f'%{q}%', f'%{q}%', limit, offset)).fetchall()
+        where.append('(provider LIKE ? OR model_name LIKE ?)')
+        params += [f'%{q}%', f'%{q}%']
+        total = cached_count(db, 'ai_engines', q, 'SELECT COUNT(1) FROM ai_engines WHERE provider LIKE ? OR model_name LIKE ?', params)
     else:
-        total = db.execute('SELECT COUNT(1) AS cnt FROM ai_engines').fetchone()['cnt']
-        rows = db.execute('SELECT id,provider,api_url,model_name,description,created_at,updated_at FROM ai_engines ORDER BY (updated_at IS NULL), updated_at DESC, id DESC LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+        total = table_count(db, 'ai_engines')
+    seek, seek_params, tail, tail_params = keyset("COALESCE(updated_at,'')", 'id', cursor, page, limit)
+    if seek:
+        where.append(seek)
+    sql = "SELECT id,provider,api_url,model_name,description,created_at,updated_at,COALESCE(updated_at,'') AS sort_key FROM ai_engines"
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    rows = db.execute(sql + " ORDER BY COALESCE(updated_at,'') DESC, id DESC" + tail, params + seek_params + tail_params).fetchall()
     items = []
     for r in rows:
         upd = r['updated_at'] or ''
@@ -597,7 +770,7 @@ def api_ai_engines_items():
             'description': r['description'] or '',
             'updated_at': upd
         })
-    return jsonify({'items': items, 'total': total, 'page': page, 'limit': limit})
+    return jsonify({'items': items, 'total': total, 'page': page, 'limit': limit, 'next_cursor': next_cursor(rows, limit, 'sort_key')})
 
 @bp.route('/api/ai_engines_get/<int:engine_id>')
 @login_required
@@ -637,6 +810,7 @@ def api_ai_engines_create():
     now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
     db.execute('INSERT INTO ai_engines(provider,api_url,api_key,model_name,description,created_at,updated_at) VALUES(?,?,?,?,?,?,?)', (provider, api_url, api_key, model_name, description, now, now))
     db.commit()
+    invalidate_metadata()
     return jsonify({'created': 1})
 
 @bp.route('/api/ai_engines_update/<int:engine_id>', methods=['POST'])
@@ -661,6 +835,7 @@ def api_ai_engines_update(engine_id):
     values.append(engine_id)
     db.execute(f"UPDATE ai_engines SET {', '.join(fields)} WHERE id=?", values)
     db.commit()
+    invalidate_metadata()
     return jsonify({'updated': 1})
 
 @bp.route('/api/ai_engines_delete/<int:engine_id>', methods=['POST'])
@@ -669,8 +844,10 @@ def api_ai_engines_update(engine_id):
 def api_ai_engines_delete(engine_id):
     from flask import jsonify
     db = get_db()
+    db.execute('DELETE FROM ai_assistant_engines WHERE engine_id=?', (engine_id,))
     db.execute('DELETE FROM ai_engines WHERE id=?', (engine_id,))
     db.commit()
+    invalidate_metadata()
     return jsonify({'deleted': 1})
 
 # AI Assistants
@@ -691,24 +868,23 @@ def ai_assistants_chat_page(assistant_id):
 @role_required('admin')
 def api_ai_assistants_items():
     from flask import jsonify, request
+    from .paging import page_args, keyset, next_cursor, table_count, cached_count
     db = get_db()
-    try:
-        page = int(request.args.get('page', '1'))
-        limit = int(request.args.get('limit', '12'))
-    except Exception:
-        page, limit = 1, 12
-    q = (request.args.get('q','') or '').strip()
-    if limit < 1:
-        limit = 12
-    if limit > 100:
-        limit = 100
-    offset = (page - 1) * limit
+    page, limit, q, cursor = page_args(request.args, 12)
+    where, params = [], []
     if q:
-        total = db.execute('SELECT COUNT(1) AS cnt FROM ai_assistants WHERE name LIKE ?', (f'%{q}%',)).fetchone()['cnt']
-        rows = db.execute('SELECT a.id,a.name,a.engine_id,a.system_prompt,a.created_at,a.updated_at,e.provider,e.model_name FROM ai_assistants a LEFT JOIN ai_engines e ON a.engine_id=e.id WHERE a.name LIKE ? ORDER BY (a.updated_at IS NULL), a.updated_at DESC, a.id DESC LIMIT ? OFFSET ?', (f'%{q}%', limit, offset)).fetchall()
+        where.append('a.name LIKE ?')
+        params.append(f'%{q}%')
+        total = cached_count(db, 'ai_assistants', q, 'SELECT COUNT(1) FROM ai_assistants WHERE name LIKE ?', params)
     else:
-        total = db.execute('SELECT COUNT(1) AS cnt FROM ai_assistants').fetchone()['cnt']
-        rows = db.execute('SELECT a.id,a.name,a.engine_id,a.system_prompt,a.created_at,a.updated_at,e.provider,e.model_name FROM ai_assistants a LEFT JOIN ai_engines e ON a.engine_id=e.id ORDER BY (a.updated_at IS NULL), a.updated_at DESC, a.id DESC LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+        total = table_count(db, 'ai_assistants')
+    seek, seek_params, tail, tail_params = keyset("COALESCE(a.updated_at,'')", 'a.id', cursor, page, limit)
+    if seek:
+        where.append(seek)
+    sql = "SELECT a.id,a.name,a.engine_id,a.system_prompt,a.created_at,a.updated_at,COALESCE(a.updated_at,'') AS sort_key,e.provider,e.model_name FROM ai_assistants a LEFT JOIN ai_engines e ON a.engine_id=e.id"
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    rows = db.execute(sql + " ORDER BY COALESCE(a.updated_at,'') DESC, a.id DESC" + tail, params + seek_params + tail_params).fetchall()
     items = []
     for r in rows:
         upd = r['updated_at'] or ''
@@ -724,7 +900,28 @@ def api_ai_assistants_items():
             'updated_at': upd,
             'system_prompt': r['system_prompt'] or ''
         })
-    return jsonify({'items': items, 'total': total, 'page': page, 'limit': limit})
+    return jsonify({'items': items, 'total': total, 'page': page, 'limit': limit, 'next_cursor': next_cursor(rows, limit, 'sort_key')})
+
+def _engine_ids(value):
+    # the engine pool arrives as a JSON list or a comma separated form field
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = [v for v in value.split(',') if v.strip()]
+    ids = []
+    for v in value:
+        try:
+            v = int(v)
+        except (TypeError, ValueError):
+            continue
+        if v not in ids:
+            ids.append(v)
+    return ids
+
+def _save_engine_pool(db, assistant_id, engine_ids):
+    db.execute('DELETE FROM ai_assistant_engines WHERE assistant_id=?', (assistant_id,))
+    db.executemany('INSERT INTO ai_assistant_engines(assistant_id, engine_id, position) VALUES(?,?,?)',
+                   [(assistant_id, e, i) for i, e in enumerate(engine_ids)])
 
 @bp.route('/api/ai_assistants_get/<int:assistant_id>')
 @login_required
@@ -732,14 +929,17 @@ def api_ai_assistants_items():
 def api_ai_assistants_get(assistant_id):
     from flask import jsonify
     db = get_db()
-    row = db.execute('SELECT id,name,engine_id,system_prompt,created_at,updated_at FROM ai_assistants WHERE id=?', (assistant_id,)).fetchone()
+    row = db.execute('SELECT id,name,engine_id,system_prompt,cache_responses,created_at,updated_at FROM ai_assistants WHERE id=?', (assistant_id,)).fetchone()
     if not row:
         return jsonify({'error':'not found'}), 404
+    pool = db.execute('SELECT engine_id FROM ai_assistant_engines WHERE assistant_id=? ORDER BY position, engine_id', (assistant_id,)).fetchall()
     return jsonify({
         'id': row['id'],
         'name': row['name'],
         'engine_id': row['engine_id'],
+        'engine_ids': [row['engine_id']] + [r['engine_id'] for r in pool if r['engine_id'] != row['engine_id']],
         'system_prompt': row['system_prompt'] or '',
+        'cache_responses': row['cache_responses'] != 0,
         'created_at': row['created_at'] or '',
         'updated_at': row['updated_at'] or ''
     })
@@ -755,6 +955,7 @@ def api_ai_assistants_create():
     name = (data.get('name') or '').strip()
     engine_id = data.get('engine_id')
     prompt = (data.get('system_prompt') or '').strip()
+    cache_responses = 0 if data.get('cache_responses') in (False, 0, '0', 'false') else 1
     try:
         engine_id = int(engine_id)
     except Exception:
@@ -762,8 +963,12 @@ def api_ai_assistants_create():
     if not name:
         return jsonify({'error':'name required'}), 400
     now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
-    db.execute('INSERT INTO ai_assistants(name,engine_id,system_prompt,created_at,updated_at) VALUES(?,?,?,?,?)', (name, engine_id, prompt, now, now))
+    cur = db.execute('INSERT INTO ai_assistants(name,engine_id,system_prompt,cache_responses,created_at,updated_at) VALUES(?,?,?,?,?,?)', (name, engine_id, prompt, cache_responses, now, now))
+    engine_ids = _engine_ids(data.get('engine_ids'))
+    if engine_ids:
+        _save_engine_pool(db, cur.lastrowid, [engine_id] + [e for e in engine_ids if e != engine_id])
     db.commit()
+    invalidate_metadata()
     return jsonify({'created': 1})
 
 @bp.route('/api/ai_assistants_update/<int:assistant_id>', methods=['POST'])
@@ -781,13 +986,23 @@ def api_ai_assistants_update(assistant_id):
         if val is not None:
             fields.append(f"{key}=?")
             values.append(val)
-    if not fields:
+    val = data.get('cache_responses')
+    if val is not None:
+        fields.append('cache_responses=?')
+        values.append(0 if val in (False, 0, '0', 'false') else 1)
+    engine_ids = _engine_ids(data.get('engine_ids'))
+    if not fields and engine_ids is None:
         return jsonify({'updated': 0})
     values.append(datetime.datetime.now().strftime('%Y-%m-%d %H:%M'))
     fields.append('updated_at=?')
     values.append(assistant_id)
     db.execute(f"UPDATE ai_assistants SET {', '.join(fields)} WHERE id=?", values)
+    if engine_ids is not None:
+        row = db.execute('SELECT engine_id FROM ai_assistants WHERE id=?', (assistant_id,)).fetchone()
+        if row:
+            _save_engine_pool(db, assistant_id, [row['engine_id']] + [e for e in engine_ids if e != row['engine_id']])
     db.commit()
+    invalidate_metadata()
     return jsonify({'updated': 1})
 
 @bp.route('/api/ai_assistants_delete/<int:assistant_id>', methods=['POST'])
@@ -797,57 +1012,91 @@ def api_ai_assistants_delete(assistant_id):
     from flask import jsonify
     db = get_db()
     db.execute('DELETE FROM ai_messages WHERE assistant_id=?', (assistant_id,))
+    db.execute('DELETE FROM ai_summaries WHERE assistant_id=?', (assistant_id,))
+    db.execute('DELETE FROM ai_assistant_engines WHERE assistant_id=?', (assistant_id,))
     db.execute('DELETE FROM ai_assistants WHERE id=?', (assistant_id,))
     db.commit()
+    invalidate_metadata()
     return jsonify({'deleted': 1})
 
 @bp.route('/api/ai_assistants_chat/<int:assistant_id>', methods=['POST'])
 @login_required
 @role_required('admin')
 def api_ai_assistants_chat(assistant_id):
-    from flask import request, jsonify
-    import datetime, requests, json
+    from flask import request, jsonify, Response, stream_with_context
+    import datetime
+    from flask import current_app
+    from . import llm, router
+    from .context import add_message, build_messages, schedule_compaction
+    from .metacache import get_assistant, get_engine
     db = get_db()
-    assistant = db.execute('SELECT id,name,engine_id,system_prompt FROM ai_assistants WHERE id=?', (assistant_id,)).fetchone()
+    assistant = get_assistant(db, assistant_id)
     if not assistant:
         return jsonify({'error':'assistant not found'}), 404
-    engine = db.execute('SELECT id,provider,api_url,api_key,model_name FROM ai_engines WHERE id=?', (assistant['engine_id'],)).fetchone()
-    if not engine:
+    engines = [e for e in (get_engine(db, i) for i in assistant['engine_ids']) if e]
+    if not engines:
         return jsonify({'error':'engine not found'}), 404
+    # replies are cached under the pinned engine whichever engine of the pool answered
+    engine = engines[0]
     text = (request.json.get('text') if request.is_json else request.form.get('text')) or ''
     text = text.strip()
+    streaming = (request.json.get('stream') if request.is_json else request.form.get('stream')) in (True, 1, '1', 'true')
     if not text:
         return jsonify({'error':'text required'}), 400
     now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
-    db.execute('INSERT INTO ai_messages(assistant_id,role,content,created_at) VALUES(?,?,?,?)', (assistant_id, 'user', text, now))
-    db.commit()
-    rows = db.execute('SELECT role, content FROM ai_messages WHERE assistant_id=? ORDER BY id DESC LIMIT 20', (assistant_id,)).fetchall()
-    history = [{'role': r['role'], 'content': r['content']} for r in reversed(rows)]
-    messages = []
-    if assistant['system_prompt']:
-        messages.append({'role':'system','content': assistant['system_prompt']})
-    messages.extend(history)
-    endpoint = (engine['api_url'] or '').rstrip('/') + '/chat/completions'
-    payload = {
-        'model': engine['model_name'],
-        'messages': messages,
-        'temperature': 0.7,
-        'stream': False
-    }
-    headers = {'Content-Type': 'application/json'}
-    if engine['api_key']:
-        headers['Authorization'] = 'Bearer ' + engine['api_key']
+    add_message(db, assistant_id, 'user', text, now)
+    # history is filled up to a token budget; turns that fall out are summarised after the reply
+    messages = build_messages(db, assistant)[0]
+    app = current_app._get_current_object()
+
+    def compact_later():
+        # the reply about to be stored can push older turns out too, so compact() decides on the full history
+        schedule_compaction(app, assistant, engine)
+    use_cache = assistant.get('cache_responses') != 0
+    cached = llm.cached_reply(engine, messages) if use_cache else None
+    if cached is not None:
+        add_message(db, assistant_id, 'assistant', cached, now)
+        compact_later()
+        if not streaming:
+            return jsonify({'reply': cached, 'cached': True})
+        body = llm.sse('start', {}) + llm.sse('delta', {'text': cached}) + llm.sse('done', {'reply': cached, 'cached': True})
+        return Response(body, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    if streaming:
+        def relay():
+            parts = []
+            failed = None
+            completed = False
+            answered = []
+            try:
+                yield llm.sse('start', {})
+                for delta in router.stream(engines, messages, on_engine=answered.append):
+                    parts.append(delta)
+                    yield llm.sse('delta', {'text': delta})
+                completed = True
+            except Exception as e:
+                failed = '调用失败: ' + str(e)
+            finally:
+                # also runs on GeneratorExit when the client disconnects, so a partial reply is kept
+                content = ''.join(parts) or failed or ''
+                # a disconnect before the first delta leaves nothing to store; an empty turn would be sent
+                # back to the model with every later message
+                if content:
+                    add_message(db, assistant_id, 'assistant', content, now)
+                    if completed and use_cache:
+                        llm.store_reply(engine, messages, content)
+                    compact_later()
+            if failed and not parts:
+                yield llm.sse('error', {'error': failed})
+            else:
+                yield llm.sse('done', {'reply': content, 'engine_id': answered[0]['id'] if answered else None})
+        return Response(stream_with_context(relay()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    answered = None
     try:
-        resp = requests.post(endpoint, headers=headers, data=json.dumps(payload), timeout=15)
-        resp.raise_for_status()
-        data = resp.json()
-        content = ''
-        try:
-            content = data['choices'][0]['message']['content']
-        except Exception:
-            content = json.dumps(data, ensure_ascii=False)
+        content, answered = router.complete(engines, messages)
+        if use_cache:
+            llm.store_reply(engine, messages, content)
     except Exception as e:
         content = '调用失败: ' + str(e)
-    db.execute('INSERT INTO ai_messages(assistant_id,role,content,created_at) VALUES(?,?,?,?)', (assistant_id, 'assistant', content, now))
-    db.commit()
-    return jsonify({'reply': content})
+    add_message(db, assistant_id, 'assistant', content, now)
+    compact_later()
+    return jsonify({'reply': content, 'engine_id': answered['id'] if answered else None})
@@ -0,0 +1,292 @@
+import os
+import re
+import json
+import time
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import llm
+from .blobs import load_text
+
+ANALYZE_WORKERS = int(os.environ.get('ANALYZE_WORKERS', '4'))
+ANALYZE_CHUNK_CHARS = int(os.environ.get('ANALYZE_CHUNK_CHARS', '3000'))
+ANALYZE_MAX_CHUNKS = int(os.environ.get('ANALYZE_MAX_CHUNKS', '4'))
+ANALYZE_TIMEOUT = float(os.environ.get('ANALYZE_TIMEOUT', '60'))
+# per-engine budgets shared by every analysis job in the process
+ENGINE_RPM = float(os.environ.get('ANALYZE_ENGINE_RPM', '60'))
+ENGINE_TPM = float(os.environ.get('ANALYZE_ENGINE_TPM', '60000'))
+ANALYZE_TEMPERATURE = 0.2
+# tokens reserved for the reply when charging a call against the token budget
+REPLY_TOKENS = 300
+
+CHUNK_PROMPT = (
+    '你是舆情分析助手。阅读用户给出的新闻内容（可能只是全文的一部分），只输出一个JSON对象，不要输出其他文字：'
+    '{"sentiment": "positive|neutral|negative", "score": -1到1之间的数字, "entities": ["人物、机构或地点"], "summary": "不超过120字的摘要"}'
+)
+MERGE_PROMPT = '下面是同一篇新闻各部分的摘要，请合并为一段不超过150字的中文摘要，只输出摘要正文。'
+JSON_RE = re.compile(r'\{.*\}', re.S)
+SENTIMENTS = ('positive', 'neutral', 'negative')
+
+
+class Budget:
+    # token buckets for requests and tokens per minute; acquire blocks until both allow the call
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = rpm
+        self._tokens = tpm
+        self._at = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self._at
+        self._at = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens, should_stop=None):
+        # a single call larger than the whole bucket waits for a full bucket instead of forever
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return True
+                need = max((1 - self._requests) * 60.0 / self.rpm, (tokens - self._tokens) * 60.0 / self.tpm)
+            if should_stop and should_stop():
+                return False
+            pause = min(max(need, 0.05), 0.5)
+            self.waited += pause
+            time.sleep(pause)
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def budget_for(engine_id):
+    with _budgets_lock:
+        b = _budgets.get(engine_id)
+        if b is None:
+            b = _budgets[engine_id] = Budget(ENGINE_RPM, ENGINE_TPM)
+        return b
+
+
+def split_chunks(text, size=ANALYZE_CHUNK_CHARS, max_chunks=ANALYZE_MAX_CHUNKS):
+    # packs whole paragraphs up to size characters; paragraphs longer than size are cut
+    chunks = []
+    current = ''
+    for para in (text or '').split('\n'):
+        para = para.strip()
+        if not para:
+            continue
+        while len(para) > size:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(para[:size])
+            para = para[size:]
+        if current and len(current) + len(para) + 1 > size:
+            chunks.append(current)
+            current = ''
+        current = (current + '\n' + para) if current else para
+    if current:
+        chunks.append(current)
+    return chunks[:max_chunks]
+
+
+def parse_result(reply):
+    data = None
+    m = JSON_RE.search(reply or '')
+    if m:
+        try:
+            data = json.loads(m.group(0))
+        except ValueError:
+            data = None
+    if not isinstance(data, dict):
+        return {'sentiment': 'neutral', 'score': 0.0, 'entities': [], 'summary': (reply or '').strip()[:200], 'parsed': False}
+    try:
+        score = max(-1.0, min(1.0, float(data.get('score') or 0)))
+    except (TypeError, ValueError):
+        score = 0.0
+    sentiment = str(data.get('sentiment') or '').lower()
+    if sentiment not in SENTIMENTS:
+        sentiment = label_for(score)
+    entities = data.get('entities') or []
+    if not isinstance(entities, list):
+        entities = [entities]
+    return {
+        'sentiment': sentiment,
+        'score': score,
+        'entities': [str(e).strip() for e in entities if str(e).strip()],
+        'summary': str(data.get('summary') or '').strip(),
+        'parsed': True
+    }
+
+
+def label_for(score):
+    if score > 0.2:
+        return 'positive'
+    if score < -0.2:
+        return 'negative'
+    return 'neutral'
+
+
+class Stopped(Exception):
+    pass
+
+
+def call_engine(engine, messages, budget, should_stop):
+    # returns (reply, remote); remote is False when the reply came from the LLM cache
+    cached = llm.cached_reply(engine, messages, ANALYZE_TEMPERATURE)
+    if cached is not None:
+        return cached, False
+    if not budget.acquire(llm.estimate_messages(messages) + REPLY_TOKENS, should_stop):
+        raise Stopped()
+    reply = llm.complete(engine, messages, temperature=ANALYZE_TEMPERATURE, timeout=ANALYZE_TIMEOUT)
+    llm.store_reply(engine, messages, reply, ANALYZE_TEMPERATURE)
+    return reply, True
+
+
+def analyze_text(engine, title, text, budget, should_stop=None):
+    chunks = split_chunks(text) or [title or '']
+    parts = []
+    calls = 0
+    for i, chunk in enumerate(chunks):
+        header = f'标题：{title}\n' + (f'（第{i + 1}/{len(chunks)}部分）\n' if len(chunks) > 1 else '')
+        reply, remote = call_engine(engine, [{'role': 'system', 'content': CHUNK_PROMPT}, {'role': 'user', 'content': header + chunk}], budget, should_stop)
+        calls += remote
+        parts.append(parse_result(reply))
+    score = sum(p['score'] for p in parts) / len(parts)
+    counts = {}
+    for p in parts:
+        for e in p['entities']:
+            counts[e] = counts.get(e, 0) + 1
+    entities = sorted(counts, key=lambda e: (-counts[e], e))[:10]
+    summary = parts[0]['summary']
+    if len(parts) > 1:
+        joined = '\n'.join(f'{i + 1}. {p["summary"]}' for i, p in enumerate(parts) if p['summary'])
+        summary, remote = call_engine(engine, [{'role': 'system', 'content': MERGE_PROMPT}, {'role': 'user', 'content': joined}], budget, should_stop)
+        calls += remote
+        summary = summary.strip()
+    result = {
+        'sentiment': label_for(score) if len(parts) > 1 else parts[0]['sentiment'],
+        'score': round(score, 3),
+        'entities': entities,
+        'summary': summary,
+        'chunks': len(chunks),
+        'engine_id': engine['id'],
+        'model': engine['model_name'],
+        'analyzed_at': datetime.datetime.now().isoformat()
+    }
+    return result, calls
+
+
+def pick_engine(db, engine_id=None):
+    from .metacache import get_engine
+    if engine_id:
+        return get_engine(db, engine_id)
+    row = db.execute('SELECT id FROM ai_engines ORDER BY id LIMIT 1').fetchone()
+    return get_engine(db, row['id']) if row else None
+
+
+def run_analysis(db, params, progress=None, should_cancel=None):
+    # walks crawl_items by id; finished items are stamped analyzed_at, so a restarted job skips them
+    engine = pick_engine(db, params.get('engine_id'))
+    if not engine:
+        raise ValueError('engine not found')
+    budget = budget_for(engine['id'])
+    limit = int(params.get('limit') or 100)
+    ids = params.get('ids') or None
+    # with flagged, only rows the lexicon scorer flagged are sent to the engine
+    flagged = bool(params.get('flagged')) and not ids
+    # with force, rows analysed before the job was submitted are redone, rows analysed by this job are not
+    redo_before = params.get('submitted_at') if params.get('force') else None
+    stats = {'pages_fetched': 0, 'items_found': 0, 'items_saved': 0, 'errors': 0}
+    done_ids = []
+
+    # workers only see this event; should_cancel reads the job row on the job thread's connection
+    stop = threading.Event()
+
+    def cancelled():
+        if should_cancel and should_cancel():
+            stop.set()
+        return stop.is_set()
+
+    if flagged:
+        # rows saved since the last scoring pass are scored first so they can be picked up
+        from .sentiment import score_items
+        score_items(db, should_cancel=cancelled)
+
+    def select(after, n):
+        where = ['id > ?']
+        args = [after]
+        if redo_before:
+            where.append('(analyzed_at IS NULL OR analyzed_at < ?)')
+            args.append(redo_before)
+        else:
+            where.append('analyzed_at IS NULL')
+        if ids:
+            where.append(f"id IN ({','.join('?' * len(ids))})")
+            args += ids
+        else:
+            # near-duplicates carry the same story as the row they point at
+            where.append('dup_of IS NULL')
+        if flagged:
+            where.append('sentiment_flag=1')
+        return db.execute(
+            f"SELECT id,title,summary,content_hash,detail_json FROM crawl_items WHERE {' AND '.join(where)} ORDER BY id LIMIT ?",
+            args + [n]
+        ).fetchall()
+
+    def save(row, result):
+        try:
+            detail = json.loads(row['detail_json'] or '{}')
+        except ValueError:
+            detail = {}
+        if not isinstance(detail, dict):
+            detail = {'raw': detail}
+        detail['analysis'] = result
+        db.execute('UPDATE crawl_items SET detail_json=?, analyzed_at=? WHERE id=?', (json.dumps(detail, ensure_ascii=False), result['analyzed_at'], row['id']))
+        db.commit()
+
+    last_id = 0
+    exhausted = False
+    pending = {}
+    with ThreadPoolExecutor(max_workers=ANALYZE_WORKERS, thread_name_prefix='analyze') as pool:
+        while not cancelled():
+            room = min(ANALYZE_WORKERS * 2 - len(pending), limit - stats['items_found'])
+            if room > 0 and not exhausted:
+                rows = select(last_id, room)
+                exhausted = len(rows) < room
+                for row in rows:
+                    last_id = row['id']
+                    text = load_text(db, row['content_hash']) or row['summary'] or ''
+                    pending[pool.submit(analyze_text, engine, row['title'] or '', text, budget, stop.is_set)] = row
+                stats['items_found'] += len(rows)
+            if not pending:
+                break
+            finished, _ = wait(list(pending), timeout=1.0, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                row = pending.pop(fut)
+                try:
+                    result, calls = fut.result()
+                except Stopped:
+                    continue
+                except Exception:
+                    stats['errors'] += 1
+                    continue
+                stats['pages_fetched'] += calls
+                save(row, result)
+                done_ids.append(row['id'])
+                stats['items_saved'] += 1
+            if progress:
+                progress(stats)
+        for fut in pending:
+            fut.cancel()
+    return stats, {'ids': done_ids}
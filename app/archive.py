@@ -0,0 +1,145 @@
+import os
+import re
+import datetime
+from flask import current_app
+from .blobs import gc_blobs
+
+# rows older than ARCHIVE_AFTER_DAYS move into one SQLite file per month under ARCHIVE_DIR;
+# partitions older than RETENTION_MONTHS are deleted (0 keeps them forever)
+ARCHIVE_AFTER_DAYS = int(os.environ.get('CRAWL_ARCHIVE_AFTER_DAYS', '90'))
+RETENTION_MONTHS = int(os.environ.get('CRAWL_RETENTION_MONTHS', '0'))
+ARCHIVE_VACUUM = os.environ.get('CRAWL_ARCHIVE_VACUUM', '1') != '0'
+# SQLite allows 10 attached databases per connection by default
+MAX_ATTACHED = 8
+
+ITEM_COLUMNS = 'id,keyword,title,summary,cover,original_url,source,deep_crawled,content_hash,detail_json,created_at'
+PARTITION_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS {s}.crawl_items (id INTEGER PRIMARY KEY, keyword TEXT, title TEXT, summary TEXT, cover TEXT, '
+    'original_url TEXT, source TEXT, deep_crawled INTEGER DEFAULT 0, content_hash TEXT, detail_json TEXT, created_at TEXT)',
+    'CREATE INDEX IF NOT EXISTS {s}.idx_crawl_items_created ON crawl_items(created_at, id)',
+    'CREATE TABLE IF NOT EXISTS {s}.content_blobs (hash TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER) WITHOUT ROWID',
+)
+PARTITION_RE = re.compile(r'^crawl_items_(\d{6})\.db$')
+
+
+def archive_dir():
+    return current_app.config.get('ARCHIVE_DIR') or os.path.join(os.path.dirname(current_app.config['DATABASE']), 'archive')
+
+
+def partition_path(month):
+    return os.path.join(archive_dir(), f'crawl_items_{month}.db')
+
+
+def alias(month):
+    return 'arc_' + month
+
+
+def month_of(value):
+    # 'YYYY-MM-DD...' -> 'YYYYMM'
+    return (value or '')[:7].replace('-', '')
+
+
+def month_bounds(month):
+    start = datetime.date(int(month[:4]), int(month[4:]), 1)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return start.isoformat(), end.isoformat()
+
+
+def list_partitions():
+    d = archive_dir()
+    if not os.path.isdir(d):
+        return []
+    return sorted(m.group(1) for m in (PARTITION_RE.match(n) for n in os.listdir(d)) if m)
+
+
+def partitions_between(date_from, date_to=None):
+    # a range with only an end date reaches back through the newest MAX_ATTACHED partitions before it,
+    # so it stays usable however many months are archived; an explicit range longer than that is refused
+    lo = month_of(date_from) if date_from else ''
+    hi = month_of(date_to) if date_to else '999999'
+    months = [m for m in list_partitions() if lo <= m <= hi]
+    return months if date_from else months[-MAX_ATTACHED:]
+
+
+class attached:
+    # ATTACH the given monthly partitions for the duration of a with-block. ATTACH and DETACH cannot run
+    # inside a transaction, so the caller must not have one open; writes made in the block must be
+    # committed there, since whatever is still pending on exit is rolled back.
+
+    def __init__(self, db, months, create=False):
+        self.db = db
+        self.months = list(months)
+        self.create = create
+        self.aliases = []
+
+    def __enter__(self):
+        if len(self.months) > MAX_ATTACHED:
+            raise ValueError(f'date range spans more than {MAX_ATTACHED} archived months')
+        if self.db.in_transaction:
+            raise RuntimeError('commit or roll back before attaching archive partitions')
+        try:
+            for m in self.months:
+                if self.create:
+                    os.makedirs(archive_dir(), exist_ok=True)
+                self.db.execute(f'ATTACH DATABASE ? AS {alias(m)}', (partition_path(m),))
+                self.aliases.append(alias(m))
+                if self.create:
+                    for ddl in PARTITION_SCHEMA:
+                        self.db.execute(ddl.format(s=alias(m)))
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return self.aliases
+
+    def __exit__(self, *exc):
+        if self.db.in_transaction:
+            self.db.rollback()
+        for a in self.aliases:
+            self.db.execute(f'DETACH DATABASE {a}')
+        self.aliases = []
+        return False
+
+
+def archive_before(db, cutoff, vacuum=ARCHIVE_VACUUM):
+    # moves crawl_items with created_at < cutoff (ISO date) into their monthly partitions
+    months = [r[0] for r in db.execute(
+        "SELECT DISTINCT substr(created_at, 1, 7) FROM crawl_items WHERE created_at < ? ORDER BY 1", (cutoff,)
+    ).fetchall() if r[0]]
+    moved = {}
+    for ym in months:
+        month = month_of(ym)
+        lo, hi = month_bounds(month)
+        hi = min(hi, cutoff)
+        with attached(db, [month], create=True) as (a,):
+            db.execute(
+                f'INSERT OR IGNORE INTO {a}.content_blobs(hash, data, size) SELECT b.hash, b.data, b.size FROM main.content_blobs b '
+                'WHERE b.hash IN (SELECT content_hash FROM main.crawl_items WHERE created_at >= ? AND created_at < ?)', (lo, hi)
+            )
+            db.execute(
+                f'INSERT OR IGNORE INTO {a}.crawl_items({ITEM_COLUMNS}) SELECT {ITEM_COLUMNS} FROM main.crawl_items '
+                'WHERE created_at >= ? AND created_at < ?', (lo, hi)
+            )
+            cur = db.execute('DELETE FROM main.crawl_items WHERE created_at >= ? AND created_at < ?', (lo, hi))
+            db.commit()
+            moved[month] = cur.rowcount
+    blobs = gc_blobs(db) if moved else 0
+    if moved and vacuum:
+        db.execute('VACUUM')
+    return {'moved': moved, 'blobs_removed': blobs}
+
+
+def apply_retention(months=RETENTION_MONTHS, today=None):
+    if months <= 0:
+        return []
+    today = today or datetime.date.today()
+    y, m = divmod(today.year * 12 + today.month - 1 - months, 12)
+    oldest = f'{y:04d}{m + 1:02d}'
+    removed = []
+    for month in list_partitions():
+        if month < oldest:
+            path = partition_path(month)
+            for ext in ('', '-wal', '-shm', '-journal'):
+                if os.path.exists(path + ext):
+                    os.remove(path + ext)
+            removed.append(month)
+    return removed
@@ -2,6 +2,7 @@ from flask import Blueprint, render_template, request, redirect, url_for, sessio
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 from .db import get_db
+from .metacache import get_role_name
 
 bp = Blueprint('auth', __name__)
 
@@ -31,9 +32,9 @@ def login():
         db = get_db()
         user = db.execute('SELECT id, password_hash, role_id FROM users WHERE username = ?', (username,)).fetchone()
         if user and check_password_hash(user['password_hash'], password):
-            role = db.execute('SELECT name FROM roles WHERE id = ?', (user['role_id'],)).fetchone()
+            role = get_role_name(db, user['role_id'])
             session['user_id'] = user['id']
-            session['role'] = role['name'] if role else 'user'
+            session['role'] = role or 'user'
             if session['role'] == 'admin':
                 return redirect(url_for('admin.index'))
             return redirect(url_for('main.reports'))
@@ -0,0 +1,64 @@
+import zlib
+import hashlib
+
+# article bodies live in content_blobs, zlib-compressed and keyed by the sha256 of the text,
+# so crawl_items rows stay narrow and syndicated copies of one article are stored once
+LEVEL = 6
+CHUNK = 500
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'), LEVEL)
+
+
+def inflate(data):
+    # registered as a SQL function: the FTS triggers index the decompressed text
+    if data is None:
+        return None
+    return zlib.decompress(data).decode('utf-8')
+
+
+def put_blobs(db, texts):
+    # texts: {hash: text}; existing hashes are left alone, caller commits
+    rows = [(h, compress(t), len(t)) for h, t in texts.items() if t]
+    db.executemany('INSERT OR IGNORE INTO content_blobs(hash, data, size) VALUES(?,?,?)', rows)
+    return len(rows)
+
+
+def load_text(db, h, schema='main'):
+    if not h:
+        return ''
+    row = db.execute(f'SELECT data FROM {schema}.content_blobs WHERE hash=?', (h,)).fetchone()
+    return inflate(row['data']) if row else ''
+
+
+def gc_blobs(db):
+    cur = db.execute('DELETE FROM content_blobs WHERE hash NOT IN (SELECT content_hash FROM crawl_items WHERE content_hash IS NOT NULL)')
+    db.commit()
+    return cur.rowcount
+
+
+def migrate_content_blobs(db):
+    # moves inline deep_content into content_blobs; returns the number of rows moved
+    moved = 0
+    while True:
+        rows = db.execute('SELECT id, deep_content FROM crawl_items WHERE deep_content IS NOT NULL LIMIT ?', (CHUNK,)).fetchall()
+        if not rows:
+            break
+        texts = {}
+        updates = []
+        for r in rows:
+            text = r['deep_content']
+            h = content_hash(text) if text else None
+            if h:
+                texts[h] = text
+            updates.append((h, r['id']))
+        put_blobs(db, texts)
+        db.executemany('UPDATE crawl_items SET content_hash=?, deep_content=NULL WHERE id=?', updates)
+        db.commit()
+        moved += len(updates)
+    return moved
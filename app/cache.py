@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class DiskBacking:
+    # small sqlite side file so every gunicorn worker on the box shares cached entries
+
+    def __init__(self, path: str, max_entries: int = 0):
+        self.path = path
+        # expired entries are purged every 100 writes; past max_entries the ones closest to expiry go too
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value, expires_at FROM cache_entries WHERE key=?', (key,)).fetchone()
+        if not row or row[1] < time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, expires_at):
+        conn = self._conn()
+        conn.execute('INSERT OR REPLACE INTO cache_entries(key, value, expires_at) VALUES(?,?,?)', (key, json.dumps(value, ensure_ascii=False), expires_at))
+        conn.commit()
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.trim()
+
+    def trim(self):
+        self.purge()
+        if not self.max_entries:
+            return
+        conn = self._conn()
+        conn.execute(
+            'DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_entries ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+        conn.commit()
+
+    def delete(self, key):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache_entries WHERE key=?', (key,))
+        conn.commit()
+
+    def purge(self):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache_entries WHERE expires_at < ?', (time.time(),))
+        conn.commit()
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache_entries')
+        conn.commit()
+
+
+class TTLCache:
+    # LRU bounded by entry count and approximate JSON size, with per-entry expiry
+
+    def __init__(self, maxsize: int = 512, ttl: float = 300, max_bytes: int = 0, backing=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.backing = backing
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(*parts):
+        return json.dumps(parts, ensure_ascii=False, separators=(',', ':'))
+
+    def _evict(self):
+        while self._data and (len(self._data) > self.maxsize or (self.max_bytes and self._bytes > self.max_bytes)):
+            _, (_, _, size) = self._data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def _store(self, key, value, expires_at, size):
+        old = self._data.pop(key, None)
+        if old:
+            self._bytes -= old[2]
+        self._data[key] = (value, expires_at, size)
+        self._bytes += size
+        self._evict()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry:
+                if entry[1] >= now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._data.pop(key)
+                self._bytes -= entry[2]
+        if self.backing is not None:
+            try:
+                found = self.backing.get(key)
+            except sqlite3.Error:
+                found = None
+            if found:
+                value, expires_at = found
+                with self._lock:
+                    self._store(key, value, expires_at, len(json.dumps(value, ensure_ascii=False)))
+                    self.hits += 1
+                    self.disk_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        size = len(json.dumps(value, ensure_ascii=False))
+        with self._lock:
+            self._store(key, value, expires_at, size)
+        if self.backing is not None:
+            try:
+                self.backing.set(key, value, expires_at)
+            except sqlite3.Error:
+                pass
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry:
+                self._bytes -= entry[2]
+        if self.backing is not None:
+            try:
+                self.backing.delete(key)
+            except sqlite3.Error:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+        if self.backing is not None:
+            try:
+                self.backing.clear()
+            except sqlite3.Error:
+                pass
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'maxsize': self.maxsize,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / total) if total else 0.0,
+                'shared': self.backing is not None
+            }
+
+
+CRAWL_CACHE_DISK_ENTRIES = int(os.environ.get('CRAWL_CACHE_DISK_ENTRIES', '5000'))
+_crawl_path = os.environ.get('CRAWL_CACHE_PATH')
+crawl_page_cache = TTLCache(
+    maxsize=int(os.environ.get('CRAWL_CACHE_SIZE', '512')),
+    ttl=float(os.environ.get('CRAWL_CACHE_TTL', '300')),
+    max_bytes=int(os.environ.get('CRAWL_CACHE_MAX_BYTES', str(32 * 1024 * 1024))),
+    backing=DiskBacking(_crawl_path, max_entries=CRAWL_CACHE_DISK_ENTRIES) if _crawl_path else None
+)
+
+# chat completions survive restarts by default: init_app puts them in the instance folder unless
+# LLM_CACHE_PATH (environment or app config) names a file; LLM_CACHE_PATH='' keeps them in memory only
+LLM_CACHE_DISK_ENTRIES = int(os.environ.get('LLM_CACHE_DISK_ENTRIES', '20000'))
+_llm_path = os.environ.get('LLM_CACHE_PATH')
+llm_response_cache = TTLCache(
+    maxsize=int(os.environ.get('LLM_CACHE_SIZE', '1024')),
+    ttl=float(os.environ.get('LLM_CACHE_TTL', str(7 * 24 * 3600))),
+    max_bytes=int(os.environ.get('LLM_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+    backing=DiskBacking(_llm_path, max_entries=LLM_CACHE_DISK_ENTRIES) if _llm_path else None
+)
+
+
+def init_app(app):
+    if _llm_path is not None or llm_response_cache.backing is not None:
+        return
+    path = app.config.get('LLM_CACHE_PATH')
+    if path is None:
+        os.makedirs(app.instance_path, exist_ok=True)
+        path = os.path.join(app.instance_path, 'llm_cache.db')
+    if path:
+        llm_response_cache.backing = DiskBacking(path, max_entries=LLM_CACHE_DISK_ENTRIES)
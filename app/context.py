@@ -0,0 +1,154 @@
+import os
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import llm
+
+# history sent with each chat turn is capped by estimated tokens rather than by message count;
+# turns that fall out of the window are folded into one stored rolling summary per assistant
+CONTEXT_TOKENS = int(os.environ.get('CHAT_CONTEXT_TOKENS', '3000'))
+SUMMARY_TOKENS = int(os.environ.get('CHAT_SUMMARY_TOKENS', '400'))
+# once a turn falls out of the window, compaction also folds this many tokens of the oldest turns still
+# in it, so it runs about once per that much new conversation rather than after every turn
+COMPACT_AFTER_TOKENS = int(os.environ.get('CHAT_COMPACT_AFTER_TOKENS', '1000'))
+MAX_HISTORY_ROWS = 200
+
+SUMMARY_PROMPT = (
+    '你负责压缩对话记录。请把“已有摘要”和“新增对话”合并为一段不超过300字的中文摘要，'
+    '保留事实、数据、结论和用户的要求与偏好，不要编造，只输出摘要正文。'
+)
+SUMMARY_PREFIX = '此前对话摘要：'
+
+_pool = None
+_pool_lock = threading.Lock()
+_running = set()
+
+
+def with_token_counts(db, rows):
+    # fills token_count for rows written before the column existed and stores it for next time
+    out = []
+    missing = []
+    for r in rows:
+        count = r['token_count']
+        if count is None:
+            count = llm.estimate_tokens(r['content'])
+            missing.append((count, r['id']))
+        out.append({'id': r['id'], 'role': r['role'], 'content': r['content'], 'tokens': count})
+    if missing:
+        db.executemany('UPDATE ai_messages SET token_count=? WHERE id=?', missing)
+        db.commit()
+    return out
+
+
+def add_message(db, assistant_id, role, content, created_at):
+    db.execute(
+        'INSERT INTO ai_messages(assistant_id,role,content,token_count,created_at) VALUES(?,?,?,?,?)',
+        (assistant_id, role, content, llm.estimate_tokens(content), created_at)
+    )
+    db.commit()
+
+
+def window_tokens(assistant, budget=CONTEXT_TOKENS):
+    # room left for turns; a full-size summary is always reserved, so compacting never shrinks the window
+    # and build_messages and compact agree on which turns are outside it
+    return (budget - llm.estimate_messages([{'content': assistant['system_prompt']}])
+            - SUMMARY_TOKENS - llm.estimate_tokens(SUMMARY_PREFIX) - llm.MESSAGE_OVERHEAD)
+
+
+def build_messages(db, assistant, budget=CONTEXT_TOKENS):
+    # returns (messages, overflow); overflow means older unsummarised turns were left out
+    summary = db.execute('SELECT upto_id, content, token_count FROM ai_summaries WHERE assistant_id=?', (assistant['id'],)).fetchone()
+    upto = summary['upto_id'] if summary else 0
+    rows = db.execute(
+        'SELECT id, role, content, token_count FROM ai_messages WHERE assistant_id=? AND id>? ORDER BY id DESC LIMIT ?',
+        (assistant['id'], upto, MAX_HISTORY_ROWS)
+    ).fetchall()
+    history = with_token_counts(db, rows)
+    available = window_tokens(assistant, budget)
+    picked = []
+    used = 0
+    overflow = len(rows) >= MAX_HISTORY_ROWS
+    for m in history:
+        cost = m['tokens'] + llm.MESSAGE_OVERHEAD
+        if picked and used + cost > available:
+            overflow = True
+            break
+        content = m['content']
+        if not picked and cost > available:
+            # a single pasted article larger than the window is cut rather than dropped
+            content = llm.truncate_tokens(content, max(available - llm.MESSAGE_OVERHEAD, 1))
+            cost = available
+        picked.append({'role': m['role'], 'content': content})
+        used += cost
+    messages = []
+    if assistant['system_prompt']:
+        messages.append({'role': 'system', 'content': assistant['system_prompt']})
+    if summary and summary['content']:
+        messages.append({'role': 'system', 'content': SUMMARY_PREFIX + summary['content']})
+    messages.extend(reversed(picked))
+    return messages, overflow
+
+
+def compact(db, assistant, engine, budget=CONTEXT_TOKENS):
+    # folds the turns that no longer fit the window into the rolling summary; returns True if it did
+    summary = db.execute('SELECT upto_id, content FROM ai_summaries WHERE assistant_id=?', (assistant['id'],)).fetchone()
+    upto = summary['upto_id'] if summary else 0
+    rows = db.execute(
+        'SELECT id, role, content, token_count FROM ai_messages WHERE assistant_id=? AND id>? ORDER BY id DESC',
+        (assistant['id'], upto)
+    ).fetchall()
+    history = with_token_counts(db, rows)
+    window = window_tokens(assistant, budget)
+    used = 0
+    cut = None
+    for i, m in enumerate(history):
+        used += m['tokens'] + llm.MESSAGE_OVERHEAD
+        if i > 0 and cut is None and used > window - COMPACT_AFTER_TOKENS:
+            cut = i
+        if i > 0 and used > window:
+            break
+    else:
+        # everything unsummarised still fits the window build_messages sends
+        return False
+    older = history[cut:]
+    older.reverse()
+    transcript = '\n'.join(
+        ('用户' if m['role'] == 'user' else '助手') + '：' + llm.truncate_tokens(m['content'], 800) for m in older
+    )
+    prompt = '已有摘要：' + ((summary['content'] if summary else '') or '无') + '\n\n新增对话：\n' + transcript
+    text = llm.complete(engine, [{'role': 'system', 'content': SUMMARY_PROMPT}, {'role': 'user', 'content': prompt}], temperature=0.2, timeout=60).strip()
+    text = llm.truncate_tokens(text, SUMMARY_TOKENS)
+    db.execute(
+        'INSERT INTO ai_summaries(assistant_id, upto_id, content, token_count, updated_at) VALUES(?,?,?,?,?) '
+        'ON CONFLICT(assistant_id) DO UPDATE SET upto_id=excluded.upto_id, content=excluded.content, '
+        'token_count=excluded.token_count, updated_at=excluded.updated_at',
+        (assistant['id'], older[-1]['id'], text, llm.estimate_tokens(text), datetime.datetime.now().strftime('%Y-%m-%d %H:%M'))
+    )
+    db.commit()
+    return True
+
+
+def _compact_job(app, assistant, engine):
+    from .db import get_db
+    try:
+        with app.app_context():
+            compact(get_db(), assistant, engine)
+    except Exception:
+        # the next turn simply tries again
+        pass
+    finally:
+        with _pool_lock:
+            _running.discard(assistant['id'])
+
+
+def schedule_compaction(app, assistant, engine):
+    # runs after the reply is sent so summarising never adds to the user's wait
+    global _pool
+    with _pool_lock:
+        if assistant['id'] in _running:
+            return False
+        _running.add(assistant['id'])
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-compact')
+    _pool.submit(_compact_job, app, dict(assistant), dict(engine))
+    return True
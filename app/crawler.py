@@ -1,7 +1,33 @@
 import os
-import requests
-from bs4 import BeautifulSoup, Comment
+from bs4 import Comment
 import json
+import time
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import http_client
+from .extractor import extract_with_rule
+from .snapshot import HomepageSnapshot
+from .html_parser import make_soup, compile_selector, class_contains, PORTAL_TAGS
+
+BAIDU_CONTAINERS = compile_selector("div.c-container")
+BAIDU_RESULT_OP = compile_selector("div.result-op")
+SINA_RESULT_DIVS = class_contains("div", "box-result", "result")
+SINA_RESULTS = compile_selector(".box-result, .result")
+SOHU_DIVS = class_contains("div", "box", "result", "news", "item")
+SOHU_RESULTS = compile_selector(".news-box .box, .result, .result-item, .news-item")
+SOHU_FALLBACK_DIVS = class_contains("div", "result", "news")
+PORTAL_LI = compile_selector("li")
+PORTAL_ARTICLE = compile_selector("article")
+PORTAL_DIVS = class_contains("div", "news", "item", "list", "pic")
+
+
+def portal_containers(soup):
+    containers = []
+    containers.extend(PORTAL_LI.select(soup))
+    containers.extend(PORTAL_ARTICLE.select(soup))
+    containers.extend(PORTAL_DIVS.select(soup))
+    return containers
+
 
 def crawl_baidu_news(keyword: str, pn: int = 0):
     url = "https://www.baidu.com/s"
@@ -45,12 +71,12 @@ def crawl_baidu_news(keyword: str, pn: int = 0):
         headers["cookie"] = cookie
     results = []
     try:
-        resp = requests.get(url, params=params, headers=headers, timeout=10)
+        resp = http_client.get(url, params=params, headers=headers, timeout=10)
         resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, "html.parser")
-        containers = soup.find_all("div", class_="c-container")
+        soup = make_soup(resp.text)
+        containers = BAIDU_CONTAINERS.select(soup)
         if not containers:
-            containers = soup.find_all("div", class_="result-op")
+            containers = BAIDU_RESULT_OP.select(soup)
         for item in containers:
             obj = {}
             comment = item.find(string=lambda t: isinstance(t, Comment) and "s-data:" in t)
@@ -122,12 +148,12 @@ def crawl_sina_news(keyword: str, page: int = 1, size: int = 10):
     }
     results = []
     try:
-        resp = requests.get(url, params=params, headers=headers, timeout=10)
+        resp = http_client.get(url, params=params, headers=headers, timeout=10)
         resp.raise_for_status()
-        soup = BeautifulSoup(resp.content, "html.parser")
+        soup = make_soup(resp.content)
         items = []
-        items.extend(soup.find_all("div", class_=lambda c: c and ("box-result" in c or "result" in c)))
-        items.extend(soup.select(".box-result, .result") or [])
+        items.extend(SINA_RESULT_DIVS.select(soup))
+        items.extend(SINA_RESULTS.select(soup))
         seen = set()
         for it in items:
             a = it.find("a")
@@ -176,12 +202,12 @@ def crawl_sohu_news(keyword: str, offset: int = 0, limit: int = 10):
         except Exception:
             page = 1
         params = {"keyword": keyword, "p": page}
-        resp = requests.get(url, params=params, headers=headers, timeout=10)
+        resp = http_client.get(url, params=params, headers=headers, timeout=10)
         resp.raise_for_status()
-        soup = BeautifulSoup(resp.content, "html.parser")
+        soup = make_soup(resp.content)
         items = []
-        items.extend(soup.find_all("div", class_=lambda c: c and ("box" in c or "result" in c or "news" in c or "item" in c)))
-        items.extend(soup.select(".news-box .box, .result, .result-item, .news-item") or [])
+        items.extend(SOHU_DIVS.select(soup))
+        items.extend(SOHU_RESULTS.select(soup))
         seen = set()
         for it in items:
             a = it.find("a")
@@ -215,10 +241,10 @@ def crawl_sohu_news(keyword: str, offset: int = 0, limit: int = 10):
                 results.append(obj)
         if not results and keyword:
             params = {"query": keyword, "page": page}
-            resp = requests.get(url, params=params, headers=headers, timeout=10)
+            resp = http_client.get(url, params=params, headers=headers, timeout=10)
             resp.raise_for_status()
-            soup = BeautifulSoup(resp.content, "html.parser")
-            items = soup.select(".news-box .box, .result, .result-item, .news-item") or soup.find_all("div", class_=lambda c: c and ("result" in c or "news" in c))
+            soup = make_soup(resp.content)
+            items = SOHU_RESULTS.select(soup) or SOHU_FALLBACK_DIVS.select(soup)
             seen = set()
             for it in items:
                 a = it.find("a")
@@ -251,46 +277,9 @@ def crawl_sohu_news(keyword: str, offset: int = 0, limit: int = 10):
                 if obj.get("title") and obj.get("original_url") and obj.get("cover"):
                     results.append(obj)
         if not results:
-            backup_url = "https://news.sohu.com/"
+            # homepage fallback is answered from the shared snapshot instead of refetching news.sohu.com
             try:
-                resp = requests.get(backup_url, headers=headers, timeout=10)
-                resp.raise_for_status()
-                soup = BeautifulSoup(resp.content, "html.parser")
-                containers = []
-                containers.extend(soup.find_all("li"))
-                containers.extend(soup.find_all("article"))
-                containers.extend(soup.find_all("div", class_=lambda c: c and ("news" in c or "item" in c or "list" in c or "pic" in c)))
-                seen = set()
-                for item in containers:
-                    a = item.find("a")
-                    if not a:
-                        continue
-                    href = (a.get("href") or "").strip()
-                    title = a.get_text(strip=True)
-                    if not href or not title:
-                        continue
-                    if href in seen:
-                        continue
-                    seen.add(href)
-                    original_url = href if href.startswith("http") else ("https://news.sohu.com/" + href.lstrip("/"))
-                    p = item.find("p") or item.find("div")
-                    summary = p.get_text(strip=True) if p else ""
-                    img = item.find("img")
-                    cover = (img.get("src") or "").strip() if img else ""
-                    if cover and not (cover.startswith("http://") or cover.startswith("https://")):
-                        cover = "https://news.sohu.com/" + cover.lstrip("/")
-                    text = (title or "") + " " + (summary or "")
-                    if keyword and keyword not in text:
-                        continue
-                    obj = {
-                        "title": title,
-                        "summary": summary,
-                        "cover": cover,
-                        "original_url": original_url,
-                        "source": "搜狐新闻"
-                    }
-                    if obj.get("title") and obj.get("original_url") and obj.get("cover"):
-                        results.append(obj)
+                results = SOHU_HOME_SNAPSHOT.search(keyword)
             except Exception:
                 pass
     except Exception:
@@ -301,71 +290,229 @@ def crawl_sohu_news(keyword: str, offset: int = 0, limit: int = 10):
         limit = 10
     return results[offset:offset+limit]
 
-def crawl_xinhua_multi(keyword: str, offset: int = 0, limit: int = 10):
-    bases = [
-        "https://sc.news.cn/",
-        "http://yn.news.cn/",
-        "http://sx.news.cn/",
-        "http://ha.news.cn/",
-        "http://hq.news.cn/",
-        "http://bj.news.cn/"
-    ]
+
+def _sohu_home_entries():
     headers = {
         "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
         "accept-language": "zh-CN,zh;q=0.9",
+        "referer": "https://search.sohu.com/",
         "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
     }
+    backup_url = "https://news.sohu.com/"
+    resp = http_client.get(backup_url, headers=headers, timeout=10)
+    resp.raise_for_status()
+    containers = portal_containers(make_soup(resp.content, parse_only=PORTAL_TAGS))
     results = []
     seen = set()
-    for base in bases:
+    for item in containers:
+        a = item.find("a")
+        if not a:
+            continue
+        href = (a.get("href") or "").strip()
+        title = a.get_text(strip=True)
+        if not href or not title:
+            continue
+        if href in seen:
+            continue
+        seen.add(href)
+        original_url = href if href.startswith("http") else ("https://news.sohu.com/" + href.lstrip("/"))
+        p = item.find("p") or item.find("div")
+        summary = p.get_text(strip=True) if p else ""
+        img = item.find("img")
+        cover = (img.get("src") or "").strip() if img else ""
+        if cover and not (cover.startswith("http://") or cover.startswith("https://")):
+            cover = "https://news.sohu.com/" + cover.lstrip("/")
+        obj = {
+            "title": title,
+            "summary": summary,
+            "cover": cover,
+            "original_url": original_url,
+            "source": "搜狐新闻"
+        }
+        if obj.get("title") and obj.get("original_url") and obj.get("cover"):
+            results.append(obj)
+    return results
+
+
+SOHU_HOME_SNAPSHOT = HomepageSnapshot("sohu_home", _sohu_home_entries)
+
+
+XINHUA_BASES = [
+    "https://sc.news.cn/",
+    "http://yn.news.cn/",
+    "http://sx.news.cn/",
+    "http://ha.news.cn/",
+    "http://hq.news.cn/",
+    "http://bj.news.cn/"
+]
+
+XINHUA_DEADLINE = float(os.environ.get("XINHUA_DEADLINE", "12"))
+
+
+def _xinhua_fetch_base(base: str, headers: dict, timeout: float):
+    resp = http_client.get(base, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    containers = portal_containers(make_soup(resp.content, parse_only=PORTAL_TAGS))
+    entries = []
+    seen = set()
+    for item in containers:
+        a = item.find("a")
+        if not a:
+            continue
+        href = (a.get("href") or "").strip()
+        title = a.get_text(strip=True)
+        if not href or not title:
+            continue
+        if href in seen:
+            continue
+        seen.add(href)
+        if href.startswith("http"):
+            original_url = href
+        else:
+            original_url = base.rstrip("/") + "/" + href.lstrip("/")
+        p = item.find("p") or item.find("div")
+        summary = p.get_text(strip=True) if p else ""
+        img = item.find("img")
+        cover = (img.get("src") or "").strip() if img else ""
+        if cover and not (cover.startswith("http://") or cover.startswith("https://")):
+            cover = base.rstrip("/") + "/" + cover.lstrip("/")
+        obj = {
+            "title": title,
+            "summary": summary,
+            "cover": cover,
+            "original_url": original_url,
+            "source": "新华网"
+        }
+        if not (obj.get("title") and obj.get("original_url") and obj.get("cover")):
+            obj = None
+        # href is kept even when the item is unusable so cross-site dedupe matches the serial order
+        entries.append((href, obj))
+    return entries
+
+
+def _xinhua_sources(deadline: float = None):
+    # {base: entries} per regional homepage; None for one that failed or missed the deadline
+    headers = {
+        "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
+        "accept-language": "zh-CN,zh;q=0.9",
+        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+    }
+    if deadline is None:
+        deadline = XINHUA_DEADLINE
+    # fan out all regional homepages at once; whatever misses the deadline is dropped
+    pool = ThreadPoolExecutor(max_workers=len(XINHUA_BASES), thread_name_prefix="xinhua")
+    futures = {}
+    for idx, base in enumerate(XINHUA_BASES):
+        futures[pool.submit(_xinhua_fetch_base, base, headers, min(10, deadline))] = idx
+    done, _ = wait(futures, timeout=deadline)
+    pool.shutdown(wait=False, cancel_futures=True)
+    per_base = dict.fromkeys(XINHUA_BASES)
+    for fut in done:
         try:
-            resp = requests.get(base, headers=headers, timeout=10)
-            resp.raise_for_status()
-            soup = BeautifulSoup(resp.content, "html.parser")
-            containers = []
-            containers.extend(soup.find_all("li"))
-            containers.extend(soup.find_all("article"))
-            containers.extend(soup.find_all("div", class_=lambda c: c and ("news" in c or "item" in c or "list" in c or "pic" in c)))
-            for item in containers:
-                a = item.find("a")
-                if not a:
-                    continue
-                href = (a.get("href") or "").strip()
-                title = a.get_text(strip=True)
-                if not href or not title:
-                    continue
-                if href in seen:
-                    continue
-                seen.add(href)
-                if href.startswith("http"):
-                    original_url = href
-                else:
-                    original_url = base.rstrip("/") + "/" + href.lstrip("/")
-                p = item.find("p") or item.find("div")
-                summary = p.get_text(strip=True) if p else ""
-                img = item.find("img")
-                cover = (img.get("src") or "").strip() if img else ""
-                if cover and not (cover.startswith("http://") or cover.startswith("https://")):
-                    cover = base.rstrip("/") + "/" + cover.lstrip("/")
-                text = (title or "") + " " + (summary or "")
-                if keyword and keyword not in text:
-                    continue
-                obj = {
-                    "title": title,
-                    "summary": summary,
-                    "cover": cover,
-                    "original_url": original_url,
-                    "source": "新华网"
-                }
-                if obj.get("title") and obj.get("original_url") and obj.get("cover"):
-                    results.append(obj)
+            per_base[XINHUA_BASES[futures[fut]]] = fut.result()
         except Exception:
             pass
+    return per_base
+
+
+def _xinhua_merge(per_base: dict):
+    results = []
+    seen = set()
+    for base in XINHUA_BASES:
+        for href, obj in per_base.get(base) or ():
+            if href in seen:
+                continue
+            seen.add(href)
+            if obj:
+                results.append(obj)
+    return results
+
+
+XINHUA_SNAPSHOT = HomepageSnapshot("xinhua", _xinhua_sources, merge=_xinhua_merge)
+
+
+def crawl_xinhua_multi(keyword: str, offset: int = 0, limit: int = 10):
+    # homepages are fetched once per SNAPSHOT_TTL; every keyword/page is served from the index
+    results = XINHUA_SNAPSHOT.search(keyword)
     if offset < 0:
         offset = 0
     if limit < 1:
         limit = 10
     return results[offset:offset+limit]
+
+
+DEEP_CRAWL_WORKERS = int(os.environ.get("DEEP_CRAWL_WORKERS", "8"))
+DEEP_CRAWL_PER_DOMAIN = int(os.environ.get("DEEP_CRAWL_PER_DOMAIN", "2"))
+DEEP_CRAWL_BUDGET = float(os.environ.get("DEEP_CRAWL_BUDGET", "60"))
+
+
+def extract_article_text(content, limit: int = 10000):
+    soup = make_soup(content)
+    main = soup.find("article") or soup.find("div", class_="content") or soup.find("div", id="content") or soup.body
+    return main.get_text("\n", strip=True)[:limit] if main else ""
+
+
+def fetch_article(url: str, timeout: float = 10, rules=None):
+    rule = rules.match(url) if rules else None
+    resp = http_client.get(url, timeout=timeout, headers=(rule.headers if rule else None))
+    resp.raise_for_status()
+    # a matching rulelib entry gives targeted XPath extraction; otherwise fall back to the generic walk
+    extracted = extract_with_rule(resp.content, rule)
+    if extracted:
+        return extracted
+    return {"title": "", "content": extract_article_text(resp.content), "rule_id": None}
+
+
+def fetch_article_text(url: str, timeout: float = 10, rules=None):
+    return fetch_article(url, timeout, rules)["content"]
+
+
+def deep_crawl_batch(urls, max_workers: int = None, per_domain: int = None, budget: float = None, should_stop=None, rules=None):
+    # returns {url: text} for the pages that finished inside the budget; the rest are simply absent
+    max_workers = max_workers or DEEP_CRAWL_WORKERS
+    per_domain = per_domain or DEEP_CRAWL_PER_DOMAIN
+    budget = DEEP_CRAWL_BUDGET if budget is None else budget
+    pending = []
+    for u in urls:
+        if u and u not in pending:
+            pending.append(u)
+    results = {}
+    if not pending:
+        return results
+    deadline = time.monotonic() + budget
+    in_flight = {}
+    running = {}
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="deepcrawl")
+    try:
+        while pending or running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (should_stop and should_stop()):
+                break
+            i = 0
+            while i < len(pending) and len(running) < max_workers:
+                u = pending[i]
+                domain = urlsplit(u).netloc.lower()
+                if in_flight.get(domain, 0) >= per_domain:
+                    i += 1
+                    continue
+                pending.pop(i)
+                in_flight[domain] = in_flight.get(domain, 0) + 1
+                running[pool.submit(fetch_article_text, u, min(10, remaining), rules)] = (u, domain)
+            if not running:
+                break
+            # poll at least once a second when the caller can ask us to stop
+            done, _ = wait(running, timeout=min(remaining, 1.0) if should_stop else remaining, return_when=FIRST_COMPLETED)
+            for fut in done:
+                u, domain = running.pop(fut)
+                in_flight[domain] -= 1
+                try:
+                    results[u] = fut.result()
+                except Exception:
+                    results[u] = ""
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    return results
+
 if __name__ == "__main__":
     import sys, json as _json
     kw = sys.argv[1] if len(sys.argv) > 1 else "宜宾"
@@ -1,16 +1,79 @@
+import os
 import sqlite3
+import threading
+import weakref
 from flask import current_app, g
+from .search import cjk_bigrams
+from .blobs import inflate
+
+# applied to every new connection; app.config['SQLITE_PRAGMAS'] overrides individual entries
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+STATEMENT_CACHE = int(os.environ.get('SQLITE_STATEMENT_CACHE', '512'))
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_live = weakref.WeakSet()
+_stats = {'opened': 0, 'reused': 0}
+
+
+class Connection(sqlite3.Connection):
+    # subclass only so live connections can be tracked through weak references
+    pass
+
+
+def connect(path, pragmas=None):
+    # one connection per (thread, database file), kept open for the life of the thread
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is not None:
+        with _stats_lock:
+            _stats['reused'] += 1
+        return conn
+    settings = dict(DEFAULT_PRAGMAS)
+    settings.update(pragmas or {})
+    conn = sqlite3.connect(path, timeout=settings.get('busy_timeout', 5000) / 1000.0, cached_statements=STATEMENT_CACHE, factory=Connection)
+    conn.row_factory = sqlite3.Row
+    # the crawl_items FTS triggers call these, so every connection that writes crawl_items needs them
+    conn.create_function('cjk_bigrams', 1, cjk_bigrams, deterministic=True)
+    conn.create_function('inflate', 1, inflate, deterministic=True)
+    for name, value in settings.items():
+        conn.execute(f'PRAGMA {name}={value}')
+    conns[path] = conn
+    with _stats_lock:
+        _stats['opened'] += 1
+        _live.add(conn)
+    return conn
+
+
+def pool_stats():
+    with _stats_lock:
+        return {
+            'opened': _stats['opened'],
+            'reused': _stats['reused'],
+            'live': len(_live),
+            'statement_cache': STATEMENT_CACHE,
+        }
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(current_app.config['DATABASE'])
-        g.db.row_factory = sqlite3.Row
+        g.db = connect(current_app.config['DATABASE'], current_app.config.get('SQLITE_PRAGMAS'))
     return g.db
 
 def close_db(e=None):
     db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    if db is not None and db.in_transaction:
+        # the connection stays with the thread; just make sure no write lock outlives the request
+        db.rollback()
 
 def init_db():
     db = get_db()
@@ -59,23 +122,122 @@ def init_app(app):
 
     @app.cli.command('migrate-db')
     def migrate_db_command():
-        init_db()
         db = get_db()
+        had_fts = db.execute("SELECT 1 FROM sqlite_master WHERE name='crawl_items_fts'").fetchone()
         def has_column(table, name):
             rows = db.execute(f"PRAGMA table_info({table})").fetchall()
             for r in rows:
                 if r['name'] == name:
                     return True
             return False
+        had_blobs = has_column('crawl_items', 'content_hash')
+        if not had_blobs:
+            # the FTS triggers now read deep_content from content_blobs; init_db recreates them
+            for name in ('crawl_items_fts_ai', 'crawl_items_fts_ad', 'crawl_items_fts_au'):
+                db.execute(f'DROP TRIGGER IF EXISTS {name}')
+        if has_column('crawl_items', 'id'):
+            # schema.sql indexes dup_of and sentiment_flag, so the columns must exist before init_db runs it
+            if not has_column('crawl_items', 'simhash'):
+                db.execute("ALTER TABLE crawl_items ADD COLUMN simhash INTEGER")
+            if not has_column('crawl_items', 'dup_of'):
+                db.execute("ALTER TABLE crawl_items ADD COLUMN dup_of INTEGER")
+            for name, kind in (('sentiment_score', 'REAL'), ('risk_score', 'REAL'), ('sentiment_terms', 'TEXT'), ('sentiment_flag', 'INTEGER'), ('scored_at', 'TEXT')):
+                if not has_column('crawl_items', name):
+                    db.execute(f"ALTER TABLE crawl_items ADD COLUMN {name} {kind}")
+        init_db()
+        if not had_blobs:
+            # moving bodies updates content_hash, which would make the update trigger delete tokens the
+            # index never held; it is recreated after the move and the index rebuilt below
+            db.execute('DROP TRIGGER IF EXISTS crawl_items_fts_au')
         if not has_column('crawl_items', 'deep_crawled'):
             db.execute("ALTER TABLE crawl_items ADD COLUMN deep_crawled INTEGER DEFAULT 0")
         if not has_column('crawl_items', 'deep_content'):
             db.execute("ALTER TABLE crawl_items ADD COLUMN deep_content TEXT")
         if not has_column('crawl_items', 'detail_json'):
             db.execute("ALTER TABLE crawl_items ADD COLUMN detail_json TEXT")
+        if not has_column('crawl_items', 'content_hash'):
+            db.execute("ALTER TABLE crawl_items ADD COLUMN content_hash TEXT")
+        if not has_column('crawl_items', 'analyzed_at'):
+            db.execute("ALTER TABLE crawl_items ADD COLUMN analyzed_at TEXT")
+        if not has_column('ai_assistants', 'cache_responses'):
+            db.execute("ALTER TABLE ai_assistants ADD COLUMN cache_responses INTEGER DEFAULT 1")
+        if not has_column('ai_messages', 'token_count'):
+            # filled lazily by context.with_token_counts the first time a row is read
+            db.execute("ALTER TABLE ai_messages ADD COLUMN token_count INTEGER")
+        # (assistant_id, id) covers everything the single-column index did
+        db.execute('DROP INDEX IF EXISTS idx_ai_messages_asst')
+        db.commit()
+        from .blobs import migrate_content_blobs, gc_blobs
+        moved = migrate_content_blobs(db)
+        if moved:
+            click.echo(f'moved {moved} article bodies into content_blobs')
+        if not had_blobs:
+            init_db()
+        gc_blobs(db)
+        # rebuilt before removing duplicates so their delete triggers find the tokens they remove
+        if not had_fts or not had_blobs or moved:
+            from .search import rebuild_index
+            rebuild_index(db)
+        from .ingest import migrate_unique_urls
+        removed = migrate_unique_urls(db)
+        if removed:
+            click.echo(f'removed {removed} duplicate crawl_items')
+        from .dedupe import fingerprint_existing
+        fingerprinted = fingerprint_existing(db)
+        if fingerprinted:
+            click.echo(f'fingerprinted {fingerprinted} crawl_items')
+        # maintained counts are reseeded from COUNT(1) on next read
+        db.execute('DELETE FROM table_counts')
         db.commit()
         click.echo('migrated')
 
+    @app.cli.command('archive-items')
+    @click.option('--days', type=int, default=None, help='archive rows older than this many days (CRAWL_ARCHIVE_AFTER_DAYS)')
+    @click.option('--before', default=None, help='archive rows created before this ISO date instead')
+    @click.option('--retention-months', type=int, default=None, help='delete partitions older than this many months (CRAWL_RETENTION_MONTHS)')
+    @click.option('--no-vacuum', is_flag=True, default=False)
+    def archive_items_command(days, before, retention_months, no_vacuum):
+        import datetime
+        from .archive import archive_before, apply_retention, ARCHIVE_AFTER_DAYS, RETENTION_MONTHS, ARCHIVE_VACUUM
+        if not before:
+            before = (datetime.date.today() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS if days is None else days)).isoformat()
+        result = archive_before(get_db(), before, vacuum=ARCHIVE_VACUUM and not no_vacuum)
+        for month, n in result['moved'].items():
+            click.echo(f'{month}: archived {n} crawl_items')
+        removed = apply_retention(RETENTION_MONTHS if retention_months is None else retention_months)
+        if removed:
+            click.echo('removed partitions: ' + ', '.join(removed))
+        click.echo('archived')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        from .search import rebuild_index
+        rebuild_index(get_db())
+        click.echo('search index rebuilt')
+
+    @app.cli.command('index-vectors')
+    @click.option('--rebuild', is_flag=True, default=False, help='drop the vector index and embed every item again')
+    @click.option('--ivf', is_flag=True, default=False, help='(re)build the IVF lists afterwards')
+    @click.option('--nlist', type=int, default=None, help='IVF list count (default 4*sqrt(items))')
+    def index_vectors_command(rebuild, ivf, nlist):
+        from .vectors import index_items, get_store
+        added = index_items(get_db(), rebuild=rebuild, progress=lambda n: click.echo(f'embedded {n}') if n % 1000 < 32 else None)
+        click.echo(f'added {added} vectors, {get_store().count} indexed')
+        if ivf:
+            click.echo(f'ivf built with {get_store().build_ivf(nlist)} lists')
+
+    @app.cli.command('score-items')
+    @click.option('--rescore', is_flag=True, default=False, help='score every item again, e.g. after editing the lexicon')
+    def score_items_command(rescore):
+        from .sentiment import score_items
+        state = {}
+        def report(done, flagged):
+            state['flagged'] = flagged
+            if done % 20000 < 2000:
+                click.echo(f'scored {done}')
+        done = score_items(get_db(), rescore=rescore, progress=report)
+        click.echo(f"scored {done} items, {state.get('flagged', 0)} flagged")
+
     @app.cli.command('add-ai-engine')
     @click.option('--provider', required=True)
     @click.option('--api-url', required=True)
@@ -0,0 +1,130 @@
+import os
+import hashlib
+from collections import Counter
+import numpy as np
+from .search import cjk_bigrams
+
+# syndicated copies of one story are caught by a 64-bit SimHash of the article's search tokens. The hash
+# is split into BANDS 16-bit bands indexed in item_simhash; two hashes at most MAX_DISTANCE < BANDS bits
+# apart share a band, so candidates come from an index lookup and are confirmed by Hamming distance.
+# DEDUPE_MODE cluster keeps the copy, with its own body, and points dup_of at the first article; skip
+# drops it at ingestion; off disables the check.
+DEDUPE_MODE = os.environ.get('DEDUPE_MODE', 'cluster')
+BANDS = 4
+BAND_BITS = 16
+MAX_DISTANCE = min(int(os.environ.get('DEDUPE_MAX_DISTANCE', '3')), BANDS - 1)
+# the body is fingerprinted when there is enough of it, since portals often rewrite the headline
+MIN_BODY_CHARS = 200
+# shorter texts give unreliable fingerprints and are never treated as duplicates
+MIN_TOKENS = 8
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def _signed(h):
+    # SQLite integers are signed 64-bit
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def simhash(text):
+    weights = Counter(cjk_bigrams(text).split())
+    if sum(weights.values()) < MIN_TOKENS:
+        return None
+    digests = b''.join(hashlib.blake2b(t.encode('utf-8'), digest_size=8).digest() for t in weights)
+    # one row of 64 bits per token, most significant first, so column 0 is bit 63
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1)
+    w = np.fromiter(weights.values(), dtype=np.int64, count=len(weights))
+    votes = w @ (2 * bits.astype(np.int64) - 1)
+    return _signed(int.from_bytes(np.packbits(votes > 0).tobytes(), 'big'))
+
+
+def fingerprint(title, summary, body):
+    if body and len(body) >= MIN_BODY_CHARS:
+        return simhash(body)
+    return simhash((title or '') + '\n' + (summary or ''))
+
+
+def distance(a, b):
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+def band_keys(h):
+    # must match the expressions in the crawl_items_dup_ad trigger
+    return [(i << BAND_BITS) | ((h >> (BAND_BITS * i)) & BAND_MASK) for i in range(BANDS)]
+
+
+def find_duplicate(db, h):
+    # id of the closest indexed article within MAX_DISTANCE bits, or None
+    keys = band_keys(h)
+    rows = db.execute(
+        f"SELECT DISTINCT c.id, c.simhash FROM item_simhash s JOIN crawl_items c ON c.id = s.item_id "
+        f"WHERE s.band IN ({','.join('?' * len(keys))})", keys
+    ).fetchall()
+    best = None
+    for r in rows:
+        d = distance(h, r['simhash'])
+        if d <= MAX_DISTANCE and (best is None or (d, r['id']) < best[0]):
+            best = ((d, r['id']), r)
+    return best[1]['id'] if best else None
+
+
+def index_fingerprint(db, item_id, h):
+    db.executemany('INSERT OR IGNORE INTO item_simhash(band, item_id) VALUES(?,?)', [(k, item_id) for k in band_keys(h)])
+
+
+def update_fingerprint(db, item_id, old_h, dup_of, h):
+    # a stored row whose text changed: a first article is re-indexed, or joins a cluster if nothing copies it
+    if dup_of is None:
+        if old_h:
+            db.executemany('DELETE FROM item_simhash WHERE band=? AND item_id=?', [(k, item_id) for k in band_keys(old_h)])
+        if h is not None:
+            copied = db.execute('SELECT 1 FROM crawl_items WHERE dup_of=? LIMIT 1', (item_id,)).fetchone()
+            dup_of = None if copied else find_duplicate(db, h)
+            if dup_of is None:
+                index_fingerprint(db, item_id, h)
+    db.execute('UPDATE crawl_items SET simhash=?, dup_of=? WHERE id=?', (0 if h is None else h, dup_of, item_id))
+
+
+class BatchIndex:
+    # fingerprints of rows earlier in the same ingest batch, which are not in item_simhash yet
+
+    def __init__(self):
+        self._bands = {}
+
+    def add(self, h, url):
+        for k in band_keys(h):
+            self._bands.setdefault(k, []).append((h, url))
+
+    def find(self, h):
+        # url of the closest earlier row, or None
+        best = None
+        for k in band_keys(h):
+            for other, url in self._bands.get(k, ()):
+                d = distance(h, other)
+                if d <= MAX_DISTANCE and (best is None or d < best[0]):
+                    best = (d, url)
+        return best[1] if best else None
+
+
+def fingerprint_existing(db, chunk=500):
+    # fills simhash for rows stored before fingerprints existed, clustering them in id order
+    done = 0
+    while True:
+        rows = db.execute(
+            'SELECT c.id, c.title, c.summary, b.data FROM crawl_items c LEFT JOIN content_blobs b ON b.hash = c.content_hash '
+            'WHERE c.simhash IS NULL AND c.dup_of IS NULL ORDER BY c.id LIMIT ?', (chunk,)
+        ).fetchall()
+        if not rows:
+            return done
+        from .blobs import inflate
+        for r in rows:
+            h = fingerprint(r['title'], r['summary'], inflate(r['data']) if r['data'] else '')
+            if h is None:
+                # 0 marks "looked at, too short"; it is never indexed
+                db.execute('UPDATE crawl_items SET simhash=0 WHERE id=?', (r['id'],))
+                continue
+            match = find_duplicate(db, h)
+            db.execute('UPDATE crawl_items SET simhash=?, dup_of=? WHERE id=?', (h, match, r['id']))
+            if not match:
+                index_fingerprint(db, r['id'], h)
+        db.commit()
+        done += len(rows)
@@ -0,0 +1,165 @@
+import json
+import time
+import threading
+from urllib.parse import urlsplit
+
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:
+    etree = None
+    lxml_html = None
+
+RULES_TTL = 60
+CONTENT_LIMIT = 10000
+
+_rules = None
+_rules_loaded = 0.0
+_rules_lock = threading.Lock()
+# compiled XPath objects must not be shared between threads, so the cache is per thread
+_local = threading.local()
+
+
+class Rule:
+    def __init__(self, row):
+        self.id = row['id']
+        self.site = row['site']
+        self.domain = _normalize_domain(row['domain'] or row['site'] or '')
+        self.title_xpath = (row['title_xpath'] or '').strip()
+        self.content_xpath = (row['content_xpath'] or '').strip()
+        self.headers = _parse_headers(row['headers'])
+
+    def matches(self, host):
+        return bool(self.domain) and (host == self.domain or host.endswith('.' + self.domain))
+
+
+class RuleSet:
+    def __init__(self, rules):
+        # longest domain first so sub-site rules win over their parent domain
+        self.rules = sorted(rules, key=lambda r: len(r.domain), reverse=True)
+
+    def match(self, url):
+        host = (urlsplit(url).hostname or '').lower()
+        if not host:
+            return None
+        for rule in self.rules:
+            if rule.matches(host):
+                return rule
+        return None
+
+
+def _normalize_domain(value):
+    value = (value or '').strip().lower()
+    if '//' in value:
+        value = urlsplit(value).hostname or ''
+    value = value.split('/')[0].split(':')[0]
+    if value.startswith('www.'):
+        value = value[4:]
+    return value.strip('.')
+
+
+def _parse_headers(raw):
+    raw = (raw or '').strip()
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+        if isinstance(data, dict):
+            return {str(k): str(v) for k, v in data.items()}
+    except Exception:
+        pass
+    headers = {}
+    for line in raw.splitlines():
+        if ':' in line:
+            k, v = line.split(':', 1)
+            if k.strip():
+                headers[k.strip()] = v.strip()
+    return headers
+
+
+def load_rules(db):
+    global _rules, _rules_loaded
+    now = time.monotonic()
+    rules = _rules
+    if rules is not None and now - _rules_loaded < RULES_TTL:
+        return rules
+    with _rules_lock:
+        if _rules is not None and now - _rules_loaded < RULES_TTL:
+            return _rules
+        rows = db.execute('SELECT id,site,domain,title_xpath,content_xpath,headers FROM crawl_rules').fetchall()
+        _rules = RuleSet([Rule(r) for r in rows])
+        _rules_loaded = now
+        return _rules
+
+
+def invalidate():
+    global _rules
+    with _rules_lock:
+        _rules = None
+
+
+def compiled_xpath(expr):
+    cache = getattr(_local, 'xpaths', None)
+    if cache is None:
+        cache = _local.xpaths = {}
+    xp = cache.get(expr)
+    if xp is None:
+        if len(cache) > 256:
+            cache.clear()
+        xp = cache[expr] = etree.XPath(expr)
+    return xp
+
+
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'section', 'article', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'table', 'ul', 'ol'}
+SKIP_TAGS = {'script', 'style', 'noscript'}
+
+
+def _walk(el, out):
+    tag = el.tag if isinstance(el.tag, str) else ''
+    if tag in SKIP_TAGS or not tag:
+        return
+    block = tag in BLOCK_TAGS
+    if block:
+        out.append('\n')
+    if el.text:
+        out.append(el.text)
+    for child in el:
+        _walk(child, out)
+        if child.tail:
+            out.append(child.tail)
+    if block:
+        out.append('\n')
+
+
+def node_text(node):
+    out = []
+    _walk(node, out)
+    lines = (' '.join(line.split()) for line in ''.join(out).split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+
+def _xpath_text(tree, expr, sep):
+    parts = []
+    for node in compiled_xpath(expr)(tree):
+        if isinstance(node, str):
+            text = node.strip()
+        else:
+            text = node_text(node)
+            if sep != '\n':
+                text = sep.join(text.split('\n'))
+        if text:
+            parts.append(text)
+    return sep.join(parts)
+
+
+def extract_with_rule(content, rule, limit=CONTENT_LIMIT):
+    if lxml_html is None or rule is None or not rule.content_xpath:
+        return None
+    try:
+        tree = lxml_html.fromstring(content)
+        text = _xpath_text(tree, rule.content_xpath, '\n')
+        title = _xpath_text(tree, rule.title_xpath, ' ') if rule.title_xpath else ''
+    except Exception:
+        return None
+    if not text:
+        return None
+    return {'title': title, 'content': text[:limit], 'rule_id': rule.id}
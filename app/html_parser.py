@@ -0,0 +1,32 @@
+import os
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve
+
+try:
+    import lxml  # noqa: F401
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+# "lxml" is C-backed and several times faster than the pure-Python "html.parser"
+BACKENDS = ("lxml", "html.parser", "html5lib")
+BACKEND = os.environ.get("CRAWLER_HTML_PARSER") or ("lxml" if HAS_LXML else "html.parser")
+
+# portal homepages only ever look at these containers, so skip head/script/style entirely
+PORTAL_TAGS = SoupStrainer(["li", "article", "div"])
+
+
+def make_soup(markup, parse_only=None, backend: str = None):
+    backend = backend or BACKEND
+    if backend not in BACKENDS:
+        raise ValueError("unknown html parser backend: " + backend)
+    return BeautifulSoup(markup, backend, parse_only=parse_only)
+
+
+def compile_selector(css: str):
+    return soupsieve.compile(css)
+
+
+def class_contains(tag: str, *parts):
+    # CSS equivalent of find_all(tag, class_=lambda c: c and any(p in c for p in parts))
+    return compile_selector(", ".join('%s[class*="%s"]' % (tag, p) for p in parts))
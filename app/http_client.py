@@ -0,0 +1,102 @@
+import os
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# every outbound fetch goes through here so connections to the same host are reused
+CONFIG = {
+    "pool_connections": int(os.environ.get("CRAWLER_POOL_CONNECTIONS", "4")),
+    "pool_maxsize": int(os.environ.get("CRAWLER_POOL_MAXSIZE", "16")),
+    "retries": int(os.environ.get("CRAWLER_RETRIES", "2")),
+    "backoff": float(os.environ.get("CRAWLER_BACKOFF", "0.3")),
+    "timeout": float(os.environ.get("CRAWLER_TIMEOUT", "10")),
+}
+
+DEFAULT_HEADERS = {
+    "accept-language": "zh-CN,zh;q=0.9",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+}
+
+_sessions = {}
+_lock = threading.Lock()
+# optional requests adapter that replaces the network, e.g. for offline fixture replay
+_transport = None
+
+
+def _host_key(url: str):
+    parts = urlsplit(url)
+    return (parts.scheme or "http").lower() + "://" + (parts.netloc or "").lower()
+
+
+def _build_session(retries=None):
+    session = requests.Session()
+    retries = CONFIG["retries"] if retries is None else retries
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        backoff_factor=CONFIG["backoff"],
+        status_forcelist=(429, 502, 503, 504),
+        raise_on_status=False
+    )
+    adapter = _transport or HTTPAdapter(pool_connections=CONFIG["pool_connections"], pool_maxsize=CONFIG["pool_maxsize"], max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    return session
+
+
+def get_session(url: str, retries=None):
+    # callers that fail over themselves (the engine router) pass retries=0 and get their own keep-alive pool
+    key = _host_key(url) if retries is None else _host_key(url) + "#retries=" + str(retries)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _build_session(retries)
+                _sessions[key] = session
+    return session
+
+
+def configure(**options):
+    unknown = set(options) - set(CONFIG)
+    if unknown:
+        raise ValueError("unknown http_client option: " + ", ".join(sorted(unknown)))
+    with _lock:
+        CONFIG.update(options)
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for s in sessions:
+        s.close()
+
+
+def set_transport(adapter):
+    global _transport
+    with _lock:
+        _transport = adapter
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for s in sessions:
+        s.close()
+
+
+def request(method: str, url: str, retries=None, **kwargs):
+    kwargs.setdefault("timeout", CONFIG["timeout"])
+    return get_session(url, retries).request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def stats():
+    with _lock:
+        hosts = sorted(_sessions)
+    return {"hosts": hosts, "sessions": len(hosts), "config": dict(CONFIG)}
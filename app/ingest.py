@@ -0,0 +1,217 @@
+import json
+import datetime
+from .blobs import content_hash, put_blobs
+from . import dedupe
+from urllib.parse import urlsplit, urlunsplit
+
+CHUNK = 500
+INSERT_COLUMNS = 'keyword,title,summary,cover,original_url,source,deep_crawled,content_hash,detail_json,created_at,simhash,dup_of'
+
+# a shallow row is upgraded in place when the same article arrives again with deep content
+UPSERT_SQL = (
+    f'INSERT INTO crawl_items({INSERT_COLUMNS}) VALUES(?,?,?,?,?,?,?,?,?,?,?,?) '
+    'ON CONFLICT(original_url) DO UPDATE SET deep_crawled=1, content_hash=excluded.content_hash, detail_json=excluded.detail_json, scored_at=NULL '
+    'WHERE crawl_items.deep_crawled=0 AND excluded.deep_crawled=1'
+)
+INSERT_SQL = f'INSERT INTO crawl_items({INSERT_COLUMNS}) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)'
+UPDATE_SQL = 'UPDATE crawl_items SET deep_crawled=1, content_hash=?, detail_json=?, scored_at=NULL WHERE original_url=? AND deep_crawled=0'
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    url = (url or '').strip()
+    if not url:
+        return ''
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    if not parts.scheme or not parts.netloc:
+        return url.split('#', 1)[0]
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host
+    if port and DEFAULT_PORTS.get(scheme) != port:
+        netloc = f'{host}:{port}'
+    if parts.username:
+        netloc = parts.username + (':' + parts.password if parts.password else '') + '@' + netloc
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def has_unique_url_index(db):
+    for idx in db.execute('PRAGMA index_list(crawl_items)').fetchall():
+        if not idx['unique']:
+            continue
+        cols = db.execute(f"PRAGMA index_info({idx['name']})").fetchall()
+        if len(cols) == 1 and cols[0]['name'] == 'original_url':
+            return True
+    return False
+
+
+def existing_urls(db, urls):
+    found = {}
+    urls = list(urls)
+    for i in range(0, len(urls), CHUNK):
+        chunk = urls[i:i+CHUNK]
+        marks = ','.join('?' * len(chunk))
+        for r in db.execute(f'SELECT original_url, deep_crawled FROM crawl_items WHERE original_url IN ({marks})', chunk).fetchall():
+            found[r['original_url']] = bool(r['deep_crawled'])
+    return found
+
+
+def _row(it, url, now):
+    content = it.get('deep_content') or ''
+    h = content_hash(content) if content else None
+    detail = it.get('detail_json') or '{}'
+    if not isinstance(detail, str):
+        detail = json.dumps(detail, ensure_ascii=False)
+    return (
+        it.get('keyword',''),
+        it.get('title',''),
+        it.get('summary',''),
+        it.get('cover',''),
+        url,
+        it.get('source',''),
+        1 if it.get('deep_crawled') else 0,
+        h,
+        detail,
+        now,
+        None,
+        None
+    ), content
+
+
+def _near_duplicates(db, inserts, texts, counts):
+    # fills simhash/dup_of on new rows; returns (rows to insert, {url: url of the batch row it copies})
+    kept = []
+    pending = {}
+    batch = dedupe.BatchIndex()
+    for row in inserts:
+        h = dedupe.fingerprint(row[1], row[2], texts.get(row[7]) or '')
+        if h is None:
+            # 0 marks a row too short to fingerprint
+            kept.append(row[:10] + (0, None))
+            continue
+        match = dedupe.find_duplicate(db, h)
+        in_batch = None if match else batch.find(h)
+        if match or in_batch:
+            counts['near_duplicates'] += 1
+            if dedupe.DEDUPE_MODE == 'skip':
+                continue
+            # the copy is stored whole (portals add bylines and editor notes); dup_of only clusters it
+            kept.append(row[:10] + (h, match))
+            if in_batch:
+                pending[row[4]] = in_batch
+            continue
+        batch.add(h, row[4])
+        kept.append(row[:10] + (h, None))
+    return kept, pending
+
+
+def _refingerprint(db, upgrades, texts):
+    # a shallow row that gains its body is fingerprinted again from the body
+    for row in upgrades:
+        old = db.execute('SELECT id, simhash, dup_of FROM crawl_items WHERE original_url=?', (row[4],)).fetchone()
+        h = dedupe.fingerprint(row[1], row[2], texts.get(row[7]) or '')
+        if old and (h or 0) != (old['simhash'] or 0):
+            dedupe.update_fingerprint(db, old['id'], old['simhash'], old['dup_of'], h)
+
+
+def _index_fingerprints(db, rows, pending):
+    # new originals go into item_simhash; copies of a row from the same batch get its id now it has one
+    urls = [r[4] for r in rows if r[10] and r[11] is None and r[4] not in pending] + list(pending.values())
+    ids = {}
+    for i in range(0, len(urls), CHUNK):
+        chunk = urls[i:i+CHUNK]
+        for r in db.execute(f"SELECT id, original_url FROM crawl_items WHERE original_url IN ({','.join('?' * len(chunk))})", chunk).fetchall():
+            ids[r['original_url']] = r['id']
+    for r in rows:
+        if r[10] and r[11] is None and r[4] not in pending and r[4] in ids:
+            dedupe.index_fingerprint(db, ids[r[4]], r[10])
+    db.executemany('UPDATE crawl_items SET dup_of=? WHERE original_url=?', [(ids.get(canonical), url) for url, canonical in pending.items()])
+
+
+def ingest_items(db, items, now=None):
+    # writes a whole batch in one transaction: one lookup pass plus one executemany
+    now = now or datetime.datetime.now().isoformat()
+    counts = {'inserted': 0, 'duplicates': 0, 'updated': 0, 'skipped': 0, 'near_duplicates': 0}
+    batch = {}
+    texts = {}
+    for it in items:
+        if not isinstance(it, dict):
+            counts['skipped'] += 1
+            continue
+        url = normalize_url(it.get('original_url'))
+        if not url:
+            counts['skipped'] += 1
+            continue
+        if url in batch:
+            counts['duplicates'] += 1
+            continue
+        batch[url], content = _row(it, url, now)
+        if content:
+            texts[batch[url][7]] = content
+    if not batch:
+        return counts
+    existing = existing_urls(db, batch)
+    inserts = []
+    upgrades = []
+    for url, row in batch.items():
+        if url not in existing:
+            inserts.append(row)
+        elif not existing[url] and row[6]:
+            upgrades.append(row)
+        else:
+            counts['duplicates'] += 1
+    pending = {}
+    if dedupe.DEDUPE_MODE != 'off':
+        inserts, pending = _near_duplicates(db, inserts, texts, counts)
+    try:
+        # bodies go in first: the FTS insert trigger reads them back through content_hash
+        put_blobs(db, {r[7]: texts[r[7]] for r in inserts + upgrades if r[7]})
+        if has_unique_url_index(db):
+            db.executemany(UPSERT_SQL, inserts + upgrades)
+        else:
+            # databases that have not run migrate-db yet lack the unique index ON CONFLICT needs
+            db.executemany(INSERT_SQL, inserts)
+            db.executemany(UPDATE_SQL, [(r[7], r[8], r[4]) for r in upgrades])
+        if dedupe.DEDUPE_MODE != 'off':
+            _index_fingerprints(db, inserts, pending)
+            _refingerprint(db, upgrades, texts)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    counts['inserted'] = len(inserts)
+    counts['updated'] = len(upgrades)
+    return counts
+
+
+def migrate_unique_urls(db):
+    # normalizes stored URLs, drops duplicate rows (keeping the deep-crawled/oldest one) and makes the index unique
+    rows = db.execute('SELECT id, original_url, deep_crawled FROM crawl_items ORDER BY deep_crawled DESC, id ASC').fetchall()
+    keep = {}
+    doomed = []
+    renames = []
+    for r in rows:
+        url = normalize_url(r['original_url'])
+        if not url:
+            continue
+        if url in keep:
+            doomed.append((r['id'],))
+            continue
+        keep[url] = r['id']
+        if url != r['original_url']:
+            renames.append((url, r['id']))
+    db.executemany('DELETE FROM crawl_items WHERE id=?', doomed)
+    db.executemany('UPDATE crawl_items SET original_url=? WHERE id=?', renames)
+    if not has_unique_url_index(db):
+        db.execute('DROP INDEX IF EXISTS idx_crawl_items_url')
+        db.execute('CREATE UNIQUE INDEX idx_crawl_items_url ON crawl_items(original_url)')
+    db.commit()
+    return len(doomed)
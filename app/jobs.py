@@ -0,0 +1,255 @@
+import os
+import json
+import socket
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from .db import get_db
+
+JOB_WORKERS = int(os.environ.get('CRAWL_JOB_WORKERS', '2'))
+# a running job whose heartbeat is older than this is assumed to belong to a dead worker
+JOB_STALE_SECONDS = int(os.environ.get('CRAWL_JOB_STALE', '300'))
+
+SOURCES = ('baidu', 'sina', 'sohu', 'xinhua')
+JOB_FIELDS = 'id,kind,keyword,source,num,status,pages_fetched,items_found,items_saved,errors,error_text,cancel_requested,created_by,worker,created_at,started_at,finished_at,heartbeat_at'
+
+_pool = None
+_pool_lock = threading.Lock()
+_worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+def page_fetcher(source, kw):
+    from .crawler import crawl_baidu_news, crawl_sina_news, crawl_sohu_news, crawl_xinhua_multi
+    if source == 'baidu':
+        return lambda cursor: crawl_baidu_news(kw, pn=cursor)
+    if source == 'sina':
+        return lambda cursor: crawl_sina_news(kw, page=(cursor//10)+1, size=10)
+    if source == 'sohu':
+        return lambda cursor: crawl_sohu_news(kw, offset=cursor, limit=10)
+    if source == 'xinhua':
+        return lambda cursor: crawl_xinhua_multi(kw, offset=cursor, limit=10)
+    return None
+
+
+def crawl_auto(db, kw, num, source, progress=None, should_cancel=None):
+    from .crawler import deep_crawl_batch
+    from .extractor import load_rules
+    from .ingest import ingest_items, existing_urls, normalize_url
+    fetch = page_fetcher(source, kw)
+    if fetch is None:
+        raise ValueError('Unknown source')
+    stats = {'pages_fetched': 0, 'items_found': 0, 'items_saved': 0, 'errors': 0}
+    def report():
+        if progress:
+            progress(stats)
+    def cancelled():
+        return bool(should_cancel and should_cancel())
+    aggregated = []
+    seen = set()
+    cursor = 0
+    step = 10
+    limit = 200
+    while len(aggregated) < num and cursor <= limit and not cancelled():
+        try:
+            page = fetch(cursor)
+        except Exception:
+            stats['errors'] += 1
+            page = []
+        stats['pages_fetched'] += 1
+        if not page:
+            report()
+            break
+        for it in page:
+            url = (it.get('original_url') or '').strip()
+            if not url or url in seen or not it.get('cover') or not it.get('title'):
+                continue
+            seen.add(url)
+            it['keyword'] = kw
+            aggregated.append(it)
+            if len(aggregated) >= num:
+                break
+        stats['items_found'] = len(aggregated)
+        report()
+        cursor += step
+    candidates = {}
+    for it in aggregated:
+        url = normalize_url(it.get('original_url'))
+        if not url or not it.get('cover') or not it.get('title'):
+            continue
+        candidates.setdefault(url, it)
+    known = existing_urls(db, candidates)
+    pending = [(url, it) for url, it in candidates.items() if url not in known]
+    # deep crawl runs as one bounded concurrent stage; unfinished pages are saved with deep_crawled=0
+    contents = {}
+    if pending and not cancelled():
+        contents = deep_crawl_batch([url for url, _ in pending], should_stop=should_cancel, rules=load_rules(db))
+    rows = []
+    for url, it in pending:
+        content = contents.get(url) or ''
+        if url in contents and not content:
+            stats['errors'] += 1
+        rows.append(dict(it, original_url=url, deep_crawled=bool(content), deep_content=content,
+                         detail_json=json.dumps({'content_length': len(content)}, ensure_ascii=False)))
+    counts = ingest_items(db, rows)
+    stats['items_saved'] = counts['inserted'] + counts['updated']
+    report()
+    return stats, [r['original_url'] for r in rows]
+
+
+def _executor(app):
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='crawljob')
+                _resume_orphans(app)
+    return _pool
+
+
+def init_app(app):
+    # the pool starts with the first request rather than the first submission, so queued and orphaned
+    # jobs resume right after a restart; create_app itself may run before init-db has made the tables
+    @app.before_request
+    def start_job_pool():
+        if _pool is None:
+            _executor(app)
+
+
+def _resume_orphans(app):
+    # requeue jobs from workers that died mid-run and pick up anything still queued
+    db = get_db()
+    stale = (datetime.datetime.now() - datetime.timedelta(seconds=JOB_STALE_SECONDS)).isoformat()
+    db.execute("UPDATE crawl_jobs SET status='queued', worker=NULL WHERE status='running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)", (stale,))
+    db.commit()
+    rows = db.execute("SELECT id FROM crawl_jobs WHERE status='queued' ORDER BY id").fetchall()
+    for r in rows:
+        _pool.submit(_run_job, app, r['id'])
+
+
+def submit_crawl_job(kw, num, source, user_id=None):
+    if source not in SOURCES:
+        raise ValueError('Unknown source')
+    params = {'keyword': kw, 'num': num, 'source': source}
+    return _enqueue('crawl_auto', kw, source, num, params, user_id, _now())
+
+
+def _enqueue(kind, keyword, source, num, params, user_id, created_at):
+    db = get_db()
+    cur = db.execute(
+        "INSERT INTO crawl_jobs(kind,keyword,source,num,params_json,status,created_by,created_at) VALUES(?,?,?,?,?,'queued',?,?)",
+        (kind, keyword, source, num, json.dumps(params, ensure_ascii=False), user_id, created_at)
+    )
+    db.commit()
+    job_id = cur.lastrowid
+    app = current_app._get_current_object()
+    _executor(app).submit(_run_job, app, job_id)
+    return job_id
+
+
+def submit_analyze_job(engine_id=None, ids=None, limit=100, force=False, user_id=None, flagged=False):
+    params = {'engine_id': engine_id, 'ids': ids or [], 'limit': limit, 'force': bool(force), 'flagged': bool(flagged), 'submitted_at': _now()}
+    return _enqueue('analyze', '', 'ai', limit, params, user_id, params['submitted_at'])
+
+
+def submit_score_job(rescore=False, user_id=None):
+    params = {'rescore': bool(rescore)}
+    return _enqueue('score', '', 'lexicon', 0, params, user_id, _now())
+
+
+def submit_report_job(keyword='', date_from='', date_to='', engine_id=None, limit=None, user_id=None):
+    from .reports import REPORT_MAX_ITEMS
+    limit = limit or REPORT_MAX_ITEMS
+    params = {'keyword': keyword, 'date_from': date_from, 'date_to': date_to, 'engine_id': engine_id, 'limit': limit}
+    return _enqueue('report', keyword, 'report', limit, params, user_id, _now())
+
+
+def cancel_job(job_id):
+    db = get_db()
+    now = _now()
+    db.execute("UPDATE crawl_jobs SET status='cancelled', cancel_requested=1, finished_at=? WHERE id=? AND status='queued'", (now, job_id))
+    cur = db.execute("UPDATE crawl_jobs SET cancel_requested=1 WHERE id=? AND status='running'", (job_id,))
+    db.commit()
+    return cur.rowcount
+
+
+def get_job(job_id):
+    return get_db().execute(f'SELECT {JOB_FIELDS},params_json,result_json FROM crawl_jobs WHERE id=?', (job_id,)).fetchone()
+
+
+def list_jobs(limit=20):
+    return get_db().execute(f'SELECT {JOB_FIELDS} FROM crawl_jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+
+
+def job_to_dict(r):
+    return {
+        'id': r['id'],
+        'kind': r['kind'],
+        'keyword': r['keyword'],
+        'source': r['source'],
+        'num': r['num'],
+        'status': r['status'],
+        'pages_fetched': r['pages_fetched'] or 0,
+        'items_found': r['items_found'] or 0,
+        'items_saved': r['items_saved'] or 0,
+        'errors': r['errors'] or 0,
+        'error_text': r['error_text'] or '',
+        'cancel_requested': bool(r['cancel_requested']),
+        'created_at': r['created_at'] or '',
+        'started_at': r['started_at'] or '',
+        'finished_at': r['finished_at'] or ''
+    }
+
+
+def _run_job(app, job_id):
+    with app.app_context():
+        db = get_db()
+        now = _now()
+        cur = db.execute("UPDATE crawl_jobs SET status='running', worker=?, started_at=?, heartbeat_at=? WHERE id=? AND status='queued'", (_worker_id, now, now, job_id))
+        db.commit()
+        if not cur.rowcount:
+            return
+        job = db.execute('SELECT kind, params_json FROM crawl_jobs WHERE id=?', (job_id,)).fetchone()
+        params = json.loads(job['params_json'] or '{}')
+        def progress(stats):
+            db.execute(
+                'UPDATE crawl_jobs SET pages_fetched=?, items_found=?, items_saved=?, errors=?, heartbeat_at=? WHERE id=?',
+                (stats['pages_fetched'], stats['items_found'], stats['items_saved'], stats['errors'], _now(), job_id)
+            )
+            db.commit()
+        def should_cancel():
+            row = db.execute('SELECT cancel_requested FROM crawl_jobs WHERE id=?', (job_id,)).fetchone()
+            return bool(row and row['cancel_requested'])
+        try:
+            if job['kind'] == 'analyze':
+                from .analysis import run_analysis
+                stats, result = run_analysis(db, params, progress, should_cancel)
+            elif job['kind'] == 'score':
+                from .sentiment import score_items
+                stats = {'pages_fetched': 0, 'items_found': 0, 'items_saved': 0, 'errors': 0}
+                def scored(done, flagged):
+                    stats['items_found'] = done
+                    stats['items_saved'] = flagged
+                    progress(stats)
+                score_items(db, params.get('rescore'), progress=scored, should_cancel=should_cancel)
+                result = {'flagged': stats['items_saved']}
+            elif job['kind'] == 'report':
+                from .reports import build_report
+                stats, result = build_report(db, params, progress, should_cancel)
+            else:
+                stats, urls = crawl_auto(db, params.get('keyword', ''), int(params.get('num') or 10), params.get('source', 'baidu'), progress, should_cancel)
+                result = {'urls': urls}
+            progress(stats)
+            status = 'cancelled' if should_cancel() else 'done'
+            db.execute(
+                'UPDATE crawl_jobs SET status=?, result_json=?, finished_at=?, heartbeat_at=? WHERE id=?',
+                (status, json.dumps(result, ensure_ascii=False), _now(), _now(), job_id)
+            )
+        except Exception as e:
+            db.rollback()
+            db.execute("UPDATE crawl_jobs SET status='failed', error_text=?, finished_at=? WHERE id=?", (str(e), _now(), job_id))
+        db.commit()
@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import hashlib
+from . import http_client
+from .cache import llm_response_cache
+
+# OpenAI-compatible /chat/completions calls shared by the assistant chat and analysis endpoints
+CHAT_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', '15'))
+# streaming waits at most this long between two chunks, not for the whole answer
+STREAM_CONNECT_TIMEOUT = float(os.environ.get('LLM_STREAM_CONNECT_TIMEOUT', '10'))
+STREAM_READ_TIMEOUT = float(os.environ.get('LLM_STREAM_READ_TIMEOUT', '60'))
+DEFAULT_TEMPERATURE = 0.7
+# rough tokenizer-free estimate: one token per CJK character, about four characters per token otherwise
+CJK_CHAR_RE = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    cjk = len(CJK_CHAR_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_tokens(text, limit):
+    if estimate_tokens(text) <= limit:
+        return text
+    # one token is kept for the ellipsis
+    limit -= 1
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + '…'
+
+
+def estimate_messages(messages):
+    return sum(estimate_tokens(m.get('content') or '') + MESSAGE_OVERHEAD for m in messages)
+
+
+def chat_endpoint(engine):
+    return (engine['api_url'] or '').rstrip('/') + '/chat/completions'
+
+
+def chat_headers(engine):
+    headers = {'Content-Type': 'application/json'}
+    if engine['api_key']:
+        headers['Authorization'] = 'Bearer ' + engine['api_key']
+    return headers
+
+
+def reply_content(data):
+    # a 200 body without choices is a quota, moderation or gateway error, not an answer to cache
+    try:
+        content = data['choices'][0]['message']['content']
+    except (KeyError, IndexError, TypeError):
+        content = None
+    if not isinstance(content, str):
+        raise ValueError('engine returned no reply: ' + json.dumps(data, ensure_ascii=False)[:300])
+    return content
+
+
+def complete(engine, messages, temperature=DEFAULT_TEMPERATURE, timeout=None, retries=None):
+    payload = {
+        'model': engine['model_name'],
+        'messages': messages,
+        'temperature': temperature,
+        'stream': False
+    }
+    resp = http_client.post(chat_endpoint(engine), headers=chat_headers(engine), data=json.dumps(payload), timeout=timeout or CHAT_TIMEOUT, retries=retries)
+    resp.raise_for_status()
+    return reply_content(resp.json())
+
+
+def stream(engine, messages, temperature=DEFAULT_TEMPERATURE, retries=None):
+    # yields content deltas as the engine produces them; closing the generator closes the upstream response
+    payload = {
+        'model': engine['model_name'],
+        'messages': messages,
+        'temperature': temperature,
+        'stream': True
+    }
+    resp = http_client.post(chat_endpoint(engine), headers=chat_headers(engine), data=json.dumps(payload),
+                            timeout=(STREAM_CONNECT_TIMEOUT, STREAM_READ_TIMEOUT), stream=True, retries=retries)
+    try:
+        resp.raise_for_status()
+        if 'text/event-stream' not in (resp.headers.get('Content-Type') or ''):
+            # engines that ignore stream=True answer with one ordinary JSON body
+            yield reply_content(resp.json())
+            return
+        resp.encoding = 'utf-8'
+        # chunk_size=None hands over each network chunk as soon as it arrives
+        for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            body = line[5:].strip()
+            if body == '[DONE]':
+                break
+            try:
+                delta = json.loads(body)['choices'][0].get('delta') or {}
+            except Exception:
+                continue
+            if delta.get('content'):
+                yield delta['content']
+    finally:
+        resp.close()
+
+
+def cache_key(engine, messages, temperature=DEFAULT_TEMPERATURE):
+    # whitespace at the ends of a message and line-ending style do not change the answer
+    normalized = [[(m.get('role') or '').strip().lower(), (m.get('content') or '').replace('\r\n', '\n').strip()] for m in messages]
+    digest = hashlib.sha256(json.dumps(normalized, ensure_ascii=False, separators=(',', ':')).encode('utf-8')).hexdigest()
+    return llm_response_cache.make_key('chat', engine['id'], engine['model_name'], digest, float(temperature))
+
+
+def cached_reply(engine, messages, temperature=DEFAULT_TEMPERATURE):
+    return llm_response_cache.get(cache_key(engine, messages, temperature))
+
+
+def store_reply(engine, messages, reply, temperature=DEFAULT_TEMPERATURE):
+    if reply:
+        llm_response_cache.set(cache_key(engine, messages, temperature), reply)
+
+
+def sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
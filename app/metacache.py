@@ -0,0 +1,117 @@
+import os
+import time
+import sqlite3
+import threading
+
+# settings, roles, engines and assistants change rarely; rows are cached per process and dropped when
+# meta_generation moves. Triggers bump it on every write, so other workers notice within CHECK_INTERVAL.
+CHECK_INTERVAL = float(os.environ.get('METADATA_CHECK_INTERVAL', '2'))
+
+
+class MetadataCache:
+
+    def __init__(self, check_interval: float = CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._data = {}
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _current_generation(self, db):
+        row = db.execute('SELECT gen FROM meta_generation WHERE id=1').fetchone()
+        return row[0] if row else 0
+
+    def _sync(self, db):
+        now = time.monotonic()
+        if self._generation is not None and now - self._checked_at < self.check_interval:
+            return
+        gen = self._current_generation(db)
+        with self._lock:
+            if gen != self._generation:
+                if self._generation is not None:
+                    self.invalidations += 1
+                self._data = {}
+                self._generation = gen
+            self._checked_at = now
+
+    def get(self, db, key, loader):
+        try:
+            self._sync(db)
+        except sqlite3.OperationalError:
+            # database predates migrate-db; read through
+            return loader(db)
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        value = loader(db)
+        with self._lock:
+            self._data[key] = value
+        return value
+
+    def invalidate(self):
+        # the writing process drops its copy at once instead of waiting for the next generation check
+        with self._lock:
+            self._data = {}
+            self._generation = None
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'generation': self._generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': (self.hits / total) if total else 0.0,
+            }
+
+
+metadata = MetadataCache()
+
+
+def _one(sql, params=()):
+    def load(db):
+        row = db.execute(sql, params).fetchone()
+        return dict(row) if row else None
+    return load
+
+
+def get_settings(db):
+    return metadata.get(db, ('settings',), _one('SELECT app_name, logo_path FROM settings LIMIT 1'))
+
+
+def get_role_name(db, role_id):
+    row = metadata.get(db, ('role', role_id), _one('SELECT name FROM roles WHERE id = ?', (role_id,)))
+    return row['name'] if row else None
+
+
+def _assistant_loader(assistant_id):
+    one = _one('SELECT id,name,engine_id,system_prompt,cache_responses FROM ai_assistants WHERE id=?', (assistant_id,))
+
+    def load(db):
+        row = one(db)
+        if row:
+            # the pinned engine_id leads; ai_assistant_engines adds the rest of the pool
+            rows = db.execute('SELECT engine_id FROM ai_assistant_engines WHERE assistant_id=? ORDER BY position, engine_id', (assistant_id,)).fetchall()
+            row['engine_ids'] = [row['engine_id']] + [r['engine_id'] for r in rows if r['engine_id'] != row['engine_id']]
+        return row
+    return load
+
+
+def get_assistant(db, assistant_id):
+    return metadata.get(db, ('assistant', assistant_id), _assistant_loader(assistant_id))
+
+
+def get_engine(db, engine_id):
+    return metadata.get(db, ('engine', engine_id), _one('SELECT id,provider,api_url,api_key,model_name FROM ai_engines WHERE id=?', (engine_id,)))
+
+
+def invalidate():
+    metadata.invalidate()
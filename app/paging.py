@@ -0,0 +1,79 @@
+import json
+import base64
+from .cache import TTLCache
+
+# totals for filtered listings are recomputed at most every 30s per (table, query)
+count_cache = TTLCache(maxsize=1024, ttl=30)
+
+COUNTED_TABLES = ('crawl_items', 'crawl_rules', 'ai_engines', 'ai_assistants')
+# OFFSET paging gets slower with depth, keyset paging does not, so cursor requests may ask for more
+MAX_LIMIT = 100
+MAX_CURSOR_LIMIT = 500
+
+
+def encode_cursor(sort_value, row_id):
+    raw = json.dumps([sort_value, row_id], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw.decode('utf-8'))
+        return sort_value, int(row_id)
+    except Exception:
+        return None
+
+
+def page_args(args, default_limit):
+    try:
+        page = int(args.get('page', '1'))
+        limit = int(args.get('limit', str(default_limit)))
+    except Exception:
+        page, limit = 1, default_limit
+    if page < 1:
+        page = 1
+    if limit < 1:
+        limit = default_limit
+    cap = MAX_CURSOR_LIMIT if 'cursor' in args else MAX_LIMIT
+    if limit > cap:
+        limit = cap
+    q = (args.get('q','') or '').strip()
+    return page, limit, q, decode_cursor(args.get('cursor'))
+
+
+def keyset(sort_expr, id_expr, cursor, page, limit):
+    # (sort, id) strictly after the cursor when one is given, otherwise plain OFFSET for random page jumps
+    if cursor:
+        return f'({sort_expr}, {id_expr}) < (?, ?)', [cursor[0], cursor[1]], ' LIMIT ?', [limit]
+    return '', [], ' LIMIT ? OFFSET ?', [limit, (page - 1) * limit]
+
+
+def next_cursor(rows, limit, sort_key, id_key='id'):
+    if len(rows) < limit or not rows:
+        return None
+    last = rows[-1]
+    return encode_cursor(last[sort_key], last[id_key])
+
+
+def table_count(db, table):
+    # maintained by the *_count_ai/_ad triggers; seeded from COUNT(1) the first time it is read
+    if table not in COUNTED_TABLES:
+        raise ValueError('no maintained count for ' + table)
+    row = db.execute('SELECT cnt FROM table_counts WHERE name=?', (table,)).fetchone()
+    if row is None:
+        db.execute(f'INSERT OR IGNORE INTO table_counts(name, cnt) SELECT ?, COUNT(1) FROM {table}', (table,))
+        db.commit()
+        row = db.execute('SELECT cnt FROM table_counts WHERE name=?', (table,)).fetchone()
+    return row['cnt']
+
+
+def cached_count(db, table, q, sql, params):
+    key = count_cache.make_key(table, q)
+    total = count_cache.get(key)
+    if total is None:
+        total = db.execute(sql, params).fetchone()[0]
+        count_cache.set(key, total)
+    return total
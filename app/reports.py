@@ -0,0 +1,240 @@
+import os
+import datetime
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import llm
+from .analysis import budget_for, call_engine, pick_engine, split_chunks, Stopped
+from .archive import attached, partitions_between
+from .blobs import content_hash, load_text
+from .search import match_query
+
+# reports are built map-reduce style: one short summary per article (kept in article_summaries by
+# content hash, so a re-run only summarises new articles), then the summaries are condensed batch by
+# batch into one briefing. Batches follow item id, so older batches repeat and hit the LLM cache.
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '4'))
+REPORT_MAX_ITEMS = int(os.environ.get('REPORT_MAX_ITEMS', '500'))
+REPORT_ARTICLE_CHARS = int(os.environ.get('REPORT_ARTICLE_CHARS', '3000'))
+REPORT_BATCH_TOKENS = int(os.environ.get('REPORT_BATCH_TOKENS', '3000'))
+# reduce levels before the final report; 500 articles condense in three
+REPORT_MAX_LEVELS = int(os.environ.get('REPORT_MAX_LEVELS', '4'))
+
+MAP_PROMPT = '你是政务舆情分析员。用不超过100字概括这篇新闻的核心事实（主体、事件、时间、影响），只输出概括正文。'
+REDUCE_PROMPT = '下面是若干条新闻要点，请归纳为一段舆情简报：按主题分条列出主要事件和各方反应，不超过400字，只输出简报正文。'
+FINAL_PROMPT = (
+    '下面是一组新闻要点或分段简报，请整合为一份舆情报告，分为“总体态势”“重点事件”“风险提示”三部分，'
+    '不超过800字，不要编造材料中没有的内容。'
+)
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+def select_items(db, keyword='', date_from='', date_to='', limit=REPORT_MAX_ITEMS, schemas=('main',)):
+    # newest matching rows across main and the attached partitions, returned oldest first so new articles
+    # land in the last batches; part names the schema a row's body is read from
+    match = match_query(keyword) if keyword else None
+    dates = []
+    date_params = []
+    if date_from:
+        dates.append('created_at >= ?')
+        date_params.append(date_from)
+    if date_to:
+        dates.append("created_at < date(?, '+1 day')")
+        date_params.append(date_to)
+    branches = []
+    params = []
+    for s in schemas:
+        where = list(dates)
+        args = list(date_params)
+        if s == 'main':
+            # near-duplicates would only summarise the same story again
+            where.append('dup_of IS NULL')
+        if match and s == 'main':
+            where.append('id IN (SELECT rowid FROM crawl_items_fts WHERE crawl_items_fts MATCH ?)')
+            args.append(match)
+        elif keyword:
+            # partitions carry no FTS index, so they are matched on title and keyword only
+            where.append('(title LIKE ? OR keyword LIKE ?)')
+            args += ['%' + keyword + '%'] * 2
+        clause = (' WHERE ' + ' AND '.join(where)) if where else ''
+        branches.append(f"SELECT id,title,summary,content_hash,created_at,'{s}' AS part FROM {s}.crawl_items{clause}")
+        params += args
+    rows = db.execute(' UNION ALL '.join(branches) + ' ORDER BY created_at DESC, id DESC LIMIT ?', params + [limit]).fetchall()
+    return sorted(rows, key=lambda r: r['id'])
+
+
+def article_key(row):
+    # articles without a stored body are keyed by what is summarised instead: title and summary
+    return row['content_hash'] or content_hash((row['title'] or '') + '\n' + (row['summary'] or ''))
+
+
+def summarize_article(engine, row, text, budget, should_stop):
+    chunks = split_chunks(text, REPORT_ARTICLE_CHARS, 1)
+    body = chunks[0] if chunks else (row['summary'] or '')
+    reply, remote = call_engine(engine, [{'role': 'system', 'content': MAP_PROMPT}, {'role': 'user', 'content': f"标题：{row['title'] or ''}\n{body}"}], budget, should_stop)
+    return reply.strip(), remote
+
+
+def pack(texts, limit=REPORT_BATCH_TOKENS):
+    batches = []
+    current = []
+    used = 0
+    for t in texts:
+        cost = llm.estimate_tokens(t) + 1
+        if current and used + cost > limit:
+            batches.append(current)
+            current = []
+            used = 0
+        current.append(t)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def condense(engine, texts, budget, should_stop, title='', progress=None):
+    # reduces until one batch is left, then writes the final report from it; returns (text, remote calls).
+    # progress(calls so far) runs after every reduce batch.
+    calls = 0
+    level = texts
+    for depth in range(REPORT_MAX_LEVELS + 1):
+        batches = pack(level)
+        if len(batches) <= 1:
+            joined = '\n'.join(f'{i + 1}. {t}' for i, t in enumerate(batches[0] if batches else []))
+            reply, remote = call_engine(engine, [{'role': 'system', 'content': FINAL_PROMPT}, {'role': 'user', 'content': f'报告主题：{title}\n{joined}'}], budget, should_stop)
+            return reply.strip(), calls + remote
+        if depth == REPORT_MAX_LEVELS:
+            break
+        partials = []
+        for batch in batches:
+            joined = '\n'.join(f'{i + 1}. {t}' for i, t in enumerate(batch))
+            reply, remote = call_engine(engine, [{'role': 'system', 'content': REDUCE_PROMPT}, {'role': 'user', 'content': joined}], budget, should_stop)
+            calls += remote
+            # a long reply would fill a batch on its own; at a quarter of one, each batch of the next
+            # level holds at least three partials, so every level is smaller than the one before
+            partials.append(llm.truncate_tokens(reply.strip(), REPORT_BATCH_TOKENS // 4))
+            if progress:
+                progress(calls)
+        level = partials
+    raise ValueError(f'{len(texts)} summaries did not condense within {REPORT_MAX_LEVELS} levels')
+
+
+def report_title(keyword, date_from, date_to):
+    span = f'{date_from or "最早"}至{date_to or "今"}' if (date_from or date_to) else datetime.date.today().isoformat()
+    return f'{keyword or "综合"}舆情报告（{span}）'
+
+
+def build_report(db, params, progress=None, should_cancel=None):
+    # archived months the date range reaches stay attached for the whole build, since bodies are read lazily
+    date_from = params.get('date_from') or ''
+    date_to = params.get('date_to') or ''
+    months = partitions_between(date_from, date_to) if (date_from or date_to) else []
+    with attached(db, months) as aliases:
+        return _build_report(db, params, ['main'] + aliases, progress, should_cancel)
+
+
+def _build_report(db, params, schemas, progress, should_cancel):
+    engine = pick_engine(db, params.get('engine_id'))
+    if not engine:
+        raise ValueError('engine not found')
+    budget = budget_for(engine['id'])
+    keyword = params.get('keyword') or ''
+    date_from = params.get('date_from') or ''
+    date_to = params.get('date_to') or ''
+    stats = {'pages_fetched': 0, 'items_found': 0, 'items_saved': 0, 'errors': 0}
+    stop = threading.Event()
+
+    def cancelled():
+        if should_cancel and should_cancel():
+            stop.set()
+        return stop.is_set()
+
+    rows = select_items(db, keyword, date_from, date_to, int(params.get('limit') or REPORT_MAX_ITEMS), schemas)
+    if not rows:
+        raise ValueError('no articles matched')
+    stats['items_found'] = len(rows)
+    keys = {r['id']: article_key(r) for r in rows}
+    per_key = Counter(keys.values())
+    summaries = {}
+    wanted = list(set(keys.values()))
+    for i in range(0, len(wanted), 500):
+        chunk = wanted[i:i + 500]
+        for s in db.execute(f"SELECT content_hash, summary FROM article_summaries WHERE model=? AND content_hash IN ({','.join('?' * len(chunk))})", [engine['model_name']] + chunk):
+            summaries[s['content_hash']] = s['summary']
+    todo = []
+    queued = set()
+    for r in rows:
+        k = keys[r['id']]
+        if k not in summaries and k not in queued:
+            queued.add(k)
+            todo.append(r)
+    stats['items_saved'] = sum(n for k, n in per_key.items() if k in summaries)
+    if progress:
+        progress(stats)
+
+    # workers only call the engine; summaries are written on this thread's connection
+    pending = {}
+    made = 0
+    with ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='report') as pool:
+        it = iter(todo)
+        while not cancelled():
+            while len(pending) < REPORT_WORKERS * 2:
+                row = next(it, None)
+                if row is None:
+                    break
+                text = load_text(db, row['content_hash'], schema=row['part']) or row['summary'] or ''
+                pending[pool.submit(summarize_article, engine, row, text, budget, stop.is_set)] = row
+            if not pending:
+                break
+            finished, _ = wait(list(pending), timeout=1.0, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                row = pending.pop(fut)
+                try:
+                    summary, remote = fut.result()
+                except Stopped:
+                    continue
+                except Exception:
+                    stats['errors'] += 1
+                    continue
+                stats['pages_fetched'] += remote
+                k = keys[row['id']]
+                summaries[k] = summary
+                db.execute(
+                    'INSERT OR REPLACE INTO article_summaries(content_hash, model, summary, created_at) VALUES(?,?,?,?)',
+                    (k, engine['model_name'], summary, _now())
+                )
+                db.commit()
+                stats['items_saved'] += per_key[k]
+                made += 1
+            if progress:
+                progress(stats)
+        for fut in pending:
+            fut.cancel()
+    if cancelled():
+        return stats, {}
+    texts = []
+    seen = set()
+    for r in rows:
+        k = keys[r['id']]
+        if k in summaries and k not in seen:
+            seen.add(k)
+            texts.append(summaries[k])
+    if not texts:
+        raise ValueError(f"summarising failed for all {len(rows)} matched articles ({stats['errors']} errors)")
+    title = report_title(keyword, date_from, date_to)
+    fetched = stats['pages_fetched']
+
+    def reduced(calls):
+        # keeps the job's heartbeat fresh through a long reduce
+        stats['pages_fetched'] = fetched + calls
+        if progress:
+            progress(stats)
+
+    body, calls = condense(engine, texts, budget, stop.is_set, keyword or title, reduced)
+    stats['pages_fetched'] = fetched + calls
+    body += f'\n\n（基于{len(texts)}篇文章，本次新增摘要{made}篇）'
+    cur = db.execute('INSERT INTO reports(title, body, created_at) VALUES(?,?,?)', (title, body, _now()))
+    db.commit()
+    return stats, {'report_id': cur.lastrowid}
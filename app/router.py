@@ -0,0 +1,260 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import llm
+
+# an assistant's engine pool is tried best-first by measured latency and error rate. Every attempt streams,
+# so latency is time to the first token: an engine that has not produced one after its usual latency plus
+# HEDGE_DEVIATIONS deviations (at least HEDGE_AFTER seconds) is hedged with the next one, an error fails
+# over at once, and the whole call gives up after DEADLINE seconds instead of waiting on one provider.
+HEDGE_AFTER = float(os.environ.get('LLM_HEDGE_AFTER', '4'))
+HEDGE_DEVIATIONS = 4.0
+DEADLINE = float(os.environ.get('LLM_DEADLINE', str(llm.CHAT_TIMEOUT)))
+MAX_ATTEMPTS = int(os.environ.get('LLM_MAX_ATTEMPTS', '3'))
+# consecutive failures that take an engine out of rotation for COOLDOWN seconds
+TRIP_AFTER = int(os.environ.get('LLM_ENGINE_TRIP_AFTER', '3'))
+COOLDOWN = float(os.environ.get('LLM_ENGINE_COOLDOWN', '30'))
+EWMA_ALPHA = 0.3
+ERROR_WEIGHT = 4.0
+
+
+class EngineError(Exception):
+    pass
+
+
+class EngineHealth:
+    # latency is seconds to the first answer token, smoothed; deviation is its smoothed absolute deviation
+
+    def __init__(self):
+        self.latency = None
+        self.deviation = 0.0
+        self.error_rate = 0.0
+        self.failures = 0
+        self.down_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.wins = 0
+
+    def score(self):
+        latency = self.latency if self.latency is not None else HEDGE_AFTER / 2
+        return latency * (1 + ERROR_WEIGHT * self.error_rate)
+
+    def hedge_after(self):
+        if self.latency is None:
+            return HEDGE_AFTER
+        return max(HEDGE_AFTER, self.latency + HEDGE_DEVIATIONS * self.deviation)
+
+
+class Router:
+
+    def __init__(self):
+        self._health = {}
+        self._lock = threading.Lock()
+        self.hedges = 0
+        self.failovers = 0
+
+    def _get(self, engine_id):
+        h = self._health.get(engine_id)
+        if h is None:
+            h = self._health[engine_id] = EngineHealth()
+        return h
+
+    def rank(self, engines):
+        # engines in cooldown go last rather than away, so a pool that is entirely down is still tried
+        now = time.monotonic()
+        with self._lock:
+            keyed = [(self._get(e['id']).down_until > now, self._get(e['id']).score(), i, e) for i, e in enumerate(engines)]
+        keyed.sort(key=lambda k: k[:3])
+        return [k[3] for k in keyed]
+
+    def success(self, engine_id, latency):
+        with self._lock:
+            h = self._get(engine_id)
+            h.requests += 1
+            h.failures = 0
+            h.down_until = 0.0
+            if h.latency is None:
+                h.latency = latency
+            else:
+                h.deviation = (1 - EWMA_ALPHA) * h.deviation + EWMA_ALPHA * abs(latency - h.latency)
+                h.latency = (1 - EWMA_ALPHA) * h.latency + EWMA_ALPHA * latency
+            h.error_rate = (1 - EWMA_ALPHA) * h.error_rate
+
+    def failure(self, engine_id):
+        with self._lock:
+            h = self._get(engine_id)
+            h.requests += 1
+            h.errors += 1
+            h.failures += 1
+            h.error_rate = (1 - EWMA_ALPHA) * h.error_rate + EWMA_ALPHA
+            if h.failures >= TRIP_AFTER:
+                h.down_until = time.monotonic() + COOLDOWN
+
+    def hedge_after(self, engine_id):
+        with self._lock:
+            return self._get(engine_id).hedge_after()
+
+    def win(self, engine_id):
+        with self._lock:
+            self._get(engine_id).wins += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'hedges': self.hedges,
+                'failovers': self.failovers,
+                'engines': {
+                    str(engine_id): {
+                        'latency': round(h.latency, 3) if h.latency is not None else None,
+                        'hedge_after': round(h.hedge_after(), 3),
+                        'error_rate': round(h.error_rate, 3),
+                        'requests': h.requests,
+                        'errors': h.errors,
+                        'wins': h.wins,
+                        'down': h.down_until > now
+                    } for engine_id, h in self._health.items()
+                }
+            }
+
+
+router = Router()
+# an attempt that loses a hedge stops at its next chunk, but one still waiting for its first keeps a worker
+_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('LLM_ROUTER_WORKERS', '32')), thread_name_prefix='llm-route')
+
+
+class _Attempts:
+    # launches engines in ranked order and decides when the next one is due
+
+    def __init__(self, engines, deadline):
+        self.order = router.rank(engines)[:MAX_ATTEMPTS]
+        # with a single engine the session's own connect retries are the only second chance
+        self.retries = 0 if len(self.order) > 1 else None
+        self.launched = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.end = self.started + deadline
+        self.next_at = self.started
+
+    def more(self):
+        return self.launched < len(self.order)
+
+    def launch(self, fn, *args):
+        i = self.launched
+        self.launched += 1
+        self.next_at = time.monotonic() + router.hedge_after(self.order[i]['id'])
+        _pool.submit(fn, i, self.order[i], *args)
+
+    def wait_for(self, events):
+        # next event, or None once the next hedge is due; raises when the deadline passes
+        while True:
+            now = time.monotonic()
+            if now >= self.end:
+                raise EngineError(f'no engine answered within {self.end - self.started:g}s')
+            until = min(self.next_at, self.end) if self.more() else self.end
+            try:
+                return events.get(timeout=max(until - now, 0.01))
+            except queue.Empty:
+                if self.more() and time.monotonic() >= self.next_at:
+                    with router._lock:
+                        router.hedges += 1
+                    return None
+
+    def failover(self, launch):
+        # after an error: start the next engine if there is one; False once every launched attempt failed
+        self.failed += 1
+        if self.more():
+            with router._lock:
+                router.failovers += 1
+            launch()
+            return True
+        return self.failed < self.launched
+
+
+def complete(engines, messages, temperature=llm.DEFAULT_TEMPERATURE, deadline=DEADLINE):
+    # returns (reply, engine) from the first engine in the pool that answers. The attempts stream even
+    # here: hedging on the whole answer would race every long reply, and a streamed loser can be stopped.
+    chosen = []
+    reply = ''.join(stream(engines, messages, temperature, on_engine=chosen.append, deadline=deadline))
+    return reply, chosen[0]
+
+
+def stream(engines, messages, temperature=llm.DEFAULT_TEMPERATURE, on_engine=None, deadline=DEADLINE):
+    # yields deltas from the first engine to produce one; the others are told to stop. Once text has
+    # been produced there is no failover, since a second engine would start the answer over.
+    attempts = _Attempts(engines, deadline)
+    events = queue.Queue()
+    stops = []
+
+    def attempt(i, engine, stop):
+        t0 = time.monotonic()
+        first = True
+        try:
+            parts = llm.stream(engine, messages, temperature, retries=attempts.retries)
+            try:
+                for delta in parts:
+                    if first:
+                        router.success(engine['id'], time.monotonic() - t0)
+                        first = False
+                    if stop.is_set():
+                        return
+                    events.put((i, 'delta', delta))
+            finally:
+                parts.close()
+            if first:
+                router.success(engine['id'], time.monotonic() - t0)
+            events.put((i, 'end', None))
+        except Exception as e:
+            if not stop.is_set():
+                router.failure(engine['id'])
+            events.put((i, 'error', e))
+
+    def launch():
+        stops.append(threading.Event())
+        attempts.launch(attempt, stops[-1])
+
+    winner = None
+
+    def choose(i):
+        for j, stop in enumerate(stops):
+            if j != i:
+                stop.set()
+        router.win(attempts.order[i]['id'])
+        if on_engine:
+            on_engine(attempts.order[i])
+        return i
+
+    launch()
+    try:
+        while True:
+            if winner is None:
+                event = attempts.wait_for(events)
+                if event is None:
+                    launch()
+                    continue
+            else:
+                # the winning attempt's own read timeout bounds this wait
+                event = events.get()
+            i, kind, data = event
+            if winner is not None and i != winner:
+                continue
+            if kind == 'delta':
+                if winner is None:
+                    winner = choose(i)
+                yield data
+            elif kind == 'end':
+                if winner is None:
+                    winner = choose(i)
+                return
+            elif winner is not None or not attempts.failover(launch):
+                raise data
+    finally:
+        # also runs when the client disconnects; attempts stop at their next chunk
+        for stop in stops:
+            stop.set()
+
+
+def stats():
+    return router.stats()
@@ -13,5 +13,10 @@ def index():
 def reports():
     from .db import get_db
     db = get_db()
-    latest = db.execute('SELECT title, body, created_at FROM reports ORDER BY id DESC LIMIT 1').fetchone()
-    return render_template('reports/index.html', latest=latest)
+    report_id = request.args.get('id', type=int)
+    if report_id:
+        latest = db.execute('SELECT id, title, body, created_at FROM reports WHERE id=?', (report_id,)).fetchone()
+    else:
+        latest = db.execute('SELECT id, title, body, created_at FROM reports ORDER BY id DESC LIMIT 1').fetchone()
+    recent = db.execute('SELECT id, title, created_at FROM reports ORDER BY id DESC LIMIT 20').fetchall()
+    return render_template('reports/index.html', latest=latest, recent=recent)
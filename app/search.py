@@ -0,0 +1,94 @@
+import re
+import html
+
+# crawl_items_fts is a contentless FTS5 index fed with pre-tokenized text: CJK runs become
+# overlapping character bigrams and other words are lower-cased, so unicode61 indexes them as-is
+TOKEN_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿]+|[0-9A-Za-zÀ-ɏ]+')
+CJK_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿]')
+# bm25 column weights: title, summary, keyword, deep_content
+BM25_WEIGHTS = (5.0, 2.0, 3.0, 1.0)
+
+
+def _run_tokens(run):
+    if CJK_RE.match(run):
+        if len(run) == 1:
+            return [run]
+        return [run[i:i+2] for i in range(len(run) - 1)]
+    return [run.lower()]
+
+
+def cjk_bigrams(text):
+    if not text:
+        return ''
+    tokens = []
+    for m in TOKEN_RE.finditer(text):
+        tokens.extend(_run_tokens(m.group(0)))
+    return ' '.join(tokens)
+
+
+def match_query(q):
+    # every CJK run must appear as consecutive bigrams (a phrase), i.e. as a substring
+    phrases = []
+    for m in TOKEN_RE.finditer(q or ''):
+        run = m.group(0)
+        if CJK_RE.match(run) and len(run) == 1:
+            return None
+        phrases.append('"' + ' '.join(_run_tokens(run)) + '"')
+    if not phrases:
+        return None
+    return ' AND '.join(phrases)
+
+
+def query_terms(q):
+    return [m.group(0) for m in TOKEN_RE.finditer(q or '')]
+
+
+def highlight(text, terms, width=120):
+    text = text or ''
+    if not text:
+        return ''
+    lowered = text.lower()
+    spans = []
+    for t in terms:
+        t_low = t.lower()
+        start = lowered.find(t_low)
+        while start >= 0:
+            spans.append((start, start + len(t)))
+            start = lowered.find(t_low, start + len(t))
+    if not spans:
+        return html.escape(text[:width]) + ('…' if len(text) > width else '')
+    spans.sort()
+    first = spans[0][0]
+    lo = max(0, first - width // 3)
+    hi = min(len(text), lo + width)
+    out = ['…' if lo > 0 else '']
+    pos = lo
+    for s, e in spans:
+        if s < pos or e > hi:
+            continue
+        out.append(html.escape(text[pos:s]))
+        out.append('<em>' + html.escape(text[s:e]) + '</em>')
+        pos = e
+    out.append(html.escape(text[pos:hi]))
+    if hi < len(text):
+        out.append('…')
+    return ''.join(out)
+
+
+def snippet(row, terms, width=120):
+    for field in ('summary', 'deep_content', 'title'):
+        value = row[field] or ''
+        low = value.lower()
+        if any(t.lower() in low for t in terms):
+            return highlight(value, terms, width)
+    return highlight(row['summary'] or '', terms, width)
+
+
+def rebuild_index(db):
+    db.execute("INSERT INTO crawl_items_fts(crawl_items_fts) VALUES('delete-all')")
+    db.execute(
+        'INSERT INTO crawl_items_fts(rowid, title, summary, keyword, deep_content) '
+        'SELECT c.id, cjk_bigrams(c.title), cjk_bigrams(c.summary), cjk_bigrams(c.keyword), cjk_bigrams(inflate(b.data)) '
+        'FROM crawl_items c LEFT JOIN content_blobs b ON b.hash=c.content_hash'
+    )
+    db.commit()
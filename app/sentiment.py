@@ -0,0 +1,317 @@
+import os
+import json
+import datetime
+from collections import deque
+from flask import current_app
+from .analysis import label_for
+from .blobs import inflate
+import numpy as np
+
+# local first-pass scoring: one Aho-Corasick automaton over every lexicon term finds all matches in a
+# single pass over the text, then the matches of a whole batch are summed per item. Items the lexicon
+# flags (clearly negative or carrying risk terms) are the ones worth sending to the LLM.
+SENTIMENT_LEXICON = os.environ.get('SENTIMENT_LEXICON', '')
+SENTIMENT_BATCH = int(os.environ.get('SENTIMENT_BATCH', '2000'))
+# only the head of long bodies is scanned; the lede carries the tone of a news article
+SENTIMENT_CHARS = int(os.environ.get('SENTIMENT_CHARS', '3000'))
+FLAG_SCORE = float(os.environ.get('SENTIMENT_FLAG_SCORE', '-0.3'))
+FLAG_RISK = float(os.environ.get('SENTIMENT_FLAG_RISK', '3'))
+# a negator flips a sentiment term starting at most this many characters after it (不太好, 没有明显改善)
+NEGATION_GAP = 2
+# damps the score of items with only one or two matches: a single weight-1 term scores 1/(1+SMOOTHING)
+SMOOTHING = 1.0
+MAX_TERMS = 10
+
+# term weight [kind]; kind is sentiment (default), risk or negation. A lexicon file in the same format
+# (SENTIMENT_LEXICON or the SENTIMENT_LEXICON config key) is read after these and overrides them.
+DEFAULT_LEXICON = '''
+# sentiment
+好评 1
+点赞 1
+满意 1
+称赞 1
+赞扬 1
+支持 0.5
+欢迎 0.5
+改善 1
+提升 0.5
+进展 0.5
+突破 1
+成功 1
+成效 1
+顺利 0.5
+稳定 0.5
+增长 0.5
+受益 1
+惠民 1
+便民 1
+优化 0.5
+安全 0.5
+和谐 0.5
+繁荣 1
+创新 0.5
+不满 -1
+不安全 -1
+投诉 -1
+抱怨 -1
+质疑 -1
+批评 -1
+谴责 -1.5
+愤怒 -1.5
+担忧 -1
+恐慌 -1.5
+失望 -1
+困难 -0.5
+下滑 -1
+下降 -0.5
+亏损 -1
+拖欠 -1.5
+延误 -0.5
+混乱 -1
+乱象 -1
+违规 -1
+违法 -1.5
+失职 -1.5
+敷衍 -1
+推诿 -1
+损失 -1
+伤亡 -2
+死亡 -2
+受伤 -1
+事故 -1.5
+# risk
+群体性事件 3 risk
+聚集 1 risk
+上访 2 risk
+维权 1.5 risk
+罢工 2 risk
+抗议 2 risk
+冲突 1.5 risk
+爆炸 2 risk
+火灾 1.5 risk
+坍塌 2 risk
+泄漏 1.5 risk
+污染 1 risk
+疫情 1 risk
+食品安全 1.5 risk
+腐败 2 risk
+贪污 2 risk
+受贿 2 risk
+诈骗 1.5 risk
+谣言 1 risk
+网暴 1.5 risk
+舆论 0.5 risk
+曝光 1 risk
+# negators
+不 0 negation
+没 0 negation
+没有 0 negation
+未 0 negation
+无 0 negation
+并非 0 negation
+不再 0 negation
+'''
+KINDS = ('sentiment', 'risk', 'negation')
+SENTIMENT, RISK, NEGATION = range(3)
+
+
+class Matcher:
+    # Aho-Corasick automaton; finditer yields (end, pattern index) for every occurrence, in end order
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        goto = [{}]
+        out = [()]
+        for i, p in enumerate(self.patterns):
+            state = 0
+            for ch in p:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = goto[state][ch] = len(goto)
+                    goto.append({})
+                    out.append(())
+                state = nxt
+            out[state] += (i,)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] += out[fail[nxt]]
+        # longest pattern first at each state, which is what overlapping matches resolve to
+        self._out = [tuple(sorted(o, key=lambda i: -len(self.patterns[i]))) for o in out]
+        self._goto = goto
+        self._fail = fail
+
+    def finditer(self, text):
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for end, ch in enumerate(text):
+            nxt = goto[state].get(ch)
+            while nxt is None and state:
+                state = fail[state]
+                nxt = goto[state].get(ch)
+            state = nxt or 0
+            if out[state]:
+                for i in out[state]:
+                    yield end, i
+
+
+class Lexicon:
+
+    def __init__(self, entries):
+        # entries: {term: (weight, kind)}
+        self.terms = sorted(entries)
+        self.weights = [entries[t][0] for t in self.terms]
+        self.kinds = [KINDS.index(entries[t][1]) for t in self.terms]
+        self.matcher = Matcher(self.terms)
+
+    @classmethod
+    def parse(cls, *sources):
+        entries = {}
+        for text in sources:
+            for line in (text or '').splitlines():
+                parts = line.split('#', 1)[0].split()
+                if not parts:
+                    continue
+                try:
+                    weight = float(parts[1]) if len(parts) > 1 else 1.0
+                except ValueError:
+                    continue
+                kind = parts[2] if len(parts) > 2 else 'sentiment'
+                if kind in KINDS:
+                    entries[parts[0]] = (weight, kind)
+        return cls(entries)
+
+    def matches(self, text):
+        # (term index, sign) per match; a match inside a longer one (安全 in 不安全) is dropped
+        found = []
+        negator_end = None
+        for end, i in self.matcher.finditer(text):
+            start = end - len(self.terms[i]) + 1
+            if self.kinds[i] == NEGATION:
+                negator_end = end
+                continue
+            if found and found[-1][1] == end and found[-1][0] <= start:
+                continue
+            while found and found[-1][0] >= start:
+                found.pop()
+            # the negator must end before the term starts, so 不满 is not read as a negated 满
+            negated = negator_end is not None and negator_end < start <= negator_end + NEGATION_GAP + 1
+            found.append((start, end, i, -1 if negated else 1))
+        return [(i, sign) for _, _, i, sign in found]
+
+
+_lexicon = None
+
+
+def get_lexicon():
+    global _lexicon
+    path = current_app.config.get('SENTIMENT_LEXICON') or SENTIMENT_LEXICON
+    if _lexicon is None or _lexicon[0] != path:
+        extra = ''
+        if path:
+            with open(path, encoding='utf-8') as f:
+                extra = f.read()
+        _lexicon = (path, Lexicon.parse(DEFAULT_LEXICON, extra))
+    return _lexicon[1]
+
+
+def score_texts(lexicon, texts):
+    # returns one (score, risk, terms) per text; terms maps matched term -> count, most frequent first
+    docs = []
+    term_ids = []
+    signs = []
+    for n, text in enumerate(texts):
+        for i, sign in lexicon.matches(text):
+            docs.append(n)
+            term_ids.append(i)
+            signs.append(sign)
+    count = len(texts)
+    docs = np.asarray(docs, dtype=np.int64)
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    signed = np.asarray(lexicon.weights)[term_ids] * np.asarray(signs, dtype=np.float64)
+    kinds = np.asarray(lexicon.kinds, dtype=np.int64)[term_ids]
+    is_sentiment = kinds == SENTIMENT
+    total = np.bincount(docs, np.where(is_sentiment, signed, 0.0), count)
+    magnitude = np.bincount(docs, np.where(is_sentiment, np.abs(signed), 0.0), count)
+    # a negated risk term (未发生火灾) adds nothing
+    risks = np.bincount(docs, np.where(is_sentiment, 0.0, np.maximum(signed, 0.0)), count)
+    scores = (total / (magnitude + SMOOTHING)).tolist()
+    risks = risks.tolist()
+    pairs, hits = np.unique(docs * len(lexicon.terms) + term_ids, return_counts=True)
+    pairs = zip(*divmod(pairs, len(lexicon.terms)), hits.tolist())
+    terms = [{} for _ in texts]
+    for n, i, c in pairs:
+        terms[int(n)][lexicon.terms[int(i)]] = int(c)
+    return [
+        (round(s, 3), round(r, 2), dict(sorted(t.items(), key=lambda kv: -kv[1])[:MAX_TERMS]))
+        for s, r, t in zip(scores, risks, terms)
+    ]
+
+
+def is_flagged(score, risk):
+    return score <= FLAG_SCORE or risk >= FLAG_RISK
+
+
+def item_text(row):
+    body = inflate(row['data']) if row['data'] else ''
+    return '\n'.join((row['title'] or '', row['summary'] or '', body[:SENTIMENT_CHARS]))
+
+
+def score_items(db, rescore=False, limit=None, progress=None, should_cancel=None):
+    # scores rows without a score (all rows with rescore) in id order; returns how many were scored
+    lexicon = get_lexicon()
+    now = datetime.datetime.now().isoformat()
+    done = 0
+    flagged = 0
+    last_id = 0
+    while limit is None or done < limit:
+        if should_cancel and should_cancel():
+            break
+        n = SENTIMENT_BATCH if limit is None else min(SENTIMENT_BATCH, limit - done)
+        rows = db.execute(
+            'SELECT c.id, c.title, c.summary, b.data FROM crawl_items c LEFT JOIN content_blobs b ON b.hash = c.content_hash '
+            f"WHERE c.id > ?{'' if rescore else ' AND c.scored_at IS NULL'} ORDER BY c.id LIMIT ?", (last_id, n)
+        ).fetchall()
+        if not rows:
+            break
+        updates = []
+        for r, (score, risk, terms) in zip(rows, score_texts(lexicon, [item_text(r) for r in rows])):
+            flag = 1 if is_flagged(score, risk) else 0
+            flagged += flag
+            updates.append((score, risk, json.dumps(terms, ensure_ascii=False), flag, now, r['id']))
+        db.executemany(
+            'UPDATE crawl_items SET sentiment_score=?, risk_score=?, sentiment_terms=?, sentiment_flag=?, scored_at=? WHERE id=?', updates
+        )
+        db.commit()
+        done += len(rows)
+        last_id = rows[-1]['id']
+        if progress:
+            progress(done, flagged)
+    return done
+
+
+def item_sentiment(row):
+    # the stored lexicon result of a crawl_items row, or None before it is scored
+    if not row['scored_at']:
+        return None
+    try:
+        terms = json.loads(row['sentiment_terms'] or '{}')
+    except ValueError:
+        terms = {}
+    return {
+        'score': row['sentiment_score'],
+        'sentiment': label_for(row['sentiment_score'] or 0.0),
+        'risk': row['risk_score'],
+        'terms': terms,
+        'flagged': bool(row['sentiment_flag']),
+        'scored_at': row['scored_at']
+    }
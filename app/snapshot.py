@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+
+SNAPSHOT_TTL = float(os.environ.get("SNAPSHOT_TTL", "300"))
+
+
+def _grams(text: str, n: int):
+    return {text[i:i+n] for i in range(len(text) - n + 1)}
+
+
+class HomepageSnapshot:
+    # parsed portal headlines kept for SNAPSHOT_TTL seconds and searched through
+    # a character uni/bigram inverted index, so any keyword or page is served without refetching.
+    # With merge, the loader returns {source: entries or None} and merge(sources) builds the entry list;
+    # a source that failed (None) keeps what it had in the previous snapshot.
+
+    def __init__(self, name: str, loader, ttl: float = None, merge=None):
+        self.name = name
+        self.loader = loader
+        self.merge = merge
+        self.ttl = SNAPSHOT_TTL if ttl is None else ttl
+        self._state = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.loads = 0
+        self.hits = 0
+
+    def clear(self):
+        with self._lock:
+            self._state = None
+
+    def _build(self, entries, sources=None):
+        texts = []
+        unigrams = {}
+        bigrams = {}
+        for doc_id, obj in enumerate(entries):
+            text = (obj.get("title") or "") + " " + (obj.get("summary") or "")
+            texts.append(text)
+            for g in _grams(text, 1):
+                unigrams.setdefault(g, []).append(doc_id)
+            for g in _grams(text, 2):
+                bigrams.setdefault(g, []).append(doc_id)
+        return {"entries": entries, "sources": sources, "texts": texts, "uni": unigrams, "bi": bigrams, "loaded_at": time.monotonic()}
+
+    def refresh(self):
+        try:
+            loaded = self.loader()
+        except Exception:
+            loaded = None
+        state = self._state
+        sources = None
+        entries = loaded
+        if self.merge is not None and loaded is not None:
+            sources = dict(state["sources"] or {}) if state else {}
+            sources.update((k, v) for k, v in loaded.items() if v is not None)
+            entries = self.merge(sources)
+        # an empty or failed load never replaces a good snapshot, and a first one is not kept at all,
+        # so the next search tries again instead of serving nothing for a whole TTL
+        if not entries:
+            return state or self._build([])
+        state = self._build(entries, sources)
+        self._state = state
+        self.loads += 1
+        return state
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            self._refreshing = False
+
+    def _current(self):
+        state = self._state
+        if state is None:
+            with self._lock:
+                state = self._state
+                if state is None:
+                    return self.refresh()
+        if time.monotonic() - state["loaded_at"] >= self.ttl and not self._refreshing:
+            with self._lock:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, name="snapshot-" + self.name, daemon=True).start()
+        else:
+            self.hits += 1
+        return state
+
+    def search(self, keyword: str = ""):
+        state = self._current()
+        entries = state["entries"]
+        if not keyword:
+            return [dict(o) for o in entries]
+        if len(keyword) == 1:
+            candidates = state["uni"].get(keyword, [])
+        else:
+            postings = []
+            for g in _grams(keyword, 2):
+                p = state["bi"].get(g)
+                if not p:
+                    return []
+                postings.append(p)
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for p in postings[1:]:
+                candidates.intersection_update(p)
+                if not candidates:
+                    return []
+            candidates = sorted(candidates)
+        texts = state["texts"]
+        return [dict(entries[i]) for i in candidates if keyword in texts[i]]
+
+    def stats(self):
+        state = self._state
+        return {
+            "name": self.name,
+            "entries": len(state["entries"]) if state else 0,
+            "age": (time.monotonic() - state["loaded_at"]) if state else None,
+            "loads": self.loads,
+            "hits": self.hits,
+        }
@@ -0,0 +1,442 @@
+import os
+import json
+import math
+import zlib
+import bisect
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from . import http_client
+from .blobs import load_text
+from .search import cjk_bigrams
+import numpy as np
+
+# article embeddings live next to the database as two append-only files: vectors.f32 holds count x dim
+# float32 rows and ids.i64 the matching crawl_items ids in ascending order. meta.json records which
+# embedder wrote them, so switching embedders starts the index over, and lists edited items awaiting a re-embed.
+VECTOR_EMBEDDER = os.environ.get('VECTOR_EMBEDDER', 'hash')
+HASH_DIM = int(os.environ.get('VECTOR_HASH_DIM', '256'))
+EMBED_BATCH = int(os.environ.get('VECTOR_EMBED_BATCH', '32'))
+EMBED_CHARS = int(os.environ.get('VECTOR_EMBED_CHARS', '2000'))
+EMBED_TIMEOUT = float(os.environ.get('VECTOR_EMBED_TIMEOUT', '30'))
+# semantic endpoints embed at most this many new items before answering; index-vectors does the rest
+CATCHUP_ITEMS = int(os.environ.get('VECTOR_CATCHUP_ITEMS', '500'))
+IVF_NPROBE = int(os.environ.get('VECTOR_IVF_NPROBE', '8'))
+# filing every row costs count x nlist dot products, so the default list count is capped
+IVF_MAX_LISTS = 4096
+SCAN_ROWS = 65536
+
+
+def vector_dir():
+    return current_app.config.get('VECTOR_DIR') or os.path.join(current_app.instance_path, 'vectors')
+
+
+def normalize(v):
+    norm = math.sqrt(sum(x * x for x in v))
+    return [x / norm for x in v] if norm else list(v)
+
+
+class HashingEmbedder:
+    # signed feature hashing of the search tokens (CJK bigrams and lower-cased words); needs no service
+
+    def __init__(self, dim=HASH_DIM):
+        self.dim = dim
+        self.key = f'hash-{dim}'
+
+    def embed(self, texts):
+        out = []
+        for text in texts:
+            v = [0.0] * self.dim
+            for token in cjk_bigrams(text).split():
+                h = zlib.crc32(token.encode('utf-8'))
+                v[h % self.dim] += -1.0 if h & 0x80000000 else 1.0
+            out.append(normalize(v))
+        return out
+
+
+class RemoteEmbedder:
+    # the OpenAI-compatible /embeddings endpoint of an ai_engines row
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.key = f"engine-{engine['id']}-{engine['model_name']}"
+        self.dim = None
+
+    def embed(self, texts):
+        from .llm import chat_headers
+        url = (self.engine['api_url'] or '').rstrip('/') + '/embeddings'
+        payload = {'model': self.engine['model_name'], 'input': list(texts)}
+        resp = http_client.post(url, headers=chat_headers(self.engine), data=json.dumps(payload), timeout=EMBED_TIMEOUT)
+        resp.raise_for_status()
+        data = sorted(resp.json()['data'], key=lambda d: d.get('index', 0))
+        out = [normalize([float(x) for x in d['embedding']]) for d in data]
+        if len(out) != len(texts):
+            raise ValueError('embedding count mismatch')
+        self.dim = len(out[0]) if out else self.dim
+        return out
+
+
+def get_embedder(db):
+    if VECTOR_EMBEDDER == 'hash':
+        return HashingEmbedder()
+    from .metacache import get_engine
+    engine = get_engine(db, int(VECTOR_EMBEDDER))
+    if not engine:
+        raise ValueError('embedding engine not found')
+    return RemoteEmbedder(engine)
+
+
+class VectorStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.vec_path = os.path.join(path, 'vectors.f32')
+        self.ids_path = os.path.join(path, 'ids.i64')
+        self.ivf_path = os.path.join(path, 'ivf.npz')
+        self._lock = threading.Lock()
+        self._loaded = None
+        self.meta = self._read_meta()
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'key': None, 'dim': 0, 'count': 0, 'last_id': 0}
+
+    def _write_meta(self):
+        tmp = self.meta_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self.meta_path)
+
+    @property
+    def count(self):
+        return self.meta['count']
+
+    @property
+    def dim(self):
+        return self.meta['dim']
+
+    def refresh(self):
+        self.meta = self._read_meta()
+
+    def reset(self, key, dim):
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            for p in (self.vec_path, self.ids_path, self.ivf_path):
+                if os.path.exists(p):
+                    os.remove(p)
+            self.meta = {'key': key, 'dim': dim, 'count': 0, 'last_id': 0}
+            self._write_meta()
+            self._loaded = None
+
+    def append(self, ids, vectors, last_id):
+        # rows past meta['count'] (from a crash between the writes) are cut before appending; a batch
+        # another process indexed meanwhile is skipped
+        with self._lock:
+            self.meta = self._read_meta()
+            if ids and ids[0] <= self.meta['last_id']:
+                return False
+            count = self.meta['count']
+            with open(self.vec_path, 'ab') as f:
+                f.truncate(count * self.dim * 4)
+                flat = array('f')
+                for v in vectors:
+                    flat.extend(v)
+                flat.tofile(f)
+            with open(self.ids_path, 'ab') as f:
+                f.truncate(count * 8)
+                array('q', ids).tofile(f)
+            self.meta['count'] = count + len(ids)
+            self.meta['last_id'] = max(last_id, self.meta['last_id'])
+            self._write_meta()
+
+    def mark_stale(self, item_id):
+        # an indexed item whose text changed is queued in meta.json for the next index pass to re-embed
+        with self._lock:
+            self.meta = self._read_meta()
+            stale = self.meta.setdefault('stale', [])
+            if item_id in stale or self.position(item_id) is None:
+                return False
+            stale.append(item_id)
+            self._write_meta()
+            return True
+
+    def clear_stale(self, item_ids):
+        with self._lock:
+            self.meta = self._read_meta()
+            done = set(item_ids)
+            self.meta['stale'] = [i for i in self.meta.get('stale', []) if i not in done]
+            self._write_meta()
+
+    def replace(self, item_id, vector):
+        # rows are fixed size, so an edited item is overwritten in place; its IVF list stays the one its
+        # old vector was filed under until the next build_ivf
+        with self._lock:
+            self.meta = self._read_meta()
+            pos = self.position(item_id)
+            if pos is None:
+                return False
+            with open(self.vec_path, 'r+b') as f:
+                f.seek(pos * self.dim * 4)
+                array('f', vector).tofile(f)
+            self._loaded = None
+            return True
+
+    def load(self):
+        # (matrix, ids) for the rows written so far, reused until the count changes
+        loaded = self._loaded
+        count = self.meta['count']
+        if loaded and loaded[0] == count:
+            return loaded[1], loaded[2]
+        if not count:
+            return None, []
+        matrix = np.memmap(self.vec_path, dtype=np.float32, mode='r', shape=(count, self.dim))
+        ids = np.fromfile(self.ids_path, dtype=np.int64, count=count)
+        self._loaded = (count, matrix, ids)
+        return matrix, ids
+
+    def position(self, item_id):
+        matrix, ids = self.load()
+        if matrix is None:
+            return None
+        pos = bisect.bisect_left(ids, item_id)
+        if pos >= len(ids) or ids[pos] != item_id:
+            return None
+        return pos
+
+    def vector_of(self, item_id):
+        pos = self.position(item_id)
+        if pos is None:
+            return None
+        return [float(x) for x in self.load()[0][pos]]
+
+    def search(self, query, k=10):
+        # [(score, item_id)] by cosine similarity, best first; vectors are unit length so a dot product does
+        matrix, ids = self.load()
+        if matrix is None or k <= 0:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        ivf = self._ivf()
+        if ivf is not None:
+            rows = self._probe(ivf, q)
+        else:
+            rows = None
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+        if rows is not None:
+            chunks = [(rows[i:i + SCAN_ROWS], None) for i in range(0, len(rows), SCAN_ROWS)]
+        else:
+            chunks = [(None, (i, min(i + SCAN_ROWS, len(ids)))) for i in range(0, len(ids), SCAN_ROWS)]
+        for picked, span in chunks:
+            if picked is not None:
+                scores = matrix[picked] @ q
+                positions = picked
+            else:
+                scores = np.asarray(matrix[span[0]:span[1]]) @ q
+                positions = np.arange(span[0], span[1])
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+                scores, positions = scores[top], positions[top]
+            best_scores = np.concatenate([best_scores, scores])
+            best_rows = np.concatenate([best_rows, positions])
+            if len(best_scores) > k:
+                top = np.argpartition(-best_scores, k)[:k]
+                best_scores, best_rows = best_scores[top], best_rows[top]
+        order = np.argsort(-best_scores)
+        return [(float(best_scores[i]), int(ids[best_rows[i]])) for i in order]
+
+    def _ivf(self):
+        if not os.path.exists(self.ivf_path):
+            return None
+        cached = getattr(self, '_ivf_cache', None)
+        mtime = os.path.getmtime(self.ivf_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with np.load(self.ivf_path) as data:
+            ivf = {name: data[name] for name in data.files}
+        if int(ivf['count']) > self.count or ivf['centroids'].shape[1] != self.dim:
+            return None
+        self._ivf_cache = (mtime, ivf)
+        return ivf
+
+    def _probe(self, ivf, q):
+        # rows in the nprobe closest lists, plus every row appended after the IVF was built
+        centroid_scores = ivf['centroids'] @ q
+        nprobe = min(IVF_NPROBE, len(centroid_scores))
+        lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        offsets = ivf['offsets']
+        parts = [ivf['order'][offsets[c]:offsets[c + 1]] for c in lists]
+        built = int(ivf['count'])
+        if built < self.count:
+            parts.append(np.arange(built, self.count, dtype=np.int64))
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+    def build_ivf(self, nlist=None, iters=10, sample=100000, seed=0):
+        # spherical k-means over a sample, then every row is filed under its nearest centroid
+        matrix, ids = self.load()
+        count = len(ids)
+        if not count:
+            return 0
+        nlist = nlist or min(IVF_MAX_LISTS, max(1, int(4 * math.sqrt(count))))
+        nlist = min(nlist, count)
+        rng = np.random.default_rng(seed)
+        picks = np.sort(rng.choice(count, size=min(sample, count), replace=False))
+        train = np.asarray(matrix[picks])
+        centroids = train[rng.choice(len(train), size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(train @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            norms = np.linalg.norm(sums, axis=1)
+            filled = norms > 0
+            centroids[filled] = sums[filled] / norms[filled, None]
+        assign = np.empty(count, dtype=np.int64)
+        for i in range(0, count, SCAN_ROWS):
+            assign[i:i + SCAN_ROWS] = np.argmax(np.asarray(matrix[i:i + SCAN_ROWS]) @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        tmp = self.ivf_path + '.tmp.npz'
+        np.savez(tmp, centroids=centroids.astype(np.float32), order=order, offsets=offsets, count=np.int64(count))
+        os.replace(tmp, self.ivf_path)
+        return nlist
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+_index_lock = threading.Lock()
+
+
+def get_store():
+    path = vector_dir()
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = VectorStore(path)
+    store.refresh()
+    return store
+
+
+def item_text(db, row):
+    body = load_text(db, row['content_hash']) or ''
+    return '\n'.join(filter(None, [row['title'], row['summary'], body[:EMBED_CHARS]]))
+
+
+def index_items(db, max_items=None, rebuild=False, progress=None):
+    # embeds crawl_items newer than the last indexed id; returns the number of rows added.
+    # A catch-up call (max_items set) skips the work while another thread is already indexing.
+    if not _index_lock.acquire(blocking=max_items is None):
+        return 0
+    try:
+        return _index_items(db, max_items, rebuild, progress)
+    finally:
+        _index_lock.release()
+
+
+def _index_items(db, max_items, rebuild, progress):
+    embedder = get_embedder(db)
+    store = get_store()
+    if rebuild or store.meta.get('key') != embedder.key:
+        store.reset(embedder.key, getattr(embedder, 'dim', None) or 0)
+    added = _refresh_stale(db, embedder, store, max_items)
+    while max_items is None or added < max_items:
+        n = EMBED_BATCH if max_items is None else min(EMBED_BATCH, max_items - added)
+        rows = db.execute(
+            'SELECT id,title,summary,content_hash FROM crawl_items WHERE id > ? AND dup_of IS NULL ORDER BY id LIMIT ?',
+            (store.meta['last_id'], n)
+        ).fetchall()
+        if not rows:
+            break
+        vectors = embedder.embed([item_text(db, r) for r in rows])
+        if not store.dim:
+            store.reset(embedder.key, len(vectors[0]))
+        if not store.append([r['id'] for r in rows], vectors, rows[-1]['id']):
+            break
+        added += len(rows)
+        if progress:
+            progress(added)
+    return added
+
+
+def _refresh_stale(db, embedder, store, max_items):
+    # re-embeds edited items in place before any new rows; deleted ones just leave the queue
+    done = 0
+    while max_items is None or done < max_items:
+        n = EMBED_BATCH if max_items is None else min(EMBED_BATCH, max_items - done)
+        ids = store.meta.get('stale', [])[:n]
+        if not ids:
+            break
+        rows = db.execute(
+            f"SELECT id,title,summary,content_hash FROM crawl_items WHERE id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall()
+        if rows:
+            for r, v in zip(rows, embedder.embed([item_text(db, r) for r in rows])):
+                store.replace(r['id'], v)
+        store.clear_stale(ids)
+        done += len(ids)
+    return done
+
+
+_refresh_pool = None
+_refresh_lock = threading.Lock()
+
+
+def _refresh_job(app):
+    from .db import get_db
+    try:
+        with app.app_context():
+            index_items(get_db(), CATCHUP_ITEMS)
+    except Exception:
+        # stale vectors stay queued for the next catch-up or index-vectors run
+        pass
+
+
+def mark_stale(item_id):
+    # called after an item's text is edited; the re-embedding runs off the request
+    global _refresh_pool
+    if not get_store().mark_stale(item_id):
+        return False
+    app = current_app._get_current_object()
+    with _refresh_lock:
+        if _refresh_pool is None:
+            _refresh_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vector-refresh')
+    _refresh_pool.submit(_refresh_job, app)
+    return True
+
+
+def _items(db, hits, exclude=None):
+    # hits of deleted or archived items are dropped here
+    ids = [item_id for _, item_id in hits if item_id != exclude]
+    if not ids:
+        return []
+    rows = {r['id']: r for r in db.execute(
+        f"SELECT id,keyword,title,summary,original_url,source,created_at FROM crawl_items WHERE id IN ({','.join('?' * len(ids))})", ids
+    ).fetchall()}
+    out = []
+    for score, item_id in hits:
+        r = rows.get(item_id)
+        if r is not None and item_id != exclude:
+            out.append(dict(r, score=round(score, 4)))
+    return out
+
+
+def similar_items(db, item_id, k=10):
+    index_items(db, CATCHUP_ITEMS)
+    store = get_store()
+    vector = store.vector_of(item_id)
+    if vector is None:
+        row = db.execute('SELECT id,title,summary,content_hash FROM crawl_items WHERE id=?', (item_id,)).fetchone()
+        if not row:
+            return None
+        vector = get_embedder(db).embed([item_text(db, row)])[0]
+    # a few extra hits cover the item itself and rows deleted since they were indexed
+    return _items(db, store.search(vector, k + 5), exclude=item_id)[:k]
+
+
+def semantic_search(db, text, k=20):
+    index_items(db, CATCHUP_ITEMS)
+    vector = get_embedder(db).embed([text])[0]
+    return _items(db, get_store().search(vector, k + 5))[:k]
@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import http_client, crawler  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+EXPECTED = os.path.join(FIXTURES, "expected.json")
+
+# each case replays its own host -> fixture table; hosts not listed answer 404
+CASES = [
+    {"name": "baidu", "routes": {"www.baidu.com": "baidu_search.html"},
+     "call": lambda: crawler.crawl_baidu_news("成都")},
+    {"name": "sina", "routes": {"search.sina.com.cn": "sina_search.html"},
+     "call": lambda: crawler.crawl_sina_news("成都", page=1, size=20)},
+    {"name": "sohu", "routes": {"search.sohu.com": "sohu_search.html"},
+     "call": lambda: crawler.crawl_sohu_news("成都", offset=0, limit=50)},
+    {"name": "sohu_portal", "routes": {"search.sohu.com": "empty.html", "news.sohu.com": "sohu_home.html"},
+     "call": lambda: cold(crawler.SOHU_HOME_SNAPSHOT, crawler.crawl_sohu_news, "成都", offset=0, limit=50)},
+    {"name": "xinhua", "routes": {"sc.news.cn": "xinhua_sc.html", "bj.news.cn": "xinhua_bj.html"},
+     "call": lambda: cold(crawler.XINHUA_SNAPSHOT, crawler.crawl_xinhua_multi, "", offset=0, limit=500)},
+    {"name": "xinhua_warm", "routes": {"sc.news.cn": "xinhua_sc.html", "bj.news.cn": "xinhua_bj.html"},
+     "call": lambda: crawler.crawl_xinhua_multi("成都", offset=0, limit=500)},
+]
+
+
+def cold(snapshot, fn, *args, **kwargs):
+    # drop the homepage snapshot first so the parse itself is measured
+    snapshot.clear()
+    return fn(*args, **kwargs)
+
+
+class FixtureAdapter(BaseAdapter):
+    def __init__(self, routes):
+        super().__init__()
+        self.routes = routes
+        self.cache = {}
+        self.requests = 0
+
+    def _body(self, name):
+        if name not in self.cache:
+            with open(os.path.join(FIXTURES, name), "rb") as f:
+                self.cache[name] = f.read()
+        return self.cache[name]
+
+    def send(self, request, **kwargs):
+        self.requests += 1
+        host = urlsplit(request.url).hostname or ""
+        resp = requests.Response()
+        resp.url = request.url
+        resp.request = request
+        name = self.routes.get(host)
+        if name:
+            resp.status_code = 200
+            resp._content = self._body(name)
+            resp.headers["Content-Type"] = "text/html; charset=utf-8"
+            resp.encoding = "utf-8"
+        else:
+            resp.status_code = 404
+            resp._content = b""
+        return resp
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, routes):
+        super().__init__()
+        self.routes = routes
+
+    def send(self, request, **kwargs):
+        resp = super().send(request, **kwargs)
+        name = self.routes.get(urlsplit(request.url).hostname or "")
+        if name and resp.status_code == 200:
+            with open(os.path.join(FIXTURES, name), "wb") as f:
+                f.write(resp.content)
+        return resp
+
+
+def summarize(items):
+    return {
+        "count": len(items),
+        "titles": [it.get("title", "") for it in items[:5]],
+        "urls": [it.get("original_url", "") for it in items[:5]],
+    }
+
+
+def run_case(case, repeat):
+    adapter = FixtureAdapter(case["routes"])
+    http_client.set_transport(adapter)
+    items = case["call"]()
+    adapter.requests = 0
+    started = time.perf_counter()
+    total_items = 0
+    for _ in range(repeat):
+        total_items += len(case["call"]())
+    elapsed = time.perf_counter() - started
+    pages = adapter.requests
+    # memory is traced on a separate call so the allocator hooks do not skew the timings
+    tracemalloc.start()
+    case["call"]()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return items, {
+        "pages_per_s": pages / elapsed if elapsed else 0.0,
+        "items_per_s": total_items / elapsed if elapsed else 0.0,
+        "ms_per_call": elapsed * 1000 / repeat,
+        "peak_kb": peak / 1024,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded portal pages through every crawler parser")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--case", action="append", help="only run the named case(s)")
+    parser.add_argument("--update-expected", action="store_true", help="rewrite expected.json from the current parsers")
+    parser.add_argument("--record", action="store_true", help="fetch live pages and overwrite the fixtures")
+    args = parser.parse_args(argv)
+    cases = [c for c in CASES if not args.case or c["name"] in args.case]
+
+    if args.record:
+        for case in cases:
+            http_client.set_transport(RecordingAdapter(case["routes"]))
+            case["call"]()
+            print("recorded", case["name"])
+        http_client.set_transport(None)
+        return 0
+
+    expected = {}
+    if os.path.exists(EXPECTED):
+        with open(EXPECTED, encoding="utf-8") as f:
+            expected = json.load(f)
+    failed = []
+    print("%-12s %8s %10s %10s %10s %10s  %s" % ("case", "items", "pages/s", "items/s", "ms/call", "peak KB", "check"))
+    try:
+        for case in cases:
+            items, stats = run_case(case, max(args.repeat, 1))
+            got = summarize(items)
+            if args.update_expected:
+                expected[case["name"]] = got
+                check = "updated"
+            elif case["name"] not in expected:
+                check = "no baseline"
+            elif expected[case["name"]] == got:
+                check = "ok"
+            else:
+                check = "MISMATCH"
+                failed.append(case["name"])
+            print("%-12s %8d %10.1f %10.1f %10.2f %10.1f  %s" % (
+                case["name"], got["count"], stats["pages_per_s"], stats["items_per_s"], stats["ms_per_call"], stats["peak_kb"], check))
+    finally:
+        http_client.set_transport(None)
+    if args.update_expected:
+        with open(EXPECTED, "w", encoding="utf-8") as f:
+            json.dump(expected, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+    if failed:
+        print("extraction changed for: " + ", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a local OpenAI-compatible /chat/completions and /embeddings endpoint for exercising the chat and analysis
+# pipelines without a real engine: register it as an ai_engine with api_url http://127.0.0.1:PORT/v1
+
+POSITIVE = ("增长", "提升", "推出", "成功", "利好")
+NEGATIVE = ("下降", "事故", "违法", "亏损", "投诉")
+
+
+def fake_reply(messages):
+    system = next((m["content"] for m in messages if m.get("role") == "system"), "")
+    user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+    if "JSON" in system:
+        score = sum(w in user for w in POSITIVE) - sum(w in user for w in NEGATIVE)
+        score = max(-1, min(1, score / 2.0))
+        sentiment = "positive" if score > 0.2 else "negative" if score < -0.2 else "neutral"
+        entities = sorted({w for w in ("成都", "宜宾", "四川", "北京") if w in user})
+        return json.dumps({"sentiment": sentiment, "score": score, "entities": entities, "summary": user[:60]}, ensure_ascii=False)
+    return "收到：" + user[:200]
+
+
+def fake_embedding(text, dim=64):
+    # character bigram counts hashed into dim buckets: similar texts get similar vectors
+    vec = [0.0] * dim
+    text = text or ""
+    for i in range(max(len(text) - 1, 1)):
+        vec[zlib.crc32(text[i:i + 2].encode("utf-8")) % dim] += 1.0
+    return vec
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.0
+    calls = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if self.path.rstrip("/").endswith("/embeddings"):
+            self._json({"data": [{"index": i, "embedding": fake_embedding(t)} for i, t in enumerate(body.get("input") or [])]})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        with Handler.lock:
+            Handler.calls += 1
+        reply = fake_reply(body.get("messages") or [])
+        if self.delay:
+            time.sleep(self.delay)
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(reply), 8):
+                self._chunk("data: " + json.dumps({"choices": [{"delta": {"content": reply[i:i + 8]}}]}, ensure_ascii=False) + "\n\n")
+            self._chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self._json({
+            "choices": [{"message": {"role": "assistant", "content": reply}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+        })
+
+    def _json(self, data):
+        out = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def serve(port=0, delay=0.0):
+    # each server gets its own delay, so a slow and a fast engine can run side by side
+    handler = type("Handler", (Handler,), {"delay": delay})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="mock OpenAI-compatible chat engine")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("MOCK_OPENAI_PORT", "8765")))
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before each reply")
+    args = parser.parse_args(argv)
+    server = serve(args.port, args.delay)
+    print(f"mock engine on http://127.0.0.1:{server.server_port}/v1", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -43,10 +43,84 @@ CREATE TABLE IF NOT EXISTS crawl_items (
   source TEXT,
   deep_crawled INTEGER DEFAULT 0,
   deep_content TEXT,
+  content_hash TEXT,
   detail_json TEXT,
-  created_at TEXT
+  analyzed_at TEXT,
+  created_at TEXT,
+  simhash INTEGER,
+  dup_of INTEGER,
+  sentiment_score REAL,
+  risk_score REAL,
+  sentiment_terms TEXT,
+  sentiment_flag INTEGER,
+  scored_at TEXT
+);
+CREATE TABLE IF NOT EXISTS content_blobs (
+  hash TEXT PRIMARY KEY,
+  data BLOB NOT NULL,
+  size INTEGER
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS article_summaries (
+  content_hash TEXT NOT NULL,
+  model TEXT NOT NULL,
+  summary TEXT,
+  created_at TEXT,
+  PRIMARY KEY(content_hash, model)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_crawl_items_url ON crawl_items(original_url);
+CREATE INDEX IF NOT EXISTS idx_crawl_items_created ON crawl_items(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_crawl_items_dup ON crawl_items(dup_of) WHERE dup_of IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_crawl_items_flagged ON crawl_items(id) WHERE sentiment_flag=1;
+CREATE TABLE IF NOT EXISTS item_simhash (
+  band INTEGER NOT NULL,
+  item_id INTEGER NOT NULL,
+  PRIMARY KEY(band, item_id)
+) WITHOUT ROWID;
+-- deleting the first copy of a story hands its bands to the next copy so later duplicates still cluster
+CREATE TRIGGER IF NOT EXISTS crawl_items_dup_ad AFTER DELETE ON crawl_items BEGIN
+  DELETE FROM item_simhash WHERE item_id=old.id AND band IN (old.simhash & 65535, 65536 | ((old.simhash >> 16) & 65535), 131072 | ((old.simhash >> 32) & 65535), 196608 | ((old.simhash >> 48) & 65535));
+  UPDATE crawl_items SET dup_of=(SELECT MIN(id) FROM crawl_items WHERE dup_of=old.id) WHERE dup_of=old.id AND id > (SELECT MIN(id) FROM crawl_items WHERE dup_of=old.id);
+  INSERT OR IGNORE INTO item_simhash(band, item_id)
+    SELECT simhash & 65535, id FROM crawl_items WHERE dup_of=old.id
+    UNION ALL SELECT 65536 | ((simhash >> 16) & 65535), id FROM crawl_items WHERE dup_of=old.id
+    UNION ALL SELECT 131072 | ((simhash >> 32) & 65535), id FROM crawl_items WHERE dup_of=old.id
+    UNION ALL SELECT 196608 | ((simhash >> 48) & 65535), id FROM crawl_items WHERE dup_of=old.id;
+  UPDATE crawl_items SET dup_of=NULL WHERE dup_of=old.id;
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS crawl_items_fts USING fts5(title, summary, keyword, deep_content, content='', tokenize='unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS crawl_items_fts_ai AFTER INSERT ON crawl_items BEGIN
+  INSERT INTO crawl_items_fts(rowid, title, summary, keyword, deep_content) VALUES (new.id, cjk_bigrams(new.title), cjk_bigrams(new.summary), cjk_bigrams(new.keyword), cjk_bigrams(inflate((SELECT data FROM content_blobs WHERE hash=new.content_hash))));
+END;
+CREATE TRIGGER IF NOT EXISTS crawl_items_fts_ad AFTER DELETE ON crawl_items BEGIN
+  INSERT INTO crawl_items_fts(crawl_items_fts, rowid, title, summary, keyword, deep_content) VALUES ('delete', old.id, cjk_bigrams(old.title), cjk_bigrams(old.summary), cjk_bigrams(old.keyword), cjk_bigrams(inflate((SELECT data FROM content_blobs WHERE hash=old.content_hash))));
+END;
+CREATE TRIGGER IF NOT EXISTS crawl_items_fts_au AFTER UPDATE OF title, summary, keyword, content_hash ON crawl_items BEGIN
+  INSERT INTO crawl_items_fts(crawl_items_fts, rowid, title, summary, keyword, deep_content) VALUES ('delete', old.id, cjk_bigrams(old.title), cjk_bigrams(old.summary), cjk_bigrams(old.keyword), cjk_bigrams(inflate((SELECT data FROM content_blobs WHERE hash=old.content_hash))));
+  INSERT INTO crawl_items_fts(rowid, title, summary, keyword, deep_content) VALUES (new.id, cjk_bigrams(new.title), cjk_bigrams(new.summary), cjk_bigrams(new.keyword), cjk_bigrams(inflate((SELECT data FROM content_blobs WHERE hash=new.content_hash))));
+END;
+CREATE TABLE IF NOT EXISTS crawl_jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL DEFAULT 'crawl_auto',
+  keyword TEXT,
+  source TEXT,
+  num INTEGER,
+  params_json TEXT,
+  status TEXT NOT NULL DEFAULT 'queued',
+  pages_fetched INTEGER DEFAULT 0,
+  items_found INTEGER DEFAULT 0,
+  items_saved INTEGER DEFAULT 0,
+  errors INTEGER DEFAULT 0,
+  error_text TEXT,
+  result_json TEXT,
+  cancel_requested INTEGER DEFAULT 0,
+  created_by INTEGER,
+  worker TEXT,
+  created_at TEXT,
+  started_at TEXT,
+  finished_at TEXT,
+  heartbeat_at TEXT
 );
-CREATE INDEX IF NOT EXISTS idx_crawl_items_url ON crawl_items(original_url);
+CREATE INDEX IF NOT EXISTS idx_crawl_jobs_status ON crawl_jobs(status);
 CREATE TABLE IF NOT EXISTS crawl_rules (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   site TEXT NOT NULL,
@@ -58,6 +132,7 @@ CREATE TABLE IF NOT EXISTS crawl_rules (
   updated_at TEXT
 );
 CREATE UNIQUE INDEX IF NOT EXISTS idx_crawl_rules_site ON crawl_rules(site);
+CREATE INDEX IF NOT EXISTS idx_crawl_rules_updated ON crawl_rules(COALESCE(updated_at,''), id);
 CREATE TABLE IF NOT EXISTS ai_engines (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   provider TEXT NOT NULL,
@@ -69,22 +144,120 @@ CREATE TABLE IF NOT EXISTS ai_engines (
   updated_at TEXT
 );
 CREATE INDEX IF NOT EXISTS idx_ai_engines_provider ON ai_engines(provider);
+CREATE INDEX IF NOT EXISTS idx_ai_engines_updated ON ai_engines(COALESCE(updated_at,''), id);
 CREATE TABLE IF NOT EXISTS ai_assistants (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   name TEXT NOT NULL,
   engine_id INTEGER NOT NULL,
   system_prompt TEXT,
+  cache_responses INTEGER DEFAULT 1,
   created_at TEXT,
   updated_at TEXT,
   FOREIGN KEY(engine_id) REFERENCES ai_engines(id)
 );
 CREATE INDEX IF NOT EXISTS idx_ai_assistants_engine ON ai_assistants(engine_id);
+CREATE INDEX IF NOT EXISTS idx_ai_assistants_updated ON ai_assistants(COALESCE(updated_at,''), id);
+CREATE TABLE IF NOT EXISTS ai_assistant_engines (
+  assistant_id INTEGER NOT NULL,
+  engine_id INTEGER NOT NULL,
+  position INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(assistant_id, engine_id),
+  FOREIGN KEY(assistant_id) REFERENCES ai_assistants(id),
+  FOREIGN KEY(engine_id) REFERENCES ai_engines(id)
+) WITHOUT ROWID;
 CREATE TABLE IF NOT EXISTS ai_messages (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   assistant_id INTEGER NOT NULL,
   role TEXT NOT NULL,
   content TEXT NOT NULL,
+  token_count INTEGER,
   created_at TEXT,
   FOREIGN KEY(assistant_id) REFERENCES ai_assistants(id)
 );
-CREATE INDEX IF NOT EXISTS idx_ai_messages_asst ON ai_messages(assistant_id);
+CREATE INDEX IF NOT EXISTS idx_ai_messages_asst_id ON ai_messages(assistant_id, id);
+CREATE TABLE IF NOT EXISTS ai_summaries (
+  assistant_id INTEGER PRIMARY KEY,
+  upto_id INTEGER NOT NULL,
+  content TEXT,
+  token_count INTEGER,
+  updated_at TEXT,
+  FOREIGN KEY(assistant_id) REFERENCES ai_assistants(id)
+);
+CREATE TABLE IF NOT EXISTS table_counts (
+  name TEXT PRIMARY KEY,
+  cnt INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS crawl_items_count_ai AFTER INSERT ON crawl_items BEGIN
+  UPDATE table_counts SET cnt=cnt+1 WHERE name='crawl_items';
+END;
+CREATE TRIGGER IF NOT EXISTS crawl_items_count_ad AFTER DELETE ON crawl_items BEGIN
+  UPDATE table_counts SET cnt=cnt-1 WHERE name='crawl_items';
+END;
+CREATE TRIGGER IF NOT EXISTS crawl_rules_count_ai AFTER INSERT ON crawl_rules BEGIN
+  UPDATE table_counts SET cnt=cnt+1 WHERE name='crawl_rules';
+END;
+CREATE TRIGGER IF NOT EXISTS crawl_rules_count_ad AFTER DELETE ON crawl_rules BEGIN
+  UPDATE table_counts SET cnt=cnt-1 WHERE name='crawl_rules';
+END;
+CREATE TRIGGER IF NOT EXISTS ai_engines_count_ai AFTER INSERT ON ai_engines BEGIN
+  UPDATE table_counts SET cnt=cnt+1 WHERE name='ai_engines';
+END;
+CREATE TRIGGER IF NOT EXISTS ai_engines_count_ad AFTER DELETE ON ai_engines BEGIN
+  UPDATE table_counts SET cnt=cnt-1 WHERE name='ai_engines';
+END;
+CREATE TRIGGER IF NOT EXISTS ai_assistants_count_ai AFTER INSERT ON ai_assistants BEGIN
+  UPDATE table_counts SET cnt=cnt+1 WHERE name='ai_assistants';
+END;
+CREATE TRIGGER IF NOT EXISTS ai_assistants_count_ad AFTER DELETE ON ai_assistants BEGIN
+  UPDATE table_counts SET cnt=cnt-1 WHERE name='ai_assistants';
+END;
+CREATE TABLE IF NOT EXISTS meta_generation (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  gen INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO meta_generation(id, gen) VALUES (1, 0);
+CREATE TRIGGER IF NOT EXISTS settings_meta_ai AFTER INSERT ON settings BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS settings_meta_au AFTER UPDATE ON settings BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS settings_meta_ad AFTER DELETE ON settings BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS roles_meta_ai AFTER INSERT ON roles BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS roles_meta_au AFTER UPDATE ON roles BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS roles_meta_ad AFTER DELETE ON roles BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_engines_meta_ai AFTER INSERT ON ai_engines BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_engines_meta_au AFTER UPDATE ON ai_engines BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_engines_meta_ad AFTER DELETE ON ai_engines BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_assistants_meta_ai AFTER INSERT ON ai_assistants BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_assistants_meta_au AFTER UPDATE ON ai_assistants BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_assistants_meta_ad AFTER DELETE ON ai_assistants BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_assistant_engines_meta_ai AFTER INSERT ON ai_assistant_engines BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_assistant_engines_meta_au AFTER UPDATE ON ai_assistant_engines BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS ai_assistant_engines_meta_ad AFTER DELETE ON ai_assistant_engines BEGIN
+  UPDATE meta_generation SET gen=gen+1 WHERE id=1;
+END;